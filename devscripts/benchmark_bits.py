@@ -0,0 +1,67 @@
+"""
+Command-line program that compares integer bit operations (bits module)
+with their string versions (utils module).
+
+python benchmark_bits.py --number 100000
+"""
+
+import os
+import sys
+import timeit
+from functools import partial
+
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from polar_rcx5_datalink import bits, utils
+
+# (name, string version, integer version, argument)
+BENCHMARKS = (
+    (
+        'most_significant_byte',
+        utils.most_significant_byte,
+        bits.most_significant_byte,
+        (1234,),
+    ),
+    (
+        'least_significant_byte',
+        utils.least_significant_byte,
+        bits.least_significant_byte,
+        (1234,),
+    ),
+    ('bcd_to_int', utils.bcd_to_int, bits.bcd_to_int, (0x59,)),
+    (
+        'twos_complement_to_int',
+        lambda value: utils.twos_complement_to_int(utils.get_bin(value, 4)),
+        lambda value: bits.to_negative(value, 4),
+        (0b1011,),
+    ),
+    (
+        'int_to_twos_complement',
+        lambda value: int(utils.int_to_twos_complement(value, 12), 2),
+        lambda value: bits.to_unsigned(value, 12),
+        (-100,),
+    ),
+)
+
+
+@click.command()
+@click.option('--number', default=100000, show_default=True)
+@click.option('--repeat', default=5, show_default=True)
+def benchmark_bits(number, repeat):
+    for name, string_func, int_func, args in BENCHMARKS:
+        assert string_func(*args) == int_func(*args)
+        string_time, int_time = (
+            min(timeit.repeat(partial(func, *args), number=number, repeat=repeat))
+            / number
+            for func in (string_func, int_func)
+        )
+        click.echo(
+            f'{name:<24} {string_time * 1e9:8.0f} ns  {int_time * 1e9:8.0f} ns  '
+            f'x{string_time / int_time:.1f}'
+        )
+
+
+if __name__ == '__main__':
+    benchmark_bits()
@@ -0,0 +1,123 @@
+"""
+Command-line program that measures how fast samples are decoded.
+
+python benchmark_parser.py --samples 20000 --repeat 5
+"""
+
+import os
+import sys
+import time
+
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from polar_rcx5_datalink.parser import TrainingSession
+from synthetic_sessions import (
+    encode_hr,
+    gps_session,
+    random_hr,
+    random_track,
+    raw_session,
+)
+
+
+def _without_compiled_loop(ts):
+    # The compiled loop (see _decoder.c) is used whenever it's built
+    ts._iter_compiled_samples = lambda: iter(())
+
+
+def reference_hr_only(ts):
+    # Generic loop without HR lookup table
+    _without_compiled_loop(ts)
+    ts._process_hr_bits = ts._process_hr_bits_reference
+    ts._parse_samples()
+
+
+def generic_hr_only(ts):
+    _without_compiled_loop(ts)
+    ts._parse_samples()
+
+
+def compiled_hr_only(ts):
+    ts._parse_samples()
+
+
+def fast_hr_only(ts):
+    ts._parse_hr_samples()
+
+
+def _without_distance(ts):
+    # Geodesics would dominate, only decoding is measured
+    ts._calculate_distance = lambda coord1, coord2: 0.0
+
+
+def reference_gps(ts):
+    # Float arithmetic on bit strings for coordinates
+    _without_distance(ts)
+    _without_compiled_loop(ts)
+    ts._parse_coord = ts._parse_coord_reference
+    ts._parse_samples()
+
+
+def generic_gps(ts):
+    _without_distance(ts)
+    _without_compiled_loop(ts)
+    ts._parse_samples()
+
+
+def compiled_gps(ts):
+    _without_distance(ts)
+    ts._parse_samples()
+
+
+# (name, kind of session, function)
+BENCHMARKS = (
+    ('hr only, reference', 'hr', reference_hr_only),
+    ('hr only, generic loop', 'hr', generic_hr_only),
+    ('hr only, compiled loop', 'hr', compiled_hr_only),
+    ('hr only, decode_hr', 'hr', fast_hr_only),
+    ('gps+hr, reference coords', 'gps', reference_gps),
+    ('gps+hr, generic loop', 'gps', generic_gps),
+    ('gps+hr, compiled loop', 'gps', compiled_gps),
+)
+
+
+def run(func, raw, repeat):
+    def setup():
+        ts = TrainingSession(raw)
+        ts.set_timezone('UTC')
+        ts._samples_bits = ts._get_samples_bits()
+        return ts
+
+    times = []
+    for _ in range(repeat):
+        ts = setup()
+        start = time.perf_counter()
+        func(ts)
+        times.append(time.perf_counter() - start)
+
+    return min(times), len(ts.samples)
+
+
+@click.command()
+@click.option('--samples', default=20000, show_default=True)
+@click.option('--repeat', default=5, show_default=True)
+def benchmark_parser(samples, repeat):
+    raw_sessions = {
+        'hr': raw_session(encode_hr(random_hr(samples)), has_gps=False),
+        'gps': gps_session(random_track(samples), has_hr=True)[0],
+    }
+
+    baselines = {}
+    for name, kind, func in BENCHMARKS:
+        best, count = run(func, raw_sessions[kind], repeat)
+        baseline = baselines.setdefault(kind, best)
+        click.echo(
+            f'{name:<30} {best * 1000:8.1f} ms  '
+            f'{count / best:12,.0f} samples/s  x{baseline / best:.1f}'
+        )
+
+
+if __name__ == '__main__':
+    benchmark_parser()
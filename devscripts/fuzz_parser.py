@@ -0,0 +1,115 @@
+"""
+Command-line program that makes sessions out of random tracks, checks
+that the parser decodes them to the encoded values and measures how
+fast it does it.
+
+python fuzz_parser.py --sessions 50 --samples 5000 --seed 0
+"""
+
+import os
+import sys
+import time
+
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from polar_rcx5_datalink.exceptions import ParserError
+from polar_rcx5_datalink.parser import Sample, TrainingSession
+from synthetic_sessions import (
+    encode_hr,
+    gps_session,
+    random_hr,
+    random_track,
+    raw_session,
+)
+
+KINDS = ('gps+hr', 'gps', 'hr')
+
+
+def make_session(kind, samples, seed):
+    """Returns raw session and [(hr, lon, lat)] the parser has to decode"""
+    if kind == 'hr':
+        values = random_hr(samples, seed)
+        expected = [Sample(hr)[:3] for hr in values]
+        return raw_session(encode_hr(values), has_gps=False), expected
+
+    has_hr = kind == 'gps+hr'
+    return gps_session(random_track(samples, seed, has_hr), has_hr, seed)
+
+
+def decode(raw):
+    """Returns decoded [(hr, lon, lat)] and seconds it took"""
+    ts = TrainingSession(raw)
+    # Timezone lookup isn't a part of decoding
+    ts.set_timezone('UTC')
+
+    start = time.perf_counter()
+    ts.parse_samples()
+    elapsed = time.perf_counter() - start
+
+    return [sample[:3] for sample in ts.samples], elapsed
+
+
+def first_difference(decoded, expected):
+    for index, (got, value) in enumerate(zip(decoded, expected)):
+        if got != value:
+            return index
+
+    return min(len(decoded), len(expected))
+
+
+@click.command()
+@click.option('--sessions', default=20, show_default=True, help='Per kind.')
+@click.option('--samples', default=5000, show_default=True)
+@click.option('--seed', default=0, show_default=True, help='Seed of the first session.')
+@click.option('--kind', 'kinds', type=click.Choice(KINDS), multiple=True)
+def fuzz_parser(sessions, samples, seed, kinds):
+    failed = False
+    for kind in kinds or KINDS:
+        decoded_count = elapsed = ambiguous = failures = 0
+
+        for session_seed in range(seed, seed + sessions):
+            try:
+                raw, expected = make_session(kind, samples, session_seed)
+            except ValueError as e:
+                # Parser's heuristics can't tell it apart, that's not a failure
+                click.echo(f'{kind} seed {session_seed}: skipped, {e}')
+                ambiguous += 1
+                continue
+
+            try:
+                decoded, took = decode(raw)
+            except ParserError as e:
+                click.echo(f'{kind} seed {session_seed}: {e!r}')
+                failures += 1
+                continue
+
+            if kind == 'hr':
+                # Padding might be decoded as extra samples
+                decoded = decoded[: len(expected)]
+
+            if decoded != expected:
+                index = first_difference(decoded, expected)
+                click.echo(
+                    f'{kind} seed {session_seed}: sample #{index} differs '
+                    f'({len(decoded)} decoded, {len(expected)} encoded)'
+                )
+                failures += 1
+                continue
+
+            decoded_count += len(decoded)
+            elapsed += took
+
+        rate = decoded_count / elapsed if elapsed else 0
+        click.echo(
+            f'{kind:<8} {failures} failed, {ambiguous} skipped, '
+            f'{decoded_count:,} samples in {elapsed:.2f} s, {rate:,.0f} samples/s'
+        )
+        failed = failed or failures > 0
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    fuzz_parser()
@@ -15,7 +15,8 @@ from bs4 import BeautifulSoup
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from polar_rcx5_datalink.utils import get_bin, int_to_twos_complement
+from polar_rcx5_datalink.bits import to_unsigned
+from polar_rcx5_datalink.utils import get_bin
 from polar_rcx5_datalink.parser import TrainingSession
 
 
@@ -34,14 +35,14 @@ def parse_hr(raw_samples):
         elif v < 0:
             prefix = '11'
 
-        samples.append(f'{prefix}{int_to_twos_complement(v, length)}')
+        samples.append(f'{prefix}{get_bin(to_unsigned(v, length), length)}')
 
     return samples
 
 
 def coord_to_bin(coord, length):
     val = round(coord / TrainingSession.COORD_COEFF)
-    return int_to_twos_complement(val, length)
+    return get_bin(to_unsigned(val, length), length)
 
 
 def extract_coords(raw_samples):
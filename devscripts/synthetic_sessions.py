@@ -0,0 +1,516 @@
+"""
+Builds synthetic raw training sessions out of sample values.
+
+Helps to test and benchmark the parser on sessions we don't have
+recordings of (e.g. sessions without gps data). Gps samples are encoded
+by the rules the parser follows, so random tracks make round trips
+through it (see fuzz_parser.py).
+"""
+
+import copy
+import datetime
+import os
+import random
+import re
+import sys
+from collections import namedtuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from polar_rcx5_datalink.bits import to_unsigned
+from polar_rcx5_datalink.parser import TrainingSession
+from polar_rcx5_datalink.utils import get_bin
+
+PACKET_LENGTH = 512
+PACKET_HEADER_LENGTH = 7
+# Trailing bytes of every packet but the last one are cut off by the parser
+PACKET_TAIL_LENGTH = 59
+
+DEFAULT_START_TIME = datetime.datetime(2019, 5, 1, 18, 30, 15)
+DEFAULT_DURATION = datetime.timedelta(hours=1)
+
+
+def random_hr(length, seed=0):
+    """Returns random heart rates with flat stretches and jumps"""
+    rnd = random.Random(seed)
+    values = [rnd.randint(60, 190)]
+    for _ in range(length - 1):
+        change = rnd.choice((0, 0, 0, rnd.randint(-5, 5), rnd.randint(-40, 40)))
+        values.append(min(max(values[-1] + change, 30), 240))
+
+    return values
+
+
+def encode_hr(values):
+    """Encodes heart rates the way the watch does.
+
+    The first value and values that change more than a 4-bit delta
+    allows are full values (011 prefix). HR freezes after two zero
+    deltas in a row, then every unchanged value takes a single bit.
+    """
+    samples = []
+    zero_deltas = 0
+    for i, hr in enumerate(values):
+        delta = hr - values[i - 1] if i > 0 else None
+        frozen = zero_deltas >= 2
+
+        if frozen and delta == 0:
+            samples.append('1')
+            zero_deltas += 1
+        elif delta is None or frozen or not -16 <= delta <= 15:
+            samples.append(f'011{get_bin(hr, 8)}')
+            zero_deltas = 0
+        else:
+            prefix = '10' if delta >= 0 else '11'
+            samples.append(f'{prefix}{get_bin(delta & 0xF, 4)}')
+            zero_deltas = zero_deltas + 1 if delta == 0 else 0
+
+    return samples
+
+
+def info_bytes(
+    has_hr=True,
+    has_gps=False,
+    sample_rate=0,
+    start_time=DEFAULT_START_TIME,
+    duration=DEFAULT_DURATION,
+):
+    """Returns bytes of the first packet that precede samples"""
+
+    def bcd(val):
+        return int(str(val), 16)
+
+    data = [0] * (349 if has_gps else 351)
+    seconds = int(duration.total_seconds())
+    fields = {
+        35: 0,
+        36: bcd(seconds % 60),
+        37: bcd(seconds // 60 % 60),
+        38: bcd(seconds // 3600),
+        39: bcd(start_time.second),
+        40: bcd(start_time.minute),
+        41: bcd(start_time.hour),
+        42: start_time.day,
+        43: start_time.month,
+        44: start_time.year - 1920,
+        50: 50,
+        54: 60,
+        165: int(has_hr),
+        166: int(has_gps),
+        167: sample_rate,
+        201: 140,
+        203: 90,
+        205: 180,
+        219: 190,
+    }
+    for index, value in fields.items():
+        data[index] = value
+
+    return data
+
+
+def raw_session(samples_bits, padding=True, **info):
+    """Splits info bytes and samples bits into packets of a raw session.
+
+    Bits are padded with at least a byte of ones since the parser cuts
+    off trailing zero bytes and stops when less than 6 bits are left.
+    Padding might be decoded as extra samples at the end. Set padding
+    to False for bits that are already aligned to bytes (see encode_gps).
+    """
+    bits = ''.join(samples_bits)
+    if padding:
+        bits += '1' * (8 + -len(bits) % 8)
+
+    data = info_bytes(**info) + [
+        int(bits[i : i + 8], 2) for i in range(0, len(bits), 8)
+    ]
+
+    packets = []
+    chunk_length = PACKET_LENGTH - PACKET_TAIL_LENGTH
+    while True:
+        is_first = not packets
+        header = [] if is_first else [0] * PACKET_HEADER_LENGTH
+        length = chunk_length - len(header)
+        chunk, data = data[:length], data[length:]
+
+        is_last = not data
+        tail = PACKET_LENGTH - len(header) - len(chunk)
+        packets.append(header + chunk + [0 if is_last else 0xFF] * tail)
+
+        if is_last:
+            return packets
+
+
+# Coordinates are encoded in units of COORD_COEFF / 10 ** 9 degrees
+COORD_UNITS = round(10 ** 9 / TrainingSession.COORD_COEFF)
+# Observed values of the 10 bits of unknown purpose that end gps samples
+UNDEFINED_BITS = (
+    '0101111111',
+    '0101111110',
+    '0110111111',
+    '0101101111',
+    '0100111111',
+)
+# Offset of longitude in lap data
+_LAP_LON_OFFSET = 283
+# Integer parts of coordinates can't be confused with bits that follow
+# frozen coordinates and rarely look like lap data (see GpsEncoder.check)
+DEFAULT_LON = 105.4
+DEFAULT_LAT = 65.6
+
+# lon and lat are in COORD_UNITS, speed and distance are raw values
+# of their fields, lap marks samples followed by lap data
+GpsSample = namedtuple(
+    'GpsSample', ['hr', 'lon', 'lat', 'speed', 'distance', 'sat', 'lap']
+)
+
+
+def twos_complement(val, length):
+    return get_bin(to_unsigned(val, length), length)
+
+
+def coord_value(units):
+    """Returns coordinate the way the parser decodes a full value of it"""
+    int_part, frac = divmod(units, COORD_UNITS)
+    return int_part + round(frac * TrainingSession.COORD_COEFF / 10 ** 9, 9)
+
+
+def coord_delta_value(prev, delta):
+    """Returns coordinate the way the parser decodes a delta of it"""
+    return round(prev + round(delta * TrainingSession.COORD_COEFF / 10 ** 9, 9), 9)
+
+
+def random_track(length, seed=0, has_hr=True, lon=DEFAULT_LON, lat=DEFAULT_LAT):
+    """Returns random gps samples with stops, straight stretches and laps.
+
+    Stops and stretches along a meridian or a parallel freeze speed,
+    distance and coordinates. Tracks stay within the starting degrees.
+    """
+    rnd = random.Random(seed)
+    hrs = random_hr(length, seed) if has_hr else [None] * length
+    pos = [round(lon * COORD_UNITS), round(lat * COORD_UNITS)]
+    bounds = [(int(c) * COORD_UNITS, (int(c) + 1) * COORD_UNITS) for c in (lon, lat)]
+    velocity = [0, 0]
+    speed = distance = 0
+    sat = 8
+
+    samples = []
+    for i in range(length):
+        if i == 0 or rnd.random() < 0.03:
+            mode = rnd.choice(('stop', 'straight', 'move', 'move'))
+            velocity = [rnd.randint(-40, 40), rnd.randint(-40, 40)]
+            if mode == 'stop':
+                velocity = [0, 0]
+            elif mode == 'straight':
+                velocity[rnd.randrange(2)] = 0
+        elif rnd.random() < 0.2:
+            velocity = [v + rnd.randint(-3, 3) if v else 0 for v in velocity]
+
+        for axis, (low, high) in enumerate(bounds):
+            if not low + COORD_UNITS // 20 < pos[axis] + velocity[axis] < high:
+                velocity[axis] = -velocity[axis]
+            pos[axis] += velocity[axis]
+
+        moved = abs(velocity[0]) + abs(velocity[1])
+        if not moved:
+            speed = 0
+        elif rnd.random() < 0.3:
+            speed = min(max(speed + rnd.randint(-5, 5), 1), 511)
+        elif rnd.random() < 0.02:
+            speed = rnd.randint(1, 511)
+        distance = (distance + moved // 4) % 2 ** 21
+
+        if rnd.random() < 0.01:
+            sat = rnd.randint(4, 7) if sat == 0 else 0
+        elif rnd.random() < 0.05:
+            sat = min(max(sat + rnd.randint(-2, 2), 0), 15)
+
+        lap = i > 0 and rnd.random() < 0.01
+        samples.append(GpsSample(hrs[i], *pos, speed, distance, sat, lap))
+
+    return samples
+
+
+class GpsEncoder(object):
+    """Encodes gps samples the way the parser reads them.
+
+    Keeps the same state as the parser (zero deltas of every field,
+    prefixless zero satellites) to pick encodings that are read back
+    unambiguously. Encodings the format leaves open (layout of lap data,
+    undefined bits, prefixless satellites) are picked at random.
+    """
+
+    _FIELDS = ('speed', 'distance', 'lon', 'lat', 'sat')
+
+    def __init__(self, has_hr=True, seed=0):
+        self.has_hr = has_hr
+        self.rnd = random.Random(seed)
+        self.bits = []
+        # (hr, lon, lat) of samples as the parser decodes them
+        self.expected = []
+        self.length = 0
+        self._zero_deltas = dict.fromkeys(self._FIELDS, 0)
+        self._prefixless_zero_sat = False
+        self._prev = None
+        # Positions of samples' ends of coordinates,
+        # lap data is looked for there
+        self._lap_checks = []
+        # Positions of skipped frozen coordinates and
+        # their integer parts, full values are looked for there
+        self._skipped = []
+
+    def encode_first(self, sample, hr_bits=''):
+        """First sample has fixed length, its speed and distance are skipped"""
+        bits = ''.join(
+            (
+                '0' * 22,
+                hr_bits,
+                '0' * 45,
+                self._full_coord(sample.lon),
+                self._full_coord(sample.lat),
+                '0' * 30,
+            )
+        )
+        self._append(sample, bits, coord_value(sample.lon), coord_value(sample.lat))
+
+    def encode(self, sample, hr_bits='', is_last=False, force_full=False):
+        """Encodes a sample after the first one.
+
+        The last sample doesn't skip frozen coordinates since the parser
+        reads 28 bits after them. force_full encodes full distance.
+        """
+        prev = self._prev
+        parts = [hr_bits]
+
+        distance_delta = sample.distance - prev.distance
+        distance, distance_deltas = self._speed_or_distance(
+            'distance',
+            distance_delta,
+            (
+                get_bin(distance_delta, 7)
+                if 0 <= distance_delta <= 127 and distance_delta != 64
+                else None
+            ),
+            '10000000' + get_bin(sample.distance, 21),
+            force_full,
+        )
+        speed_delta = sample.speed - prev.speed
+        speed_args = (
+            'speed',
+            speed_delta,
+            twos_complement(speed_delta, 7) if -63 <= speed_delta <= 63 else None,
+            '1000000' + get_bin(sample.speed, 9),
+        )
+        speed, speed_deltas = self._speed_or_distance(*speed_args, False)
+        # Full distance would be read as full speed after skipped speed
+        if not speed and len(distance) == 29:
+            speed, speed_deltas = self._speed_or_distance(*speed_args, True)
+        self._zero_deltas['distance'] = distance_deltas
+        self._zero_deltas['speed'] = speed_deltas
+        parts += [speed, distance]
+
+        skipped = []
+        lon, lat = self._prev_coords
+        decoded = []
+        for field, value in (('lon', lon), ('lat', lat)):
+            units = getattr(sample, field)
+            bits, value = self._coord(
+                field, units, getattr(prev, field), value, is_last
+            )
+            if not bits:
+                skipped.append((field, sum(map(len, parts)), int(value)))
+
+            parts.append(bits)
+            decoded.append(value)
+
+        coords_end = sum(map(len, parts))
+        self._lap_checks.append((self.length + coords_end, lon, lat, sample.lap))
+
+        sat = self._satellites(sample.sat, prev.sat)
+        if sample.lap:
+            sat_after_lap = self.rnd.random() < 0.5
+            lap = self._lap_data(lon, lat, sat_after_lap)
+            parts += [lap, sat] if sat_after_lap else [sat, lap]
+        else:
+            parts.append(sat)
+
+        parts.append(UNDEFINED_BITS[0 if is_last else self.rnd.randrange(5)])
+        bits = ''.join(parts)
+
+        for field, position, int_part in skipped:
+            # The parser counts zero deltas of frozen coordinates by the
+            # 12 bits that follow them, undefined bits aren't zeroes
+            following = bits[position : position + 12]
+            assert len(following) == 12 or '1' in following
+            if following == '0' * 12:
+                self._zero_deltas[field] += 1
+            else:
+                self._zero_deltas[field] = 0
+
+            self._skipped.append((self.length + position, int_part))
+
+        self._append(sample, bits, *decoded)
+
+    def check(self, bits):
+        """Raises ValueError if the parser might take bits for something else.
+
+        Lap data is looked for by integer parts of coordinates and
+        frozen coordinates are unfrozen by a full value with the same
+        integer part, the rest of encoded values can't be mistaken.
+        """
+        for position, lon, lat, lap in self._lap_checks:
+            pattern = f'.{{250,290}}{get_bin(int(lon), 8)}.{{24}}{get_bin(int(lat), 8)}'
+            found = re.match(pattern, bits[position : position + 416]) is not None
+            if found != lap:
+                raise ValueError(f'Lap data is ambiguous at bit {position}')
+
+        for position, int_part in self._skipped:
+            full = int(bits[position : position + 8], 2) + coord_value(
+                int(bits[position + 8 : position + 28], 2)
+            )
+            if int(full) == int_part:
+                raise ValueError(f'Frozen coordinate is ambiguous at bit {position}')
+
+    @property
+    def _prev_coords(self):
+        _, lon, lat = self.expected[-1]
+        return lon, lat
+
+    def _append(self, sample, bits, lon, lat):
+        self.bits.append(bits)
+        self.length += len(bits)
+        self.expected.append((sample.hr, lon, lat))
+        self._prev = sample
+
+    def _speed_or_distance(self, field, delta, delta_bits, full_bits, force_full):
+        """Returns bits of speed or distance and their zero deltas"""
+        zero_deltas = self._zero_deltas[field]
+        frozen = zero_deltas >= 2
+
+        if not force_full:
+            if frozen and delta == 0:
+                return '', zero_deltas + 1
+            if not frozen and delta_bits is not None:
+                return delta_bits, zero_deltas + 1 if delta == 0 else 0
+
+        return full_bits, 0
+
+    def _full_coord(self, units):
+        int_part, frac = divmod(units, COORD_UNITS)
+        return get_bin(int_part, 8) + get_bin(frac, 20)
+
+    def _coord(self, field, units, prev_units, prev, is_last):
+        """Returns bits of a coordinate and its value as the parser decodes it.
+
+        Zero deltas of skipped frozen coordinates are counted by encode.
+        """
+        delta = units - prev_units
+        if self._zero_deltas[field] >= 2:
+            if delta == 0 and not is_last:
+                return '', prev
+
+            if units // COORD_UNITS != int(prev):
+                raise ValueError(f'Frozen {field} changes its integer part')
+
+            self._zero_deltas[field] = 0
+            return self._full_coord(units), coord_value(units)
+
+        if not -2048 <= delta < 2048:
+            raise ValueError(f'Delta of {field} is too large: {delta}')
+
+        self._zero_deltas[field] = self._zero_deltas[field] + 1 if delta == 0 else 0
+        return twos_complement(delta, 12), coord_delta_value(prev, delta)
+
+    def _satellites(self, sat, prev_sat):
+        """Returns bits of number of satellites (see parser's _parse_satellites)"""
+        delta = sat - prev_sat
+        prefixless_zero = self._prefixless_zero_sat
+        self._prefixless_zero_sat = False
+
+        if self._zero_deltas['sat'] >= 2:
+            if delta == 0:
+                return ''
+
+            # Prefixless full values don't unfreeze
+            if sat == 0 or self.rnd.random() < 0.3:
+                self._prefixless_zero_sat = sat == 0
+                return '000' + get_bin(sat, 4)
+
+            self._zero_deltas['sat'] = 0
+            return '001' + get_bin(sat, 4)
+
+        if delta != 0 and sat == 0:
+            self._prefixless_zero_sat = True
+            self._zero_deltas['sat'] = 0
+            return '0' * 7
+
+        bits = twos_complement(delta, 4)
+        if prefixless_zero and (bits[:3] == '001' or not -8 <= delta <= 7):
+            self._zero_deltas['sat'] = 0
+            return '001' + get_bin(sat, 4)
+
+        if not -8 <= delta <= 7:
+            raise ValueError(f'Delta of satellites is too large: {delta}')
+
+        self._zero_deltas['sat'] = self._zero_deltas['sat'] + 1 if delta == 0 else 0
+        return bits
+
+    def _lap_data(self, lon, lat, sat_after_lap):
+        """Returns 416 bits of lap data with integer parts of coordinates.
+
+        Satellites follow lap data that starts with 9 zeroes.
+        The parser looks for longitude 250 to 290 bits after coordinates,
+        its offset keeps it in range after satellites and out of range
+        for the previous sample.
+        """
+        start = '000000000111' if sat_after_lap else '11'
+        return ''.join(
+            (
+                start.ljust(_LAP_LON_OFFSET, '0'),
+                get_bin(int(lon), 8),
+                '0' * 24,
+                get_bin(int(lat), 8),
+                '0' * (416 - _LAP_LON_OFFSET - 40),
+            )
+        )
+
+
+def encode_gps(samples, has_hr=True, seed=0):
+    """Encodes gps samples, returns bits aligned to bytes and
+    [(hr, lon, lat)] of samples as the parser decodes them.
+
+    Raises ValueError if samples can't be encoded unambiguously.
+    """
+    hr_bits = encode_hr([s.hr for s in samples]) if has_hr else [''] * len(samples)
+    encoder = GpsEncoder(has_hr, seed)
+    encoder.encode_first(samples[0], hr_bits[0])
+
+    last = len(samples) - 1
+    for i in range(1, last):
+        encoder.encode(samples[i], hr_bits[i])
+
+    if last > 0:
+        before_last = copy.deepcopy(encoder)
+        encoder.encode(samples[last], hr_bits[last], is_last=True)
+
+        # The parser would take 6 or more bits of padding for a sample,
+        # full distance (and speed) moves the end to leave less of them
+        if -encoder.length % 8 > 5:
+            encoder = before_last
+            encoder.encode(samples[last], hr_bits[last], is_last=True, force_full=True)
+
+    bits = ''.join(encoder.bits)
+    bits += '0' * (-len(bits) % 8)
+    encoder.check(bits)
+
+    return bits, encoder.expected
+
+
+def gps_session(samples, has_hr=True, seed=0, **info):
+    """Returns raw session of gps samples and their values as the parser
+    decodes them (see encode_gps)
+    """
+    bits, expected = encode_gps(samples, has_hr, seed)
+    raw = raw_session([bits], padding=False, has_hr=has_hr, has_gps=True, **info)
+
+    return raw, expected
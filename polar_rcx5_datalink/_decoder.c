@@ -0,0 +1,388 @@
+/*
+ * Compiled version of the generic samples loop of parser.TrainingSession.
+ *
+ * decode_samples follows _parse_hr, _parse_speed, _parse_distance,
+ * _parse_coord, _parse_satellites and _has_lap_data step by step and
+ * fills preallocated columns of HR and coordinates. Distances, speeds
+ * and samples themselves are left to Python (see _iter_compiled_samples).
+ *
+ * Samples closer to the end of session than MARGIN bits are not decoded,
+ * so no field is ever cut short here and bits are read as integers.
+ * The Python loop goes on from the returned state. Same goes for
+ * anything unusual: bits other than 0 and 1 or coordinates that don't
+ * fit into 8 bits stop the loop before the sample they occur in.
+ */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+
+/* Longest sample: HR 11, speed 16, distance 29, coordinates 56,
+ * satellites 11 on both sides of 416 bits of lap data, 10 undefined */
+#define MARGIN 600
+#define LAP_DATA_BITS 416
+#define NANOS 1000000000LL
+
+/* Order of parser.SampleFields */
+enum { HR, LON, LAT, DISTANCE, SPEED, SATELLITES, FIELDS };
+
+typedef struct {
+    const char *bits;
+    Py_ssize_t cursor;
+    long long zero_deltas[FIELDS];
+    int prefixless_zero_sat;
+    /* Indexed by LON and LAT */
+    long long nanos[FIELDS];
+    double coords[FIELDS];
+    long long hr;
+    int invalid;
+} Decoder;
+
+static long long
+read_bits(Decoder *d, Py_ssize_t start, int length)
+{
+    long long value = 0;
+    for (int i = 0; i < length; i++) {
+        char bit = d->bits[start + i];
+        if (bit != '0' && bit != '1') {
+            d->invalid = 1;
+        }
+        value = (value << 1) | (bit == '1');
+    }
+
+    return value;
+}
+
+static int
+is_frozen(Decoder *d, int field)
+{
+    return d->zero_deltas[field] >= 2;
+}
+
+static void
+handle_delta(Decoder *d, int field, long long delta)
+{
+    d->zero_deltas[field] = delta == 0 ? d->zero_deltas[field] + 1 : 0;
+}
+
+/* parser.coord_nanos, // rounds towards negative infinity */
+static long long
+coord_nanos(long long units)
+{
+    long long value = units * 10000 + 3;
+    long long quotient = value / 6;
+
+    return (value % 6 < 0) ? quotient - 1 : quotient;
+}
+
+static void
+parse_hr(Decoder *d)
+{
+    long long index = read_bits(d, d->cursor, 11);
+    long long prefix = index >> 9;
+
+    if (is_frozen(d, HR) && prefix != 0x1) {
+        handle_delta(d, HR, 0);
+        d->cursor += 1;
+        return;
+    }
+
+    if (prefix == 0x1 || prefix == 0x0) {
+        d->hr = prefix == 0x1 ? index & 0xFF : index;
+        d->zero_deltas[HR] = 0;
+        d->cursor += 11;
+        return;
+    }
+
+    long long delta = (index >> 5) & 0xF;
+    if (prefix == 0x3) {
+        delta -= 16;
+    }
+    handle_delta(d, HR, delta);
+    d->hr += delta;
+    d->cursor += 6;
+}
+
+static void
+parse_speed(Decoder *d)
+{
+    Py_ssize_t offset = 7;
+    long long speed = read_bits(d, d->cursor, 7);
+
+    if (is_frozen(d, SPEED)) {
+        offset = 0;
+        speed = 0;
+    }
+
+    if (read_bits(d, d->cursor, 7) == 0x40) {
+        offset = 16;
+        d->zero_deltas[SPEED] = 0;
+    }
+    else {
+        handle_delta(d, SPEED, speed);
+    }
+
+    d->cursor += offset;
+}
+
+static void
+parse_distance(Decoder *d)
+{
+    Py_ssize_t offset = 7;
+    long long dist = read_bits(d, d->cursor, 7);
+
+    if (is_frozen(d, DISTANCE)) {
+        offset = 0;
+        dist = 0;
+    }
+
+    if (read_bits(d, d->cursor, 8) == 0x80) {
+        offset = 29;
+        d->zero_deltas[DISTANCE] = 0;
+    }
+    else {
+        handle_delta(d, DISTANCE, dist);
+    }
+
+    d->cursor += offset;
+}
+
+static void
+parse_coord(Decoder *d, int field)
+{
+    long long raw = read_bits(d, d->cursor, 12);
+    long long delta = coord_nanos(raw >= 2048 ? raw - 4096 : raw);
+
+    if (is_frozen(d, field)) {
+        long long int_part = read_bits(d, d->cursor, 8);
+        long long frac = coord_nanos(read_bits(d, d->cursor + 8, 20));
+        double full_value = (double)int_part + (double)frac / (double)NANOS;
+
+        if ((long long)full_value
+            == (long long)((double)d->nanos[field] / (double)NANOS)) {
+            d->nanos[field] = int_part * NANOS + frac;
+            d->coords[field] = full_value;
+            d->zero_deltas[field] = 0;
+            d->cursor += 28;
+            return;
+        }
+
+        handle_delta(d, field, delta);
+        d->coords[field] = (double)d->nanos[field] / (double)NANOS;
+        return;
+    }
+
+    handle_delta(d, field, delta);
+    d->nanos[field] += delta;
+    d->coords[field] = (double)d->nanos[field] / (double)NANOS;
+    d->cursor += 12;
+}
+
+static void
+parse_satellites(Decoder *d)
+{
+    Py_ssize_t offset = 4;
+    long long sat = read_bits(d, d->cursor, 4);
+    long long prefixless_value = read_bits(d, d->cursor, 7);
+    /* 001 prefix */
+    int has_prefix = (sat >> 1) == 0x1;
+
+    if (d->prefixless_zero_sat && has_prefix) {
+        offset = 7;
+    }
+
+    if (is_frozen(d, SATELLITES)) {
+        offset = prefixless_value > 31 ? 0 : 7;
+        if (has_prefix) {
+            d->zero_deltas[SATELLITES] = 0;
+        }
+    }
+
+    d->prefixless_zero_sat = prefixless_value == 0;
+    if (d->prefixless_zero_sat) {
+        offset = 7;
+    }
+
+    if (offset == 4) {
+        handle_delta(d, SATELLITES, sat);
+    }
+    else if (!is_frozen(d, SATELLITES)) {
+        d->zero_deltas[SATELLITES] = 0;
+    }
+
+    d->cursor += offset;
+}
+
+/* Integer degrees of the previous sample somewhere in the lap data */
+static int
+has_lap_data(Decoder *d, long long lon, long long lat)
+{
+    for (int start = 250; start <= 290; start++) {
+        if (read_bits(d, d->cursor + start, 8) == lon
+            && read_bits(d, d->cursor + start + 32, 8) == lat) {
+            return 1;
+        }
+    }
+
+    return 0;
+}
+
+static void
+parse_sample(Decoder *d, int has_hr, int has_gps)
+{
+    /* Lap data is looked up by coordinates of the previous sample */
+    long long lon = (long long)d->coords[LON];
+    long long lat = (long long)d->coords[LAT];
+
+    if (has_hr) {
+        parse_hr(d);
+    }
+
+    if (!has_gps) {
+        return;
+    }
+
+    parse_speed(d);
+    parse_distance(d);
+    parse_coord(d, LON);
+    parse_coord(d, LAT);
+
+    if (has_lap_data(d, lon, lat)) {
+        int sat_after_lap = read_bits(d, d->cursor, 9) == 0;
+        if (!sat_after_lap) {
+            parse_satellites(d);
+        }
+
+        d->cursor += LAP_DATA_BITS;
+
+        if (sat_after_lap) {
+            parse_satellites(d);
+        }
+    }
+    else {
+        parse_satellites(d);
+    }
+
+    /* Undefined 10 bits */
+    d->cursor += 10;
+}
+
+static int
+get_column(PyObject *column, Py_buffer *buffer, const char *format)
+{
+    if (PyObject_GetBuffer(column, buffer, PyBUF_WRITABLE | PyBUF_FORMAT) < 0) {
+        return -1;
+    }
+
+    if (buffer->itemsize != 8 || strcmp(buffer->format, format) != 0) {
+        PyBuffer_Release(buffer);
+        PyErr_Format(PyExc_TypeError, "expected array('%s')", format);
+        return -1;
+    }
+
+    return 0;
+}
+
+PyDoc_STRVAR(decode_samples_doc,
+"decode_samples(bits, cursor, has_hr, has_gps, state, hr, lon, lat)\n"
+"\n"
+"Decodes samples of bits starting at cursor into columns hr (array('q')),\n"
+"lon and lat (array('d')) until they are full or samples left are close\n"
+"to the end. state is (zero deltas of parser.SampleFields...,\n"
+"prefixless_zero_sat, lon nanodegrees, lat nanodegrees, hr, lon, lat)\n"
+"of the previous sample. Returns (count, cursor, state).");
+
+static PyObject *
+decode_samples(PyObject *Py_UNUSED(module), PyObject *args)
+{
+    Decoder d = {0};
+    Py_ssize_t length;
+    int has_hr, has_gps;
+    PyObject *hr_column, *lon_column, *lat_column;
+    Py_buffer hr, lon, lat;
+    PyObject *result = NULL;
+
+    if (!PyArg_ParseTuple(
+            args, "s#npp(LLLLLLpLLLdd)OOO", &d.bits, &length, &d.cursor,
+            &has_hr, &has_gps, &d.zero_deltas[HR], &d.zero_deltas[LON],
+            &d.zero_deltas[LAT], &d.zero_deltas[DISTANCE], &d.zero_deltas[SPEED],
+            &d.zero_deltas[SATELLITES], &d.prefixless_zero_sat, &d.nanos[LON],
+            &d.nanos[LAT], &d.hr, &d.coords[LON], &d.coords[LAT], &hr_column,
+            &lon_column, &lat_column)) {
+        return NULL;
+    }
+
+    if (get_column(hr_column, &hr, "q") < 0) {
+        return NULL;
+    }
+    if (get_column(lon_column, &lon, "d") < 0) {
+        PyBuffer_Release(&hr);
+        return NULL;
+    }
+    if (get_column(lat_column, &lat, "d") < 0) {
+        PyBuffer_Release(&hr);
+        PyBuffer_Release(&lon);
+        return NULL;
+    }
+
+    Py_ssize_t size = hr.len / 8;
+    if (lon.len / 8 < size || lat.len / 8 < size) {
+        PyErr_SetString(PyExc_ValueError, "columns have different lengths");
+        goto done;
+    }
+
+    Py_ssize_t count = 0;
+    while (count < size && length - d.cursor >= MARGIN) {
+        long long lon_int = (long long)d.coords[LON];
+        long long lat_int = (long long)d.coords[LAT];
+        if (has_gps && (lon_int < 0 || lon_int > 255 || lat_int < 0 || lat_int > 255)) {
+            break;
+        }
+
+        Decoder prev = d;
+        parse_sample(&d, has_hr, has_gps);
+        if (d.invalid) {
+            d = prev;
+            break;
+        }
+
+        ((long long *)hr.buf)[count] = d.hr;
+        ((double *)lon.buf)[count] = d.coords[LON];
+        ((double *)lat.buf)[count] = d.coords[LAT];
+        count++;
+    }
+
+    result = Py_BuildValue(
+        "nn(LLLLLLOLLLdd)", count, d.cursor, d.zero_deltas[HR], d.zero_deltas[LON],
+        d.zero_deltas[LAT], d.zero_deltas[DISTANCE], d.zero_deltas[SPEED],
+        d.zero_deltas[SATELLITES], d.prefixless_zero_sat ? Py_True : Py_False,
+        d.nanos[LON], d.nanos[LAT], d.hr, d.coords[LON], d.coords[LAT]);
+
+done:
+    PyBuffer_Release(&hr);
+    PyBuffer_Release(&lon);
+    PyBuffer_Release(&lat);
+    return result;
+}
+
+static PyMethodDef decoder_methods[] = {
+    {"decode_samples", decode_samples, METH_VARARGS, decode_samples_doc},
+    {NULL, NULL, 0, NULL},
+};
+
+static struct PyModuleDef decoder_module = {
+    PyModuleDef_HEAD_INIT,
+    "_decoder",
+    "Compiled samples loop of parser.TrainingSession",
+    -1,
+    decoder_methods,
+    NULL,
+    NULL,
+    NULL,
+    NULL,
+};
+
+PyMODINIT_FUNC
+PyInit__decoder(void)
+{
+    return PyModule_Create(&decoder_module);
+}
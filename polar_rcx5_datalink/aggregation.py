@@ -0,0 +1,196 @@
+"""Totals of training sessions per week or month.
+
+Metrics of every session (distance, duration, HR load) are derived once
+and stored by metrics_key of the session, which only needs its first
+packet. Reports parse only sessions that have no stored metrics yet,
+everything else is summed up from the store.
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import threading
+
+PERIODS = ('week', 'month')
+# Fields of analytics.session_stats kept for reports
+_HR_FIELDS = ('hr_avg', 'trimp', 'load')
+
+
+def metrics_key(first_packet, packets_count):
+    """Identifies a session by its first packet (start time, duration,
+    summary) and number of packets without reading the rest of it."""
+    return f'{hashlib.sha1(bytes(first_packet)).hexdigest()}-{packets_count}'
+
+
+def session_metrics(stats):
+    """Returns metrics of a session out of its analytics.session_stats"""
+    hr = stats['hr'] or {}
+    metrics = {
+        'id': stats['id'],
+        'start_time': stats['start_time'],
+        'duration': stats['duration'],
+        'distance': stats['distance'] or 0.0,
+    }
+    metrics.update((field, hr.get(field)) for field in _HR_FIELDS)
+
+    return metrics
+
+
+def period_of(start_time, by):
+    """Returns ISO week (2019-W05) or month (2019-02) of an ISO datetime"""
+    start_time = datetime.datetime.fromisoformat(start_time)
+    if by == 'month':
+        return start_time.strftime('%Y-%m')
+
+    year, week, _ = start_time.isocalendar()
+    return f'{year}-W{week:02d}'
+
+
+def aggregate(metrics, by='week'):
+    """Returns totals of session metrics per period, oldest first.
+
+    HR average of a period is weighted by durations of its sessions.
+    """
+    if by not in PERIODS:
+        raise ValueError(f'Unknown period {by!r}, expected one of {PERIODS}')
+
+    periods = {}
+    for entry in metrics:
+        period = period_of(entry['start_time'], by)
+        total = periods.setdefault(
+            period,
+            {
+                'period': period,
+                'sessions': 0,
+                'duration': 0.0,
+                'distance': 0.0,
+                'trimp': 0.0,
+                'load': 0.0,
+                'hr_avg': None,
+                '_hr_duration': 0.0,
+            },
+        )
+
+        total['sessions'] += 1
+        for field in ('duration', 'distance', 'trimp', 'load'):
+            total[field] += entry[field] or 0.0
+
+        if entry['hr_avg'] is not None:
+            hr_duration = total['_hr_duration'] + entry['duration']
+            if hr_duration:
+                total['hr_avg'] = (
+                    (total['hr_avg'] or 0.0) * total['_hr_duration']
+                    + entry['hr_avg'] * entry['duration']
+                ) / hr_duration
+            total['_hr_duration'] = hr_duration
+
+    result = []
+    for period in sorted(periods):
+        total = periods[period]
+        del total['_hr_duration']
+        result.append(total)
+
+    return result
+
+
+class MetricsStore(object):
+    """Persistent metrics of training sessions keyed by metrics_key.
+
+    store = MetricsStore(path)
+    new = [ts for ts in training_sessions if store.key(ts) not in store]
+    store.update(new)  # computes metrics of new sessions
+    aggregate(store.metrics(keys), by='month')
+    """
+
+    _VERSION = 2
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = self._load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    @staticmethod
+    def key(training_session):
+        raw = training_session.raw
+        return metrics_key(raw[0], len(raw))
+
+    def update(self, training_sessions, workers=None):
+        """Computes and stores metrics of sessions that have none.
+
+        Sessions that can't be parsed are stored with an error so that
+        they aren't parsed again. Returns the number of new entries.
+        """
+        from .analytics import batch_stats
+
+        new = {}
+        for training_session in training_sessions:
+            key = self.key(training_session)
+            if key not in self._entries:
+                new.setdefault(key, training_session)
+
+        if not new:
+            return 0
+
+        entries = {}
+        for key, stats in zip(new, batch_stats(list(new.values()), workers)):
+            if 'error' in stats:
+                entries[key] = stats
+            else:
+                entries[key] = session_metrics(stats)
+
+        with self._lock:
+            self._entries.update(entries)
+            self._save()
+
+        return len(entries)
+
+    def metrics(self, keys=None, from_date=None, to_date=None):
+        """Returns stored metrics of sessions (all if keys is None)
+        that started within dates, without errors"""
+        if keys is None:
+            entries = self._entries.values()
+        else:
+            entries = (self._entries[key] for key in set(keys) if key in self._entries)
+
+        result = []
+        for entry in entries:
+            if 'error' in entry:
+                continue
+
+            start_time = datetime.datetime.fromisoformat(entry['start_time'])
+            if from_date is not None and start_time < from_date:
+                continue
+            if to_date is not None and start_time > to_date:
+                continue
+
+            result.append(entry)
+
+        return result
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+
+        # Metrics of earlier versions are keyed differently
+        if data.get('version') != self._VERSION:
+            return {}
+
+        return data['entries']
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': self._VERSION, 'entries': self._entries}, f)
+
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,360 @@
+"""Statistics of training sessions: HR zones, splits, training load.
+
+Samples are turned into columns (numpy arrays) and every statistic is
+computed over whole columns at once. Integrals of HR and distance over
+time are interpolated at boundaries of splits and rolling windows, so
+sessions with dropped samples (see simplify.simplified_session) are
+handled as well.
+
+Needs numpy: pip install polar_rcx5_datalink[analytics]
+"""
+
+import concurrent.futures
+import itertools
+
+import numpy
+
+from . import packed
+from .exceptions import ParserError
+from .parser import TrainingSession
+from .utils import get_logger
+
+# Lower bounds of HR zones, % of maximal HR
+HR_ZONES = (50, 60, 70, 80, 90)
+# Meters
+SPLIT_LENGTHS = {'km': 1000.0, 'mile': 1609.344}
+# Seconds, best averages over these windows are reported
+ROLLING_WINDOWS = (60, 300, 1200)
+# Weighting factor of Banister's TRIMP (1.67 for women)
+TRIMP_FACTOR = 1.92
+# Threshold HR for the load if it's not given, fraction of HR reserve
+THRESHOLD_HR_RESERVE = 0.85
+
+
+def session_columns(training_session):
+    """Returns (time, hr, distance) arrays of samples.
+
+    time is seconds from the start to the end of each sample, hr and
+    distance are None if a session doesn't have them. Heart rates of
+    zero (no contact with the strap) are NaN.
+    """
+    training_session.parse_samples()
+    samples = training_session.samples
+    count = len(samples)
+
+    indexes = training_session.sample_indexes
+    if indexes is None:
+        indexes = numpy.arange(count)
+    sample_rate = training_session.info['sample_rate']
+    time = (numpy.asarray(indexes, dtype=float) + 1) * sample_rate
+
+    hr = None
+    if training_session.hr_samples is not None:
+        hr = numpy.array(training_session.hr_samples, dtype=float)
+    elif training_session.has_hr:
+        hr = numpy.fromiter((s.hr for s in samples), dtype=float, count=count)
+    if hr is not None:
+        hr[hr == 0] = numpy.nan
+
+    distance = None
+    if training_session.has_gps:
+        distance = numpy.fromiter(
+            (s.distance for s in samples), dtype=float, count=count
+        )
+
+    return time, hr, distance
+
+
+def cumulative(time, values):
+    """Returns (points, integral, weight) of values (e.g. HR) over time.
+
+    integral of values and weight (time with known values) are given
+    at points, the boundaries of samples. Interpolate them with
+    numpy.interp to get averages over any interval.
+    """
+    durations = numpy.diff(time, prepend=0.0)
+    known = ~numpy.isnan(values)
+
+    points = numpy.concatenate(([0.0], time))
+    integral = numpy.concatenate(
+        ([0.0], numpy.cumsum(numpy.where(known, values * durations, 0.0)))
+    )
+    weight = numpy.concatenate(
+        ([0.0], numpy.cumsum(numpy.where(known, durations, 0.0)))
+    )
+
+    return points, integral, weight
+
+
+def covered_distance(time, distance):
+    """Returns (points, covered) distance at the boundaries of samples"""
+    return (
+        numpy.concatenate(([0.0], time)),
+        numpy.concatenate(([0.0], numpy.cumsum(distance))),
+    )
+
+
+def hr_stats(time, hr, hr_max, hr_rest, zones=HR_ZONES, threshold_hr=None):
+    """Returns average and maximal HR, time in zones, TRIMP and load.
+
+    Zones start with time below the first one. Load is TRIMP relative
+    to an hour at threshold HR, so an hour at threshold is 100.
+    Returns None if there are no heart rates.
+    """
+    known = ~numpy.isnan(hr)
+    if not known.any():
+        return None
+
+    durations = numpy.diff(time, prepend=0.0)[known]
+    hr = hr[known]
+
+    bounds = numpy.asarray(zones, dtype=float) / 100 * hr_max
+    in_zones = numpy.bincount(
+        numpy.searchsorted(bounds, hr, side='right'),
+        weights=durations,
+        minlength=len(bounds) + 1,
+    )
+
+    result = {
+        'hr_avg': float(numpy.average(hr, weights=durations)),
+        'hr_max': float(hr.max()),
+        'zones': [
+            {'zone': zone, 'from_hr': round(lower), 'seconds': seconds}
+            for zone, (lower, seconds) in enumerate(
+                zip([0.0, *bounds.tolist()], in_zones.tolist())
+            )
+        ],
+        'trimp': None,
+        'load': None,
+    }
+
+    reserve = hr_max - hr_rest
+    if reserve <= 0:
+        return result
+
+    def trimp_per_minute(hr_reserve):
+        return hr_reserve * 0.64 * numpy.exp(TRIMP_FACTOR * hr_reserve)
+
+    hr_reserve = numpy.clip((hr - hr_rest) / reserve, 0.0, 1.0)
+    trimp = float((durations / 60 * trimp_per_minute(hr_reserve)).sum())
+
+    threshold_reserve = THRESHOLD_HR_RESERVE
+    if threshold_hr is not None:
+        threshold_reserve = (threshold_hr - hr_rest) / reserve
+
+    result['trimp'] = trimp
+    result['load'] = float(trimp / (60 * trimp_per_minute(threshold_reserve)) * 100)
+
+    return result
+
+
+def splits(time, distance, hr=None, split_length=SPLIT_LENGTHS['km']):
+    """Returns splits of split_length meters, the last one might be shorter.
+
+    Each split has its distance, duration, pace (seconds per split_length)
+    and average HR.
+    """
+    points, covered = covered_distance(time, distance)
+    total = covered[-1]
+    if total <= 0:
+        return []
+
+    marks = numpy.arange(split_length, total, split_length)
+    boundaries = numpy.concatenate(
+        ([0.0], numpy.interp(marks, covered, points), [points[-1]])
+    )
+    lengths = numpy.diff(numpy.concatenate(([0.0], marks, [total])))
+    durations = numpy.diff(boundaries)
+
+    hr_avgs = [None] * len(durations)
+    if hr is not None:
+        hr_avgs = _averages(cumulative(time, hr), boundaries[:-1], boundaries[1:])
+
+    return [
+        {
+            'distance': length,
+            'seconds': seconds,
+            'pace': seconds / length * split_length,
+            'hr_avg': hr_avg,
+        }
+        for length, seconds, hr_avg in zip(
+            lengths.tolist(), durations.tolist(), hr_avgs
+        )
+    ]
+
+
+def rolling_averages(time, hr=None, distance=None, windows=ROLLING_WINDOWS):
+    """Returns the best averages of HR and speed over windows (seconds).
+
+    Windows longer than a session are left out. HR averages need
+    known heart rates for at least half of a window.
+    """
+    hr_cumulative = None if hr is None else cumulative(time, hr)
+    covered = None if distance is None else covered_distance(time, distance)
+
+    result = []
+    for window in windows:
+        ends = time[time >= window]
+        if not len(ends):
+            continue
+
+        starts = ends - window
+        best = {'window': window, 'hr_avg': None, 'speed_avg': None}
+        if hr_cumulative is not None:
+            averages = _averages(hr_cumulative, starts, ends, min_weight=window / 2)
+            averages = [val for val in averages if val is not None]
+            best['hr_avg'] = max(averages) if averages else None
+
+        if covered is not None:
+            points, distances = covered
+            speeds = (
+                numpy.interp(ends, points, distances)
+                - numpy.interp(starts, points, distances)
+            ) / window
+            best['speed_avg'] = float(speeds.max())
+
+        result.append(best)
+
+    return result
+
+
+def _averages(cumulative_values, starts, ends, min_weight=0.0):
+    """Returns averages over intervals, None where too few values are known"""
+    points, integral, weight = cumulative_values
+    totals = numpy.interp(ends, points, integral) - numpy.interp(
+        starts, points, integral
+    )
+    weights = numpy.interp(ends, points, weight) - numpy.interp(starts, points, weight)
+
+    known = weights > max(min_weight, 0.0)
+    averages = numpy.divide(totals, weights, out=numpy.zeros_like(totals), where=known)
+
+    return [
+        avg if is_known else None
+        for avg, is_known in zip(averages.tolist(), known.tolist())
+    ]
+
+
+def session_stats(
+    training_session,
+    split='km',
+    zones=HR_ZONES,
+    windows=ROLLING_WINDOWS,
+    threshold_hr=None,
+):
+    """Returns statistics of a training session as a JSON serializable dict.
+
+    split is a key of SPLIT_LENGTHS, paces are seconds per split.
+    """
+    time, hr, distance = session_columns(training_session)
+    split_length = SPLIT_LENGTHS[split]
+    info = training_session.info
+    elapsed = float(time[-1]) if len(time) else 0.0
+
+    result = {
+        'id': training_session.id,
+        'start_time': training_session.start_time.isoformat(),
+        'duration': elapsed,
+        'distance': None,
+        'hr': None,
+        'pace': None,
+        'splits': [],
+        'rolling': rolling_averages(time, hr, distance, windows),
+    }
+
+    if hr is not None:
+        result['hr'] = hr_stats(
+            time, hr, info['user_hr_max'], info['user_hr_rest'], zones, threshold_hr
+        )
+
+    if distance is not None and elapsed:
+        total = float(distance.sum())
+        moving = float(numpy.diff(time, prepend=0.0)[distance > 0].sum())
+        speed = total / elapsed
+        result['distance'] = total
+        result['pace'] = {
+            'speed_avg': speed,
+            'speed_max': training_session.max_speed,
+            'pace_avg': split_length / speed if speed else None,
+            'moving_seconds': moving,
+        }
+        result['splits'] = splits(time, distance, hr, split_length)
+
+    return result
+
+
+def _stats_or_error(training_session, options):
+    try:
+        return session_stats(training_session, **options)
+    except ParserError:
+        err_msg = f"Can't parse samples of session #{training_session.id}"
+        get_logger().exception(err_msg)
+        return {'id': training_session.id, 'error': err_msg}
+
+
+def _init_worker(distance_cache):
+    distance_cache.start_learning()
+    TrainingSession.distance_cache = distance_cache
+
+
+def _portable(raw_session):
+    """Returns a raw session in a form that can be sent to workers:
+    (path, offset) of a session of a packed file, bytes of packets otherwise.
+    """
+    if isinstance(raw_session, packed.PackedSession):
+        return raw_session.path, raw_session.offset
+
+    # Packets might be memoryviews, those can't be pickled
+    return [bytes(packet) for packet in raw_session]
+
+
+def _raw_session_stats(raw_session, timezone, options):
+    if isinstance(raw_session, tuple):
+        raw_session = packed.read_session(*raw_session)
+
+    training_session = TrainingSession(raw_session)
+    if timezone is not None:
+        training_session.set_timezone(timezone)
+
+    stats = _stats_or_error(training_session, options)
+    distance_cache = TrainingSession.distance_cache
+    if distance_cache is None:
+        return stats, None
+
+    return stats, distance_cache.pop_learned()
+
+
+def batch_stats(training_sessions, workers=None, **options):
+    """Returns statistics of training sessions in their order.
+
+    Sessions are parsed by a pool of workers processes (as many as CPUs
+    if workers is None), workers=1 computes them in this process.
+    options are passed to session_stats. Sessions that can't be parsed
+    get {'id': session ID, 'error': message}. Workers use a copy of
+    TrainingSession.distance_cache, distances they compute are added to it.
+    Workers map sessions of packed files themselves.
+    """
+    if workers == 1 or len(training_sessions) < 2:
+        return [_stats_or_error(ts, options) for ts in training_sessions]
+
+    # Sessions of packed files are mapped by workers, not copied to them
+    raw_sessions = [_portable(ts.raw) for ts in training_sessions]
+    timezones = [ts.timezone for ts in training_sessions]
+    distance_cache = TrainingSession.distance_cache
+    initializer = None if distance_cache is None else _init_worker
+    with concurrent.futures.ProcessPoolExecutor(
+        workers, initializer=initializer, initargs=(distance_cache,)
+    ) as executor:
+        results = list(
+            executor.map(
+                _raw_session_stats, raw_sessions, timezones, itertools.repeat(options)
+            )
+        )
+
+    stats = []
+    for session_stats, learned in results:
+        if learned is not None:
+            distance_cache.merge(learned)
+        stats.append(session_stats)
+
+    return stats
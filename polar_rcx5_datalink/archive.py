@@ -0,0 +1,234 @@
+"""Local archive of raw training sessions.
+
+Every unique session is stored once as a JSON file named after its
+content hash (see utils.raw_content_hash), index.json describes them:
+
+    archive/
+        index.json
+        sessions/<hash>.json
+
+The sessions directory can be passed to --sessions-dir like any
+directory of raw sessions.
+
+Files are imported by a pool of worker processes: each worker reads
+a file, computes fingerprints and hashes of its sessions and copies
+sessions that aren't in the archive yet. Sessions with the same header
+fingerprint (start time, duration and recording settings) but different
+content are different copies of one recording, e.g. an interrupted
+download, and are kept as separate entries.
+"""
+
+import concurrent.futures
+import json
+import os
+import shutil
+import threading
+import time
+from collections import namedtuple
+
+from . import packed
+from .utils import raw_content_hash
+
+INDEX_FILENAME = 'index.json'
+SESSIONS_DIRNAME = 'sessions'
+# Bytes of the first packet: start time and duration (35-44),
+# has_hr, has_gps and sample rate (165-167)
+_FINGERPRINT_SLICES = (slice(35, 45), slice(165, 168))
+
+ImportStats = namedtuple(
+    'ImportStats', ['files', 'sessions', 'imported', 'duplicates', 'errors', 'seconds']
+)
+
+
+def header_fingerprint(raw_session):
+    """Identifies a recording by the header of its first packet"""
+    first_packet = raw_session[0]
+    return ''.join(bytes(first_packet[s]).hex() for s in _FINGERPRINT_SLICES)
+
+
+def _session_entry(raw_session, source):
+    from .parser import TrainingSession
+
+    return {
+        'fingerprint': header_fingerprint(raw_session),
+        'start_time': TrainingSession(raw_session).name,
+        'packets': len(raw_session),
+        'source': source,
+    }
+
+
+def _write_json(path, data):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+
+    os.replace(tmp_path, path)
+
+
+def _import_file(filepath, sessions_path, known):
+    """Returns [(hash, entry)] of sessions of a file, copies unknown ones.
+
+    Runs in worker processes, known is a set of hashes in the archive.
+    """
+    result = []
+    if packed.is_packed(filepath):
+        for num, raw_session in enumerate(packed.read_sessions(filepath)):
+            session_hash = raw_content_hash(raw_session)
+            if session_hash not in known:
+                raw_session = [list(packet) for packet in raw_session]
+                _write_json(
+                    os.path.join(sessions_path, f'{session_hash}.json'), raw_session
+                )
+
+            result.append(
+                (session_hash, _session_entry(raw_session, f'{filepath}#{num}'))
+            )
+
+        return result
+
+    with open(filepath) as f:
+        raw_session = json.load(f)
+
+    session_hash = raw_content_hash(raw_session)
+    if session_hash not in known:
+        target = os.path.join(sessions_path, f'{session_hash}.json')
+        tmp_path = f'{target}.{os.getpid()}.tmp'
+        shutil.copyfile(filepath, tmp_path)
+        os.replace(tmp_path, target)
+
+    return [(session_hash, _session_entry(raw_session, filepath))]
+
+
+# (sessions_path, known hashes) of a worker process, sent once per worker
+_worker_args = None
+
+
+def _init_worker(sessions_path, known):
+    global _worker_args
+    _worker_args = sessions_path, known
+
+
+def _import_file_or_error(filepath, sessions_path=None, known=None):
+    if sessions_path is None:
+        sessions_path, known = _worker_args
+    try:
+        return _import_file(filepath, sessions_path, known), None
+    except (OSError, ValueError, LookupError, TypeError) as e:
+        return [], f'{filepath}: {e}'
+
+
+def session_files(dirs):
+    """Yields paths of files of raw sessions in directories, recursively"""
+    for path in dirs:
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.endswith('.json') or packed.is_packed(filename):
+                    yield os.path.join(dirpath, filename)
+
+
+class SessionArchive(object):
+    """Deduplicated raw sessions with an index.
+
+    archive = SessionArchive(path)
+    stats = archive.import_dirs(['/laptop1/sessions', '/laptop2/sessions'])
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.sessions_path = os.path.join(path, SESSIONS_DIRNAME)
+        self._index_path = os.path.join(path, INDEX_FILENAME)
+        self._lock = threading.Lock()
+        self._entries = self._load()
+
+    def __contains__(self, session_hash):
+        return session_hash in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def entries(self):
+        """Returns {hash: entry} of archived sessions"""
+        return dict(self._entries)
+
+    def variants(self):
+        """Returns {fingerprint: [hash, ...]} of recordings archived
+        in more than one version."""
+        result = {}
+        for session_hash, entry in self._entries.items():
+            result.setdefault(entry['fingerprint'], []).append(session_hash)
+
+        return {fp: sorted(hashes) for fp, hashes in result.items() if len(hashes) > 1}
+
+    def raw_session(self, session_hash):
+        with open(os.path.join(self.sessions_path, f'{session_hash}.json')) as f:
+            return json.load(f)
+
+    def import_dirs(self, dirs, workers=None, on_error=None):
+        """Imports raw sessions of directories, returns ImportStats.
+
+        Files are read by as many processes as CPUs if workers is None,
+        workers=1 imports them in this process. on_error is called with
+        a message for every file that can't be read.
+        """
+        start = time.perf_counter()
+        os.makedirs(self.sessions_path, exist_ok=True)
+        files = list(session_files(dirs))
+        known = frozenset(self._entries)
+
+        if workers == 1 or len(files) < 2:
+            results = (
+                _import_file_or_error(fp, self.sessions_path, known) for fp in files
+            )
+            stats = self._add(results, len(files), on_error)
+        else:
+            with concurrent.futures.ProcessPoolExecutor(
+                workers, initializer=_init_worker, initargs=(self.sessions_path, known)
+            ) as executor:
+                # Chunks keep inter-process overhead low for small files
+                chunksize = max(1, len(files) // (8 * (workers or os.cpu_count() or 1)))
+                results = executor.map(
+                    _import_file_or_error, files, chunksize=chunksize
+                )
+                stats = self._add(results, len(files), on_error)
+
+        return stats._replace(seconds=time.perf_counter() - start)
+
+    def _add(self, results, files, on_error):
+        sessions = imported = duplicates = errors = 0
+        with self._lock:
+            for file_sessions, error in results:
+                if error is not None:
+                    errors += 1
+                    if on_error is not None:
+                        on_error(error)
+                    continue
+
+                for session_hash, entry in file_sessions:
+                    sessions += 1
+                    if session_hash in self._entries:
+                        duplicates += 1
+                        continue
+
+                    self._entries[session_hash] = entry
+                    imported += 1
+
+            if imported:
+                self._save()
+
+        return ImportStats(files, sessions, imported, duplicates, errors, 0.0)
+
+    def _load(self):
+        try:
+            with open(self._index_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _save(self):
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = self._index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._entries, f, indent=2, sort_keys=True)
+
+        os.replace(tmp_path, self._index_path)
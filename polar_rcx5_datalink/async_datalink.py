@@ -0,0 +1,97 @@
+import asyncio
+import concurrent.futures
+import functools
+
+from .datalink import _OUTPUT, _READ, _SETUP, _SLEEP, _WRITE, BaseDataLink
+
+
+class AsyncDataLink(BaseDataLink):
+    """asyncio version of DataLink.
+
+    Runs the protocol steps of BaseDataLink. pyusb doesn't expose libusb
+    asynchronous transfers, so device calls run in a dedicated thread and
+    the event loop stays free for other work (e.g. parsing sessions that
+    have already been downloaded). Waiting is done by awaiting, not sleeping.
+
+        async with AsyncDataLink() as dl:
+            await dl.synchronize()
+            async for session in dl.iter_sessions():
+                ...
+    """
+
+    def __init__(self, device=None, checkpoints=None):
+        super().__init__(device, checkpoints)
+        # Device calls must not overlap so they go through a single thread
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        try:
+            if self.hw_id is not None:
+                await self._run(self._disconnect())
+        finally:
+            self._executor.shutdown(wait=False)
+
+    async def synchronize(self):
+        await self._run(self._synchronize())
+
+    async def iter_sessions(self, include=None):
+        """Yields raw training sessions as soon as they are downloaded.
+
+        include(SessionHeader) picks sessions to download, the rest
+        cost only their first packet.
+        """
+        steps = self._iter_sessions(include)
+        result = None
+        while True:
+            try:
+                request, arg = steps.send(result)
+            except StopIteration:
+                return
+
+            if request == _OUTPUT:
+                result = None
+                yield arg
+            else:
+                result = await self._do(request, arg)
+
+    async def sessions(self, include=None):
+        return [session async for session in self.iter_sessions(include)]
+
+    async def list_sessions(self):
+        """Returns SessionHeader of each session on the watch.
+
+        Only the first packet of each session is downloaded.
+        """
+        return await self._run(self._list_sessions())
+
+    async def _run(self, steps):
+        """Runs protocol steps (see BaseDataLink), returns their result"""
+        result = None
+        while True:
+            try:
+                request, arg = steps.send(result)
+            except StopIteration as stop:
+                return stop.value
+
+            result = await self._do(request, arg)
+
+    async def _do(self, request, arg):
+        if request == _SETUP:
+            return await self._call(self._setup_device)
+        if request == _WRITE:
+            return await self._call(self._device_write, arg)
+        if request == _READ:
+            return await self._call(self._device_read)
+        if request == _SLEEP:
+            return await asyncio.sleep(arg)
+
+        raise ValueError(f'Unknown request {request}')
+
+    async def _call(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(func, *args)
+        )
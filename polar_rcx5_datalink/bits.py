@@ -0,0 +1,59 @@
+"""Bit operations on integers.
+
+Shift and mask versions of the string based helpers of utils, which
+are kept for compatibility. Values are treated the same way: numbers
+are at least 16 bits wide (see utils.get_bin) and bytes are split
+into BCD digits as strings would be.
+"""
+
+
+def bin_slice(value, start=0, end=None, width=16):
+    """Same as utils.get_bin_slice: bits start:end of a number
+    that is at least width bits wide."""
+    width = max(width, value.bit_length())
+    start, end, _ = slice(start, end).indices(width)
+
+    return (value >> (width - end)) & ((1 << max(end - start, 0)) - 1)
+
+
+def most_significant_byte(value):
+    """The first 8 bits of a number that is at least 16 bits wide"""
+    return value >> (max(value.bit_length(), 16) - 8)
+
+
+def least_significant_byte(value):
+    return value & 0xFF
+
+
+def to_signed(value, length):
+    """Two's complement of length bits to integer"""
+    if value >> (length - 1):
+        return value - (1 << length)
+
+    return value
+
+
+def to_negative(value, length):
+    """Two's complement of length bits to integer assuming the number
+    is negative (see utils.twos_complement_to_int)."""
+    return value - (1 << length)
+
+
+def to_unsigned(value, length):
+    """Integer to two's complement of length bits"""
+    return value & ((1 << length) - 1)
+
+
+def _bcd_byte(value):
+    high, low = value >> 4, value & 0xF
+    # Digits are concatenated, so low "digits" above 9 take two places
+    return high * (100 if low > 9 else 10) + low
+
+
+# Binary Coded Decimals of bytes indexed by byte
+BCD_TABLE = tuple(_bcd_byte(value) for value in range(256))
+
+
+def bcd_to_int(value):
+    """Converts a byte of Binary Coded Decimal to integer"""
+    return BCD_TABLE[value]
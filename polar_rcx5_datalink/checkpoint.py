@@ -0,0 +1,91 @@
+import os
+import struct
+
+from .utils import format_hw_id
+
+
+class PartialDownloads(object):
+    """On-disk checkpoints of sessions being downloaded from the watch.
+
+    Packets are appended to a file per session as they arrive, so an
+    interrupted download can be resumed. Files are keyed by hardware ID,
+    session number and size. The first packet (session's header) is stored
+    first and must match the one received on resume, otherwise it is
+    another session with the same number and size.
+    """
+
+    _SUFFIX = '.partial'
+    # Packet index and length
+    _RECORD_HEADER = struct.Struct('<HH')
+
+    def __init__(self, path):
+        self.path = path
+        # Checkpoint file: first packet of a restored session that has
+        # no file yet
+        self._first_packets = {}
+
+    def restore(self, hw_id, number, size, first_packet):
+        """Returns {index: packet} of packets received earlier.
+
+        Starts a new checkpoint if there is none or it doesn't
+        belong to the session with the given first packet. Its file
+        is created along with the first packet appended to it.
+        """
+        packets = self._load(hw_id, number, size)
+        if packets.get(0) == list(first_packet):
+            return packets
+
+        self.discard(hw_id, number, size)
+        filepath = self._filepath(hw_id, number, size)
+        self._first_packets[filepath] = list(first_packet)
+
+        return {0: list(first_packet)}
+
+    def append(self, hw_id, number, size, index, packet):
+        filepath = self._filepath(hw_id, number, size)
+        records = [(index, packet)]
+        first_packet = self._first_packets.pop(filepath, None)
+        if first_packet is not None:
+            records.insert(0, (0, first_packet))
+
+        os.makedirs(self.path, exist_ok=True)
+        with open(filepath, 'ab') as f:
+            for record_index, record in records:
+                f.write(
+                    self._RECORD_HEADER.pack(record_index, len(record)) + bytes(record)
+                )
+
+    def discard(self, hw_id, number, size):
+        filepath = self._filepath(hw_id, number, size)
+        self._first_packets.pop(filepath, None)
+        try:
+            os.remove(filepath)
+        except FileNotFoundError:
+            pass
+
+    def _load(self, hw_id, number, size):
+        try:
+            with open(self._filepath(hw_id, number, size), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return {}
+
+        packets = {}
+        offset = 0
+        header_size = self._RECORD_HEADER.size
+        while offset + header_size <= len(data):
+            index, length = self._RECORD_HEADER.unpack_from(data, offset)
+            offset += header_size
+            packet = data[offset : offset + length]
+            if len(packet) < length:
+                # Interrupted while writing
+                break
+
+            packets[index] = list(packet)
+            offset += length
+
+        return packets
+
+    def _filepath(self, hw_id, number, size):
+        filename = f'{format_hw_id(hw_id)}-{number}-{size}{self._SUFFIX}'
+        return os.path.join(self.path, filename)
@@ -1,52 +1,68 @@
+# Heavy dependencies (usb, geopy, timezonefinder, flask, requests, loguru)
+# are imported in the code paths that need them to keep startup fast.
 import json
 import os
-import pathlib
 import sys
-from functools import wraps
+import threading
+from functools import partial, wraps
 
 import click
-import loguru
 
-import polar_rcx5_datalink.strava_sync.app as strava_sync
+from . import packed
 from .__version__ import __version__
-from .converter import FORMAT_CONVERTER_MAP
-from .datalink import DataLink
+from .converter import FORMAT_CONVERTER_MAP, PackedConverter
 from .exceptions import ParserError, SyncError
-from .parser import TrainingSession
-from .utils import report_error, report_warning, to_stdout
+from .utils import (
+    LOGS_PATH,
+    format_hw_id,
+    get_logger,
+    report_error,
+    report_warning,
+    to_stderr,
+    to_stdout,
+)
 
 ENVVAR_PREFIX = 'RCX5'
 DEFAULT_STRAVASYNC_HOST = '127.0.0.1'
 DEFAULT_STRAVASYNC_PORT = 8000
 DEFAULT_EXPORT_FORMAT = 'tcx'
-LOGS_PATH = os.path.join(
-    str(pathlib.Path.home()), 'Documents/rcx5' if os.name == 'nt' else '.rcx5'
-)
-
-log_config = {
-    'handlers': [
-        # {'sink': sys.stdout},
-        {
-            'sink': os.path.join(LOGS_PATH, 'error.log'),
-            'rotation': '100 MB',
-            'retention': '10 days',
-        }
-    ]
-}
-loguru.logger.configure(**log_config)
-
-
-def get_raw_sessions(from_dir=None):
+DEFAULT_DAEMON_POLL_INTERVAL = 5
+DEFAULT_DAEMON_SYNC_COOLDOWN = 10 * 60
+DEFAULT_DAEMON_STATUS_HOST = '127.0.0.1'
+DEFAULT_DAEMON_STATUS_PORT = 8001
+# Packets of interrupted downloads
+PARTIAL_DOWNLOADS_PATH = os.path.join(LOGS_PATH, 'partial')
+# Sessions that went through the daemon's pipeline
+DAEMON_SYNCED_PATH = os.path.join(LOGS_PATH, 'daemon-synced.json')
+# Sessions uploaded to Strava
+STRAVA_UPLOADS_PATH = os.path.join(LOGS_PATH, 'strava-uploads.json')
+# Uploads waiting for Strava's rate limit
+STRAVA_UPLOAD_QUEUE_PATH = os.path.join(LOGS_PATH, 'strava-queue')
+# Cached previews of training sessions shown by stravasync
+PREVIEWS_PATH = os.path.join(LOGS_PATH, 'previews')
+# Derived metrics of sessions summed up by rcx5 report
+METRICS_PATH = os.path.join(LOGS_PATH, 'session-metrics.json')
+# Deduplicated raw sessions imported by rcx5 import
+ARCHIVE_PATH = os.path.join(LOGS_PATH, 'archive')
+# Sessions parsed before their timezones are looked up at once
+TIMEZONE_BATCH_SIZE = 64
+# Geodesic distances of segments reused by --distance-cache
+DISTANCE_CACHE_PATH = os.path.join(LOGS_PATH, 'distance-cache.json')
+
+
+def get_raw_sessions(from_dir=None, from_date=None, to_date=None, include=None):
     """Returns unprocessed training sessions.
 
     Each session is a list of packets and each packet
-    is a list of bytes received from the watch.
+    is a list of bytes received from the watch. Sessions on the watch
+    that started out of the date range or that include(SessionHeader)
+    rejects aren't downloaded.
     """
     if from_dir is not None:
         raw_sessions = raw_sessions_from_dir(from_dir)
     else:
         try:
-            raw_sessions = raw_sessions_from_watch()
+            raw_sessions = raw_sessions_from_watch(from_date, to_date, include)
         except SyncError as err:
             report_error(str(err))
             sys.exit(1)
@@ -55,26 +71,73 @@ def get_raw_sessions(from_dir=None):
 
 
 def raw_sessions_from_dir(path):
+    """Yields raw sessions of JSON and packed (see packed module) files."""
     for filename in sorted(os.listdir(path)):
-        with open(os.path.join(path, filename)) as f:
+        filepath = os.path.join(path, filename)
+        if packed.is_packed(filepath):
+            yield from packed.read_sessions(filepath)
+            continue
+
+        with open(filepath) as f:
             yield json.load(f)
 
 
-def raw_sessions_from_watch():
-    with DataLink() as dl:
+def raw_sessions_from_watch(from_date=None, to_date=None, include=None):
+    from .checkpoint import PartialDownloads
+    from .datalink import DataLink
+
+    in_range = date_filter(from_date, to_date)
+    if in_range is not None and include is not None:
+        picked = include
+        include = lambda header: in_range(header) and picked(header)  # noqa: E731
+    elif in_range is not None:
+        include = in_range
+
+    with DataLink(checkpoints=PartialDownloads(PARTIAL_DOWNLOADS_PATH)) as dl:
         dl.synchronize()
-        return dl.sessions
+        return dl.read_sessions(include)
+
+
+def parse_raw_sessions(raw_sessions, from_date=None, to_date=None, timezones=None):
+    """Yields parsed sessions filtered by start time.
 
+    Timezones are resolved in batches of sessions (see resolve_timezones),
+    timezones is a cache for it that can be shared between calls.
+    """
+    from .parser import TrainingSession, resolve_timezones
+
+    if timezones is None:
+        timezones = {}
 
-def parse_raw_sessions(raw_sessions, from_date=None, to_date=None):
+    batch = []
     for rs in raw_sessions:
         sess = TrainingSession(rs)
-        if from_date is not None and sess.start_time < from_date:
-            continue
-        if to_date is not None and sess.start_time > to_date:
+        if not in_date_range(sess.start_time, from_date, to_date):
             continue
 
-        yield sess
+        batch.append(sess)
+        if len(batch) == TIMEZONE_BATCH_SIZE:
+            resolve_timezones(batch, timezones)
+            yield from batch
+            batch = []
+
+    resolve_timezones(batch, timezones)
+    yield from batch
+
+
+def in_date_range(start_time, from_date=None, to_date=None):
+    if from_date is not None and start_time < from_date:
+        return False
+
+    return to_date is None or start_time <= to_date
+
+
+def date_filter(from_date=None, to_date=None):
+    """Returns include for DataLink.read_sessions or None if there are no dates"""
+    if from_date is None and to_date is None:
+        return None
+
+    return lambda header: in_date_range(header.start_time, from_date, to_date)
 
 
 def load_sessions(func):
@@ -82,19 +145,47 @@ def load_sessions(func):
 
     @wraps(func)
     def wrapper(*args, **kwargs):
-        raw_sessions = get_raw_sessions(kwargs.pop('sessions_dir', None))
-        sessions = parse_raw_sessions(
-            raw_sessions, kwargs.pop('from_date', None), kwargs.pop('to_date', None)
+        from_date = kwargs.pop('from_date', None)
+        to_date = kwargs.pop('to_date', None)
+        raw_sessions = get_raw_sessions(
+            kwargs.pop('sessions_dir', None), from_date, to_date
         )
+        sessions = parse_raw_sessions(raw_sessions, from_date, to_date)
 
         return func(sessions, *args, **kwargs)
 
     return wrapper
 
 
+def use_distance_cache(ctx, path):
+    """Caches geodesics of all sessions parsed by the command in path"""
+    from .geodesic import GeodesicCache
+    from .parser import TrainingSession
+
+    cache = GeodesicCache.load(path)
+    TrainingSession.distance_cache = cache
+
+    def save():
+        cache.save(path)
+        if cache.hits + cache.misses:
+            # Commands may write JSON to stdout
+            to_stderr(
+                f'Distance cache: {cache.hit_rate:.0%} hits, '
+                f'{len(cache)} segments cached'
+            )
+
+    ctx.call_on_close(save)
+
+
 @click.group()
 @click.version_option(version=__version__)
-def cli():
+@click.option(
+    '--distance-cache',
+    is_flag=True,
+    help='Reuse geodesic distances of segments between runs.',
+)
+@click.pass_context
+def cli(ctx, distance_cache):
     """Polar RCX5 training session exporter.
 
     Export Polar RCX5 training sessions in raw or tcx format.
@@ -105,7 +196,27 @@ def cli():
       rcx5 export --out /path/for/exported/files/
       rcx5 stravasync --client-id YOUR_CLIENT_ID --client-secret YOUR_CLIENT_SECRET
     """
-    pass
+    if distance_cache:
+        use_distance_cache(ctx, DISTANCE_CACHE_PATH)
+
+
+def date_options(func):
+    options = (
+        click.option(
+            '--from-date',
+            type=click.DateTime(),
+            help='Filter sessions that have started at this date or after.',
+        ),
+        click.option(
+            '--to-date',
+            type=click.DateTime(),
+            help='Filter sessions that have started at this date or before.',
+        ),
+    )
+    for option in reversed(options):
+        func = option(func)
+
+    return func
 
 
 def common_options(func):
@@ -116,22 +227,459 @@ def common_options(func):
         type=click.Path(exists=True),
         help='Directory of raw training sessions.',
     )
-    @click.option(
-        '--from-date',
-        type=click.DateTime(),
-        help='Filter sessions that have started at this date or after.',
-    )
-    @click.option(
-        '--to-date',
-        type=click.DateTime(),
-        help='Filter sessions that have started at this date or before.',
-    )
+    @date_options
     def newfunc(*args, **kwargs):
         return func(*args, **kwargs)
 
     return newfunc
 
 
+def get_simplifier(tolerance=None, sample_rate=None):
+    """Returns a function that simplifies sessions or None if there is nothing to do"""
+    if tolerance is None and sample_rate is None:
+        return None
+
+    from .simplify import simplified_session
+
+    return partial(simplified_session, tolerance=tolerance, sample_rate=sample_rate)
+
+
+def simplify_options(func):
+    """Passes a function returned by get_simplifier as simplifier argument"""
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        kwargs['simplifier'] = get_simplifier(
+            kwargs.pop('simplify'), kwargs.pop('downsample')
+        )
+        return func(*args, **kwargs)
+
+    options = (
+        click.option(
+            '--simplify',
+            type=float,
+            metavar='TOLERANCE_M',
+            help='Simplify tracks, keeping them within this many meters.',
+        ),
+        click.option(
+            '--downsample',
+            type=int,
+            metavar='SECONDS',
+            help='Keep a sample per this many seconds.',
+        ),
+    )
+    for option in reversed(options):
+        wrapper = option(wrapper)
+
+    return wrapper
+
+
+def export_session(sess, out, file_format, simplifier=None):
+    """Returns False if the session couldn't be exported."""
+    if file_format == 'tcx' and not sess.has_gps:
+        report_warning(f'{sess.name} has no GPS data')
+        return True
+
+    try:
+        if file_format == 'tcx' and simplifier is not None:
+            sess = simplifier(sess)
+
+        converter = FORMAT_CONVERTER_MAP[file_format](sess)
+    except ParserError:
+        err_msg = f"Can't parse samples of session #{sess.id}"
+        get_logger().exception(err_msg)
+        report_warning(err_msg)
+        return False
+
+    converter.write(out)
+    return True
+
+
+def export_options(func):
+    options = (
+        click.option(
+            '-o',
+            '--out',
+            type=click.Path(exists=True, writable=True),
+            default=os.getcwd(),
+            help='Where to save the output. Current working directory by default.',
+        ),
+        click.option(
+            '-f',
+            '--format',
+            'file_format',
+            type=click.Choice(['raw', 'bin', 'tcx', 'packed']),
+            default=DEFAULT_EXPORT_FORMAT,
+            help='Export file format.',
+            show_default=True,
+        ),
+    )
+    for option in reversed(options):
+        func = option(func)
+
+    return func
+
+
+@cli.command()
+@export_options
+@simplify_options
+@common_options
+@load_sessions
+def export(sessions, out, file_format, simplifier):
+    """Exports training sessions."""
+    to_stdout('[export] Exporting training sessions')
+    if file_format == 'packed':
+        PackedConverter.write_all(sessions, out)
+        return
+
+    for sess in sessions:
+        export_session(sess, out, file_format, simplifier)
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(round(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02d}:{seconds:02d}'
+
+
+@cli.command(name='ls')
+@click.option(
+    '--device',
+    is_flag=True,
+    help='List sessions on the watch downloading only their first packets.',
+)
+@common_options
+def list_sessions(device, sessions_dir, from_date, to_date):
+    """Lists training sessions.
+
+    With --device only headers of sessions are downloaded from the watch,
+    which takes seconds instead of minutes. Numbers of sessions are their
+    positions on the watch.
+
+    \b
+    Examples:
+      rcx5 ls --device --from-date 2019-01-01
+      rcx5 ls -s /path/to/raw/sessions/
+    """
+    if device and sessions_dir is not None:
+        report_error('--device and --sessions-dir are mutually exclusive')
+        sys.exit(1)
+
+    if device:
+        rows = [
+            (h.number + 1, h.start_time, h.duration, h.has_gps, h.hr_avg, h.size)
+            for h in session_headers_from_watch()
+            if in_date_range(h.start_time, from_date, to_date)
+        ]
+    else:
+        raw_sessions = get_raw_sessions(sessions_dir, from_date, to_date)
+        sessions = parse_raw_sessions(raw_sessions, from_date, to_date)
+        rows = [
+            (
+                num,
+                sess.start_time,
+                sess.duration,
+                sess.has_gps,
+                sess.info['hr_avg'] if sess.has_hr else None,
+                sum(len(packet) for packet in sess.raw),
+            )
+            for num, sess in enumerate(sessions, 1)
+        ]
+
+    to_stdout(
+        f"{'#':>3}  {'Start':<19}  {'Duration':>8}  {'GPS':<3}  {'HR avg':>6}  {'KB':>6}"
+    )
+    for num, start_time, duration, has_gps, hr_avg, size in rows:
+        to_stdout(
+            f"{num:>3}  {start_time:%Y-%m-%d %H:%M:%S}  {format_duration(duration):>8}  "
+            f"{'yes' if has_gps else 'no':<3}  {'-' if hr_avg is None else hr_avg:>6}  "
+            f"{size / 1024:>6.1f}"
+        )
+
+
+def session_headers_from_watch():
+    from .checkpoint import PartialDownloads
+    from .datalink import DataLink
+
+    try:
+        with DataLink(checkpoints=PartialDownloads(PARTIAL_DOWNLOADS_PATH)) as dl:
+            dl.synchronize()
+            return dl.list_sessions()
+    except SyncError as err:
+        report_error(str(err))
+        sys.exit(1)
+
+
+@cli.command()
+@export_options
+@simplify_options
+@date_options
+def multisync(out, file_format, simplifier, from_date, to_date):
+    """Exports training sessions from all connected DataLinks at once.
+
+    Sessions of each watch are saved in a subdirectory
+    named after the watch's hardware ID. Packed sessions
+    of a watch are written into one file once it's synced.
+    """
+    from .checkpoint import PartialDownloads
+    from .datalink import DataLink
+    from .multisync import sync_all
+
+    devices = DataLink.find_devices()
+    if not devices:
+        report_error('Polar DataLink not found')
+        sys.exit(1)
+
+    to_stdout(f'[multisync] Syncing through {len(devices)} DataLinks')
+    timezones = {}
+    # Output directory of a watch: its sessions to pack
+    to_pack = {}
+
+    def on_session(hw_id, raw_session):
+        for sess in parse_raw_sessions([raw_session], from_date, to_date, timezones):
+            watch_out = os.path.join(out, format_hw_id(hw_id))
+            os.makedirs(watch_out, exist_ok=True)
+            if file_format == 'packed':
+                to_pack.setdefault(watch_out, []).append(sess)
+                continue
+
+            export_session(sess, watch_out, file_format, simplifier)
+
+    checkpoints = PartialDownloads(PARTIAL_DOWNLOADS_PATH)
+    stats, seconds = sync_all(
+        devices, on_session, checkpoints, date_filter(from_date, to_date)
+    )
+
+    for watch_out, sessions in to_pack.items():
+        PackedConverter.write_all(sessions, watch_out)
+
+    total_bytes = 0
+    for dev_stats in stats:
+        total_bytes += dev_stats.bytes
+        if dev_stats.error is not None:
+            hw_id = (
+                'unknown' if dev_stats.hw_id is None else format_hw_id(dev_stats.hw_id)
+            )
+            report_warning(f'Watch {hw_id}: {dev_stats.error}')
+            continue
+
+        to_stdout(
+            f'[multisync] Watch {format_hw_id(dev_stats.hw_id)}: '
+            f'{dev_stats.sessions} sessions, {dev_stats.bytes / 1024:.1f} KB '
+            f'in {dev_stats.seconds:.1f} s ({dev_stats.throughput / 1024:.1f} KB/s)'
+        )
+
+    throughput = total_bytes / seconds if seconds else 0.0
+    to_stdout(
+        f'[multisync] Total: {total_bytes / 1024:.1f} KB in {seconds:.1f} s '
+        f'({throughput / 1024:.1f} KB/s)'
+    )
+
+
+@cli.command(name='import')
+@click.argument('dirs', nargs=-1, required=True, type=click.Path(exists=True))
+@click.option(
+    '-a',
+    '--archive',
+    type=click.Path(file_okay=False),
+    default=ARCHIVE_PATH,
+    help='Directory of the archive.',
+    show_default=True,
+)
+@click.option(
+    '-j',
+    '--workers',
+    type=int,
+    help='Processes that read files. As many as CPUs by default.',
+)
+def import_sessions(dirs, archive, workers):
+    """Imports raw sessions of directories into the local archive.
+
+    Each session is stored once no matter how many copies of it
+    are imported. Directories are searched recursively for JSON
+    and packed files. Archived sessions are in the archive's
+    sessions directory, use it with --sessions-dir.
+
+    \b
+    Examples:
+      rcx5 import /backup/laptop1/ /backup/laptop2/
+      rcx5 export -s ~/.rcx5/archive/sessions/ --from-date 2019-01-01
+    """
+    from .archive import SessionArchive
+
+    session_archive = SessionArchive(archive)
+    stats = session_archive.import_dirs(dirs, workers, on_error=report_warning)
+
+    rate = stats.files / stats.seconds if stats.seconds else 0.0
+    to_stdout(
+        f'[import] {stats.files} files, {stats.sessions} sessions in '
+        f'{stats.seconds:.1f} s ({rate:.0f} files/s)'
+    )
+    to_stdout(
+        f'[import] {stats.imported} imported, {stats.duplicates} duplicates, '
+        f'{stats.errors} errors, {len(session_archive)} sessions in the archive'
+    )
+
+    variants = session_archive.variants()
+    if variants:
+        report_warning(
+            f'{len(variants)} sessions are archived in several versions '
+            '(e.g. interrupted downloads), see index.json'
+        )
+
+
+@cli.command()
+@click.option(
+    '--split',
+    type=click.Choice(['km', 'mile']),
+    default='km',
+    help='Length of splits, paces are per this length.',
+    show_default=True,
+)
+@click.option(
+    '--threshold-hr',
+    type=int,
+    help='Threshold HR for training load. 85% of HR reserve by default.',
+)
+@click.option(
+    '-j',
+    '--workers',
+    type=int,
+    help='Processes that parse sessions. As many as CPUs by default.',
+)
+@click.option(
+    '-o',
+    '--out',
+    type=click.File('w'),
+    default='-',
+    help='Where to write JSON. Standard output by default.',
+)
+@common_options
+@load_sessions
+def stats(sessions, split, threshold_hr, workers, out):
+    """Computes statistics of training sessions as JSON.
+
+    Time in HR zones, training load (TRIMP), splits,
+    paces and best rolling averages of HR and speed.
+
+    \b
+    Examples:
+      rcx5 stats --from-date 2019-01-01 --split mile
+      rcx5 stats -s /path/to/raw/sessions/ -o stats.json
+    """
+    try:
+        from .analytics import batch_stats
+    except ImportError:
+        report_error(
+            "rcx5 stats needs numpy: pip install 'polar_rcx5_datalink[analytics]'"
+        )
+        sys.exit(1)
+
+    sessions = list(sessions)
+    result = batch_stats(sessions, workers, split=split, threshold_hr=threshold_hr)
+    json.dump(result, out, indent=2)
+    out.write('\n')
+
+
+@cli.command()
+@click.option(
+    '--by',
+    type=click.Choice(['week', 'month']),
+    default='week',
+    help='Period of totals.',
+    show_default=True,
+)
+@click.option(
+    '-j',
+    '--workers',
+    type=int,
+    help='Processes that parse new sessions. As many as CPUs by default.',
+)
+@click.option('--json', 'as_json', is_flag=True, help='Print totals as JSON.')
+@common_options
+def report(sessions_dir, from_date, to_date, by, workers, as_json):
+    """Reports distance, time and training load per week or month.
+
+    Metrics of sessions are stored and only new sessions are parsed.
+    Sessions on the watch that have metrics aren't downloaded.
+
+    \b
+    Examples:
+      rcx5 report --by month
+      rcx5 report --from-date 2019-01-01 --json
+    """
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        report_error(
+            "rcx5 report needs numpy: pip install 'polar_rcx5_datalink[analytics]'"
+        )
+        sys.exit(1)
+
+    from .aggregation import MetricsStore, aggregate, metrics_key
+
+    store = MetricsStore(METRICS_PATH)
+    # Sessions of the report, known ones are skipped before parsing
+    keys = []
+
+    def is_new(key):
+        keys.append(key)
+        return key not in store
+
+    if sessions_dir is not None:
+        raw_sessions = get_raw_sessions(sessions_dir)
+        raw_sessions = (
+            rs for rs in raw_sessions if is_new(metrics_key(rs[0], len(rs)))
+        )
+    else:
+        from .datalink import DataLink
+
+        def include(header):
+            packets_count = DataLink.packets_count(header.size)
+            return is_new(metrics_key(header.first_packet, packets_count))
+
+        raw_sessions = get_raw_sessions(None, from_date, to_date, include)
+
+    new = store.update(parse_raw_sessions(raw_sessions, from_date, to_date), workers)
+    metrics = store.metrics(keys, from_date, to_date)
+    totals = aggregate(metrics, by)
+
+    if as_json:
+        to_stdout(json.dumps(totals, indent=2))
+        return
+
+    to_stdout(f'[report] {len(metrics)} sessions, {new} parsed')
+    to_stdout(
+        f"{by.capitalize():<9} {'Sessions':>8} {'Time':>8} {'Km':>8} "
+        f"{'HR avg':>6} {'Load':>6}"
+    )
+    for total in totals:
+        hours, seconds = divmod(round(total['duration']), 3600)
+        hr_avg = '-' if total['hr_avg'] is None else f"{total['hr_avg']:.0f}"
+        to_stdout(
+            f"{total['period']:<9} {total['sessions']:>8} "
+            f"{hours:>5}:{seconds // 60:02d} {total['distance'] / 1000:>8.1f} "
+            f"{hr_avg:>6} {total['load']:>6.0f}"
+        )
+
+
+def get_upload_scheduler(simplifier=None):
+    from .strava_sync.ledger import UploadLedger
+    from .strava_sync.scheduler import UploadQueue, UploadScheduler
+
+    return UploadScheduler(
+        UploadQueue(STRAVA_UPLOAD_QUEUE_PATH),
+        UploadLedger(STRAVA_UPLOADS_PATH),
+        simplifier=simplifier,
+    )
+
+
+def submit_upload(sess, scheduler):
+    """Queues a session with GPS data for upload to Strava."""
+    if sess.has_gps:
+        scheduler.submit(sess)
+
+
 @cli.command()
 @click.option(
     '-o',
@@ -143,31 +691,87 @@ def common_options(func):
 @click.option(
     '-f',
     '--format',
-    'file_format',
-    type=click.Choice(['raw', 'bin', 'tcx']),
-    default=DEFAULT_EXPORT_FORMAT,
-    help='Export file format.',
+    'file_formats',
+    type=click.Choice(['raw', 'bin', 'tcx', 'packed']),
+    multiple=True,
+    help='Export file format, can be given several times. tcx by default.',
+)
+@click.option(
+    '--strava-token',
+    help='Strava access token with write scope to upload new sessions.',
+)
+@click.option(
+    '--poll-interval',
+    type=float,
+    default=DEFAULT_DAEMON_POLL_INTERVAL,
+    help='Seconds between checks for connected DataLinks.',
     show_default=True,
 )
-@common_options
-@load_sessions
-def export(sessions, out, file_format):
-    """Exports training sessions."""
-    to_stdout('[export] Exporting training sessions')
-    for sess in sessions:
-        if file_format == 'tcx' and not sess.has_gps:
-            report_warning(f'{sess.name} has no GPS data')
-            continue
+@click.option(
+    '--sync-cooldown',
+    type=float,
+    default=DEFAULT_DAEMON_SYNC_COOLDOWN,
+    help='Seconds before a DataLink that stays plugged in is synced again.',
+    show_default=True,
+)
+@click.option('--status-host', default=DEFAULT_DAEMON_STATUS_HOST, show_default=True)
+@click.option(
+    '--status-port',
+    type=int,
+    default=DEFAULT_DAEMON_STATUS_PORT,
+    help='Port of the status socket.',
+    show_default=True,
+)
+@simplify_options
+def daemon(
+    out,
+    file_formats,
+    strava_token,
+    poll_interval,
+    sync_cooldown,
+    status_host,
+    status_port,
+    simplifier,
+):
+    """Keeps syncing new training sessions as watches become available.
+
+    Connected DataLinks are picked up automatically. Every session that
+    hasn't been synced before is exported and, if --strava-token is given,
+    uploaded to Strava. Daemon's state can be read from the status socket.
 
-        try:
-            converter = FORMAT_CONVERTER_MAP[file_format](sess)
-        except ParserError:
-            err_msg = f"Can't parse samples of session #{sess.id}"
-            loguru.logger.exception(err_msg)
-            report_warning(err_msg)
-            continue
+    \b
+    Examples:
+      rcx5 daemon --out /path/for/exported/files/ -f tcx -f raw
+      nc 127.0.0.1 8001
+    """
+    from .checkpoint import PartialDownloads
+    from .daemon import Daemon, SyncedSessions
 
-        converter.write(out)
+    pipeline = [
+        partial(export_session, out=out, file_format=file_format, simplifier=simplifier)
+        for file_format in file_formats or (DEFAULT_EXPORT_FORMAT,)
+    ]
+    stop_uploads = threading.Event()
+    if strava_token is not None:
+        scheduler = get_upload_scheduler(simplifier)
+        pipeline.append(partial(submit_upload, scheduler=scheduler))
+        threading.Thread(
+            target=scheduler.serve, args=(strava_token, stop_uploads), daemon=True
+        ).start()
+
+    sync_daemon = Daemon(
+        pipeline,
+        SyncedSessions(DAEMON_SYNCED_PATH),
+        checkpoints=PartialDownloads(PARTIAL_DOWNLOADS_PATH),
+        poll_interval=poll_interval,
+        status_address=(status_host, status_port),
+        sync_cooldown=sync_cooldown,
+    )
+    to_stdout(f'[daemon] Waiting for DataLinks, status on {status_host}:{status_port}')
+    try:
+        sync_daemon.run()
+    finally:
+        stop_uploads.set()
 
 
 @cli.command(name='stravasync')
@@ -184,9 +788,10 @@ def export(sessions, out, file_format):
     required=True,
     help='Application’s secret, obtained during registration.',
 )
+@simplify_options
 @common_options
 @load_sessions
-def stravasync(sessions, host, port, client_id, client_secret):
+def stravasync(sessions, host, port, client_id, client_secret, simplifier):
     """Helps to synchronize training sessions with Strava.
 
     Before getting started you need to register an application
@@ -205,8 +810,16 @@ def stravasync(sessions, host, port, client_id, client_secret):
       export RCX5_STRAVASYNC_CLIENT_SECRET=YOUR_CLIENT_SECRET
       rcx5 stravasync
     """
+    import polar_rcx5_datalink.strava_sync.app as strava_sync
+
     strava_sync.run_app(
-        host, port, client_id, client_secret, [s for s in sessions if s.has_gps]
+        host,
+        port,
+        client_id,
+        client_secret,
+        [s for s in sessions if s.has_gps],
+        get_upload_scheduler(simplifier),
+        PREVIEWS_PATH,
     )
 
 
@@ -3,6 +3,7 @@ import datetime
 import json
 import xml.etree.ElementTree as ET
 
+from . import packed
 from .exceptions import ConverterError
 
 
@@ -30,7 +31,46 @@ class RawConverter(Converter):
 
     def write(self, out):
         with open(self._get_filepath(out), 'w') as f:
-            return f.write(json.dumps(self.training_session.raw))
+            # Packets might be memoryviews of a packed file
+            raw = [list(packet) for packet in self.training_session.raw]
+            return f.write(json.dumps(raw))
+
+
+class PackedConverter(Converter):
+    _SUFFIX = packed.SUFFIX
+
+    def write(self, out):
+        return self.write_all([self.training_session], out)
+
+    @classmethod
+    def write_all(cls, training_sessions, out):
+        """Packs training sessions into a single file.
+
+        The file is named after start times of the first and the last
+        session. Returns its path or None if there were no sessions.
+        """
+        start_times = []
+
+        def raw_sessions():
+            for training_session in training_sessions:
+                start_times.append(training_session.start_time)
+                yield training_session.raw
+
+        tmp_path = os.path.join(out, f'.packing{cls._SUFFIX}')
+        with open(tmp_path, 'wb') as f:
+            packed.write_sessions(f, raw_sessions())
+
+        if not start_times:
+            os.remove(tmp_path)
+            return None
+
+        names = [t.strftime('%Y%m%dT%H%M%S') for t in (start_times[0], start_times[-1])]
+        if len(start_times) == 1:
+            names.pop()
+
+        filepath = os.path.join(out, '-'.join(names) + cls._SUFFIX)
+        os.replace(tmp_path, filepath)
+        return filepath
 
 
 class TCXConverter(Converter):
@@ -100,7 +140,7 @@ class TCXConverter(Converter):
             trackpoint = ET.Element('Trackpoint')
 
             time = sess.start_utctime + datetime.timedelta(
-                seconds=sess.info['sample_rate'] * sample_index
+                seconds=sess.sample_offset(sample_index)
             )
             ET.SubElement(trackpoint, 'Time').text = time.strftime(self._ISO8601_FORMAT)
 
@@ -150,4 +190,5 @@ FORMAT_CONVERTER_MAP = {
     'bin': BinaryConverter,
     'tcx': TCXConverter,
     'raw': RawConverter,
+    'packed': PackedConverter,
 }
@@ -0,0 +1,336 @@
+"""Long-running sync daemon.
+
+The watcher thread polls for connected DataLinks and puts a sync job on
+the work queue for every DataLink that has no job queued or running yet.
+Worker threads take jobs off the queue, wait for the watch to start
+synchronizing and pass sessions that haven't been synced before through
+the pipeline: a sequence of callables taking a parsed TrainingSession
+(export, upload, etc.). A step fails by raising or returning False,
+sessions are synced once all steps succeed.
+
+After a successful sync a DataLink cools down: it's synced again once
+it's plugged in again or the cooldown is over. Syncs that didn't find
+a watch are retried on the next poll.
+
+State of the daemon is served as a JSON document by a local TCP socket:
+
+    $ nc 127.0.0.1 8001
+    {"uptime": 42.0, "queued": 0, "synced_sessions": 3, "devices": [...]}
+"""
+
+import datetime
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+
+from .datalink import DataLink
+from .exceptions import SyncError
+from .utils import format_hw_id, get_logger, report_warning, to_stdout
+
+DEFAULT_POLL_INTERVAL = 5
+# Seconds between syncs of a DataLink that stays plugged in
+DEFAULT_SYNC_COOLDOWN = 10 * 60
+DEFAULT_WORKERS = 2
+# Seconds to wait for threads on stop
+_STOP_TIMEOUT = 5
+
+
+def device_key(device):
+    """Identifies a DataLink between polls"""
+    bus = getattr(device, 'bus', None)
+    address = getattr(device, 'address', None)
+    if bus is None and address is None:
+        return id(device)
+
+    return bus, address
+
+
+def session_key(hw_id, training_session):
+    """Identifies a session (or its SessionHeader) across syncs"""
+    start_time = training_session.start_time.strftime('%Y%m%dT%H%M%S')
+    return f'{format_hw_id(hw_id)}/{start_time}'
+
+
+class SyncedSessions(object):
+    """Persistent set of session keys that went through the pipeline"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._keys = self._load()
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key):
+        with self._lock:
+            self._keys.add(key)
+            self._save()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return set(json.load(f))
+        except FileNotFoundError:
+            return set()
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(sorted(self._keys), f)
+
+        os.replace(tmp_path, self.path)
+
+
+class _StatusHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        status = self.server.sync_daemon.status()
+        self.wfile.write(json.dumps(status).encode() + b'\n')
+
+
+class _StatusServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, sync_daemon):
+        super().__init__(address, _StatusHandler)
+        self.sync_daemon = sync_daemon
+
+
+class Daemon(object):
+    """Keeps syncing sessions from DataLinks as they become available.
+
+    daemon = Daemon([export_step], SyncedSessions(path))
+    daemon.run()
+    """
+
+    def __init__(
+        self,
+        pipeline,
+        synced,
+        checkpoints=None,
+        find_devices=None,
+        poll_interval=DEFAULT_POLL_INTERVAL,
+        workers=DEFAULT_WORKERS,
+        status_address=None,
+        sync_cooldown=DEFAULT_SYNC_COOLDOWN,
+    ):
+        self.pipeline = list(pipeline)
+        # SyncedSessions
+        self.synced = synced
+        # checkpoint.PartialDownloads to resume interrupted downloads
+        self.checkpoints = checkpoints
+        self.find_devices = find_devices or DataLink.find_devices
+        self.poll_interval = poll_interval
+        self.sync_cooldown = sync_cooldown
+        self.workers = workers
+        # (host, port) of the status socket, disabled if None
+        self.status_address = status_address
+        self.jobs = queue.Queue()
+
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        # Device key: state reported by the status socket
+        self._devices = {}
+        # Keys of devices that have a job queued or running
+        self._busy = set()
+        # Device key: time.monotonic() when a synced device may sync again
+        self._cooldowns = {}
+        # Timezone cache shared by all syncs
+        self._timezones = {}
+        self._threads = []
+        self._status_server = None
+        self._started_at = None
+
+    @property
+    def server_address(self):
+        """Address the status socket is bound to"""
+        if self._status_server is None:
+            return None
+
+        return self._status_server.server_address
+
+    def run(self):
+        """Runs the daemon until interrupted"""
+        self.start()
+        try:
+            while not self._stop.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def start(self):
+        self._started_at = time.monotonic()
+        targets = [self._watch] + [self._work] * self.workers
+
+        if self.status_address is not None:
+            self._status_server = _StatusServer(self.status_address, self)
+            targets.append(self._status_server.serve_forever)
+
+        for target in targets:
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        for _ in range(self.workers):
+            self.jobs.put(None)
+
+        if self._status_server is not None:
+            self._status_server.shutdown()
+            self._status_server.server_close()
+
+        # Workers may be waiting for a watch, they are daemon threads
+        # so it's fine to leave them behind
+        for thread in self._threads:
+            thread.join(_STOP_TIMEOUT)
+
+    def status(self):
+        with self._lock:
+            devices = [dict(state) for state in self._devices.values()]
+
+        return {
+            'uptime': time.monotonic() - self._started_at,
+            'queued': self.jobs.qsize(),
+            'synced_sessions': len(self.synced),
+            'devices': devices,
+        }
+
+    def poll_devices(self):
+        """Queues a sync job for every connected DataLink that has none."""
+        try:
+            devices = self.find_devices()
+        except Exception:
+            get_logger().exception("Can't list DataLinks")
+            return
+
+        with self._lock:
+            connected = set()
+            for device in devices:
+                key = device_key(device)
+                connected.add(key)
+                if key not in self._devices:
+                    to_stdout('[daemon] DataLink connected')
+                    self._devices[key] = {
+                        'hw_id': None,
+                        'state': 'idle',
+                        'last_sync': None,
+                        'new_sessions': 0,
+                        'error': None,
+                    }
+
+                if key in self._busy:
+                    continue
+
+                if time.monotonic() < self._cooldowns.get(key, 0):
+                    continue
+
+                self._busy.add(key)
+                self._devices[key]['state'] = 'queued'
+                self.jobs.put((key, device))
+
+            for key in set(self._devices) - connected - self._busy:
+                to_stdout('[daemon] DataLink disconnected')
+                del self._devices[key]
+                self._cooldowns.pop(key, None)
+
+    def _watch(self):
+        while not self._stop.is_set():
+            self.poll_devices()
+            self._stop.wait(self.poll_interval)
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+
+            key, device = job
+            try:
+                self._sync(key, device)
+            finally:
+                with self._lock:
+                    self._busy.discard(key)
+
+    def _sync(self, key, device):
+        self._update_device(key, state='syncing')
+        try:
+            with DataLink(device, self.checkpoints) as dl:
+                dl.synchronize()
+                self._update_device(key, hw_id=format_hw_id(dl.hw_id))
+                # Synced sessions are told by their first packets
+                raw_sessions = dl.read_sessions(
+                    lambda header: session_key(dl.hw_id, header) not in self.synced
+                )
+
+            new_sessions = self._process(dl.hw_id, raw_sessions)
+        except SyncError as err:
+            # Not finding the watch means nobody has started synchronizing
+            error = None if dl.hw_id is None else str(err)
+            self._update_device(key, state='idle', error=error)
+            return
+        except Exception as err:
+            get_logger().exception('Sync failed')
+            self._update_device(key, state='idle', error=str(err))
+            return
+
+        with self._lock:
+            self._cooldowns[key] = time.monotonic() + self.sync_cooldown
+
+        self._update_device(
+            key,
+            state='idle',
+            error=None,
+            new_sessions=new_sessions,
+            last_sync=datetime.datetime.now().isoformat(timespec='seconds'),
+        )
+
+    def _process(self, hw_id, raw_sessions):
+        """Runs the pipeline for new sessions and returns their number."""
+        from .parser import TrainingSession, resolve_timezones
+
+        new = []
+        for rs in raw_sessions:
+            sess = TrainingSession(rs)
+            key = session_key(hw_id, sess)
+            if key not in self.synced:
+                new.append((key, sess))
+
+        resolve_timezones([sess for _, sess in new], self._timezones)
+        to_stdout(f'[daemon] Watch {format_hw_id(hw_id)}: {len(new)} new sessions')
+
+        for key, sess in new:
+            if self._run_pipeline(sess):
+                self.synced.add(key)
+
+        return len(new)
+
+    def _run_pipeline(self, sess):
+        err_msg = f'Pipeline failed for session {sess.name}'
+        for step in self.pipeline:
+            try:
+                succeeded = step(sess) is not False
+            except Exception:
+                get_logger().exception(err_msg)
+                succeeded = False
+
+            if not succeeded:
+                report_warning(err_msg)
+                return False
+
+        return True
+
+    def _update_device(self, key, **fields):
+        with self._lock:
+            if key in self._devices:
+                self._devices[key].update(fields)
@@ -1,21 +1,56 @@
 import array
+import itertools
 import math
 import time
+from collections import namedtuple
 
 import usb.core
 import usb.util
 
-from .utils import (
-    starts_with,
-    most_significant_byte,
-    least_significant_byte,
-    report_warning,
-    to_stdout,
-)
+from .bits import least_significant_byte, most_significant_byte
+from .utils import starts_with, report_warning, to_stdout
 from .exceptions import SyncError
+from .parser import TrainingSession
+
+# Session on the watch described by its first packet. number and size
+# (bytes) identify it in the DataLink protocol, other fields are parsed
+# from first_packet the way TrainingSession does it.
+SessionHeader = namedtuple(
+    'SessionHeader',
+    [
+        'number',
+        'size',
+        'start_time',
+        'duration',
+        'has_hr',
+        'has_gps',
+        'hr_avg',
+        'first_packet',
+    ],
+)
+
+
+# Requests of protocol steps to their drivers, see BaseDataLink
+_SETUP = 'setup'
+_WRITE = 'write'
+# Sent back data or None if the read timed out
+_READ = 'read'
+_SLEEP = 'sleep'
+# A downloaded session
+_OUTPUT = 'output'
 
 
-class DataLink(object):
+class BaseDataLink(object):
+    """Messages and control flow of the DataLink protocol.
+
+    Protocol steps are generators that yield (request, argument) pairs
+    of I/O they need (see _SETUP, _WRITE, _READ, _SLEEP) and are sent
+    results back. DataLink and AsyncDataLink only differ in how they
+    carry out these requests, so the protocol is written once.
+    """
+
+    _VENDOR_ID = 0x0DA4
+    _PRODUCT_ID = 0x0004
     _PAIRING_ID = (8, 8, 8, 8)
 
     _ENDPOINT_IN = 0x81
@@ -39,34 +74,234 @@ class DataLink(object):
 
     _ERROR_TIMEOUT_CODE = 110
 
-    def __init__(self):
+    _CONNECT_REQUESTS = ((0x01, 0x07), (0x01, 0x40, 0x01, 0x00, 0x51))
+    _WATCH_FOUND_RESPONSE = (0x04, 0x42, 0x20)
+    _SESSIONS_COUNT_RESPONSE = (0x04, 0x42, 0x3C)
+    _SESSION_SIZE_RESPONSE = (0x04, 0x42, 0x06)
+
+    def __init__(self, device=None, checkpoints=None):
         # Hardware ID
         self.hw_id = None
+        # USB device (pyusb or compatible), looked up on connect if not given
+        self.dev = device
+        # checkpoint.PartialDownloads to resume interrupted downloads
+        self.checkpoints = checkpoints
+
+    @classmethod
+    def find_devices(cls):
+        """Returns all connected DataLinks"""
+        return list(
+            usb.core.find(
+                find_all=True, idVendor=cls._VENDOR_ID, idProduct=cls._PRODUCT_ID
+            )
+        )
 
-    def __enter__(self):
-        return self
+    def _setup_device(self):
+        if self.dev is None:
+            self.dev = usb.core.find(
+                idVendor=self._VENDOR_ID, idProduct=self._PRODUCT_ID
+            )
+        if self.dev is None:
+            raise SyncError('Polar DataLink not found')
 
-    def __exit__(self, exc_type, exc_value, traceback):
-        if self.hw_id is not None:
-            self._disconnect()
+        try:
+            # is_kernel_driver_active raises NotImplementedError on Windows
+            if self.dev.is_kernel_driver_active(0):
+                self.dev.detach_kernel_driver(0)
+        except NotImplementedError:
+            pass
 
-    def synchronize(self):
-        self._connect()
+        self.dev.set_configuration()
+
+    def _disconnect_request_data(self):
+        return (0x01, 0x40, 0x04, 0x00, 0x54, *self.hw_id, 0xB7, 0x00, 0x00, 0x01)
+
+    def _handle_watch_found(self, data):
+        """Sets hardware ID if data says that the watch has been found."""
+        is_expected_data = self._is_ready(data) and starts_with(
+            data, self._WATCH_FOUND_RESPONSE
+        )
+        if is_expected_data:
+            self.hw_id = tuple(reversed(data[5:8]))
+
+        return is_expected_data
+
+    def _pair_request_data(self):
+        return (
+            0x01,
+            0x40,
+            0x06,
+            0x00,
+            0x54,
+            *self.hw_id,
+            0xB6,
+            0x00,
+            *self._PAIRING_ID,
+        )
+
+    def _is_paired(self, data):
+        # 04:42:03:00:40:b6:00:01 means that the paring
+        # has been finished successfully
+        return bool(data) and data[7] == 0x01
+
+    def _count_sessions_request_data(self):
+        return (0x01, 0x40, 0x02, 0x00, 0x54, *self.hw_id)
+
+    def _session_size_request_data(self, session_number):
+        return (
+            0x01,
+            0x40,
+            0x03,
+            0x00,
+            0x54,
+            *self.hw_id,
+            0xB2,
+            0x00,
+            session_number,
+        )
+
+    @classmethod
+    def packets_count(cls, size):
+        """Number of packets of a session of size bytes"""
+        return math.ceil(size / cls._SESSION_PACKET_WITHOUT_HEADER)
+
+    def _session_packets(self, size):
+        """Yields (bytes_received, bytes_to_read) for each packet of a session."""
+        # Session data will come in packets of packet_size size
+        packet_size = self._SESSION_PACKET_WITHOUT_HEADER
+        packets_count = self.packets_count(size)
+        tail_size = size % packet_size
+
+        for packet in range(packets_count):
+            is_last = packet + 1 == packets_count
+            bytes_received = packet * packet_size
+            bytes_to_read = tail_size if is_last and tail_size else packet_size
+
+            yield bytes_received, bytes_to_read
+
+    def _assemble_packet_request_data(
+        self, session_number, bytes_received, bytes_to_read
+    ):
+        return (
+            0x01,
+            0x40,
+            0x09,
+            0x00,
+            0x54,
+            *self.hw_id,
+            0xB3,
+            0x00,
+            session_number,
+            least_significant_byte(bytes_received),
+            most_significant_byte(bytes_received),
+            0x00,
+            0x00,
+            least_significant_byte(bytes_to_read),
+            most_significant_byte(bytes_to_read),
+        )
+
+    def _next_packets(self, size):
+        """Yields (index, (bytes_received, bytes_to_read)) of packets
+        after the first one."""
+        return itertools.islice(enumerate(self._session_packets(size)), 1, None)
+
+    def _first_packet_request(self, size):
+        """Returns (bytes_received, bytes_to_read) of the first packet of a session"""
+        return next(self._session_packets(size))
+
+    def _session_header(self, number, size, first_packet):
+        header = TrainingSession([first_packet])
+        return SessionHeader(
+            number,
+            size,
+            header.start_time,
+            header.duration,
+            header.has_hr,
+            header.has_gps,
+            header.info['hr_avg'] if header.has_hr else None,
+            first_packet,
+        )
+
+    def _restore_packets(self, number, size, first_packet):
+        """Returns {index: packet} of an interrupted download of the session."""
+        if self.checkpoints is None:
+            return {}
+
+        return self.checkpoints.restore(self.hw_id, number, size, first_packet)
+
+    def _checkpoint_packet(self, number, size, index, packet):
+        if self.checkpoints is not None:
+            self.checkpoints.append(self.hw_id, number, size, index, packet)
+
+    def _discard_checkpoint(self, number, size):
+        if self.checkpoints is not None:
+            self.checkpoints.discard(self.hw_id, number, size)
+
+    def _pad_write_data(self, data):
+        return bytes(data) + bytes(self._WRITE_DATA_LENGTH - len(data))
+
+    def _is_timeout(self, err):
+        return err.errno == self._ERROR_TIMEOUT_CODE
+
+    def _is_ready(self, data):
+        """Checks if data is ready to be processed."""
+        return len(data) == self._READ_DATA_LENGTH
+
+    # Protocol steps
+
+    def _synchronize(self):
+        yield from self._connect()
         to_stdout("Select 'Connect > Start synchronizing' from your watch\n")
 
-        watch = self._find_watch()
+        watch = yield from self._find_watch()
         if watch is None:
             raise SyncError('Watch not found')
 
-        paired = self._pair()
+        paired = yield from self._pair()
         if not paired:
             raise SyncError('Pairing failed')
 
-    @property
-    def sessions(self):
+    def _iter_sessions(self, include=None):
+        """Outputs raw sessions, see DataLink.read_sessions"""
         to_stdout('[sync] Loading training sessions')
 
-        session_count = self._count_sessions()
+        for num, size in enumerate((yield from self._session_sizes())):
+            first_packet = yield from self._read_packet(
+                num, *self._first_packet_request(size)
+            )
+            if first_packet is None:
+                report_warning(f"Can't read session #{num + 1}")
+                continue
+
+            if include is not None:
+                if not include(self._session_header(num, size, first_packet)):
+                    continue
+
+            session = yield from self._read_session(num, size, first_packet)
+            if session is None:
+                report_warning(f"Can't read session #{num + 1}")
+                continue
+
+            yield _OUTPUT, session
+
+    def _list_sessions(self):
+        to_stdout('[sync] Loading headers of training sessions')
+
+        headers = []
+        for num, size in enumerate((yield from self._session_sizes())):
+            packet = yield from self._read_packet(
+                num, *self._first_packet_request(size)
+            )
+            if packet is None:
+                report_warning(f"Can't read session #{num + 1}")
+                continue
+
+            headers.append(self._session_header(num, size, packet))
+
+        return headers
+
+    def _session_sizes(self):
+        session_count = yield from self._count_sessions()
         if session_count is None:
             raise SyncError('Failed to load training sessions')
 
@@ -75,58 +310,35 @@ class DataLink(object):
 
         session_sizes = []
         for num in range(session_count):
-            size = self._read_session_size(num)
+            size = yield from self._read_session_size(num)
             if size is None:
                 raise SyncError(f"Can't get a size of session #{num + 1}")
 
             session_sizes.append(size)
 
-        sessions = []
-        for num, size in enumerate(session_sizes):
-            session = self._read_session(num, size)
-            if session is None:
-                report_warning(f"Can't read session #{num + 1}")
-                continue
-
-            sessions.append(session)
-
-        return sessions
+        return session_sizes
 
     def _connect(self):
-        self.dev = usb.core.find(idVendor=0x0DA4, idProduct=0x0004)
-        if self.dev is None:
-            raise SyncError('Polar DataLink not found')
-
-        try:
-            # is_kernel_driver_active raises NotImplementedError on Windows
-            if self.dev.is_kernel_driver_active(0):
-                self.dev.detach_kernel_driver(0)
-        except NotImplementedError:
-            pass
-
-        self.dev.set_configuration()
+        yield _SETUP, None
 
-        time.sleep(0.4)
-        self._write((0x01, 0x07))
-        time.sleep(0.001)
-        self._write((0x01, 0x40, 0x01, 0x00, 0x51))
+        yield _SLEEP, 0.4
+        first, second = self._CONNECT_REQUESTS
+        yield from self._write(first)
+        yield _SLEEP, 0.001
+        yield from self._write(second)
 
     def _disconnect(self):
-        self._write((0x01, 0x40, 0x04, 0x00, 0x54, *self.hw_id, 0xB7, 0x00, 0x00, 0x01))
+        yield from self._write(self._disconnect_request_data())
 
     def _find_watch(self):
         to_stdout('[sync] Looking for the watch')
 
         for _ in range(self._FIND_ATTEMPTS):
-            data = self._read(timeout_sleep=5)
-            is_expected_data = self._is_ready(data) and starts_with(
-                data, (0x04, 0x42, 0x20)
-            )
-            if is_expected_data:
-                self.hw_id = tuple(reversed(data[5:8]))
+            data = yield from self._read(timeout_sleep=5)
+            if self._handle_watch_found(data):
                 break
 
-            time.sleep(0.001)
+            yield _SLEEP, 0.001
 
         return self.hw_id
 
@@ -135,152 +347,189 @@ class DataLink(object):
 
         # Send pairing request PAIR_WRITE_ATTEMPTS times
         for _ in range(self._PAIR_WRITE_ATTEMPTS):
-            self._write(
-                (
-                    0x01,
-                    0x40,
-                    0x06,
-                    0x00,
-                    0x54,
-                    *self.hw_id,
-                    0xB6,
-                    0x00,
-                    *self._PAIRING_ID,
-                )
-            )
+            yield from self._write(self._pair_request_data())
 
             data = None
             for _ in range(self._PAIR_READ_ATTEMPTS):
-                read_data = self._read(timeout_sleep=0)
+                read_data = yield from self._read(timeout_sleep=0)
                 if self._is_ready(read_data):
                     data = read_data
                     break
 
-                time.sleep(0.01)
+                yield _SLEEP, 0.01
 
-            # 04:42:03:00:40:b6:00:01 means that the paring
-            # has been finished successfully
-            if data and data[7] == 0x01:
+            if self._is_paired(data):
                 return True
 
-            time.sleep(3)
+            yield _SLEEP, 3
 
         return False
 
     def _count_sessions(self):
-        send_data = (0x01, 0x40, 0x02, 0x00, 0x54, *self.hw_id)
-        self._write(send_data)
+        send_data = self._count_sessions_request_data()
+        yield from self._write(send_data)
 
         for _ in range(self._GET_SESSIONS_COUNT_ATTEMPTS):
-            data = self._read_retry((0x04, 0x42, 0x3C), send_data)
+            data = yield from self._read_retry(self._SESSIONS_COUNT_RESPONSE, send_data)
             if data is not None:
                 return data[13]
 
         return None
 
     def _read_session_size(self, session_number):
-        send_data = (
-            0x01,
-            0x40,
-            0x03,
-            0x00,
-            0x54,
-            *self.hw_id,
-            0xB2,
-            0x00,
-            session_number,
-        )
-        self._write(send_data)
+        send_data = self._session_size_request_data(session_number)
+        yield from self._write(send_data)
 
         for _ in range(self._GET_SESSION_SIZE_ATTEMPTS):
-            data = self._read_retry((0x04, 0x42, 0x06), send_data)
+            data = yield from self._read_retry(self._SESSION_SIZE_RESPONSE, send_data)
             if data is not None:
                 return (data[8] << 8) + data[7]
 
-            time.sleep(0.001)
+            yield _SLEEP, 0.001
 
         return None
 
-    def _read_session(self, number, size):
-        # Session data will come in packets of packet_size size
-        packet_size = self._SESSION_PACKET_WITHOUT_HEADER
-        packets_count = math.ceil(size / packet_size)
-        tail_size = size % packet_size
-
-        session = []
-        for packet in range(packets_count):
-            is_last = packet + 1 == packets_count
-            bytes_received = packet * packet_size
-            bytes_to_read = tail_size if is_last and tail_size else packet_size
-
-            send_data = self._assemble_packet_request_data(
-                number, bytes_received, bytes_to_read
-            )
-            self._write(send_data)
-
-            for _ in range(self._GET_SESSION_ATTEMPTS):
-                read_data = self._read()
-                if self._is_ready(read_data):
-                    data = read_data
-                    break
+    def _read_session(self, number, size, first_packet):
+        """Downloads packets of a session that follow the first one"""
+        # The first packet tells if an earlier download can be resumed
+        restored = self._restore_packets(number, size, first_packet)
+        session = [first_packet]
+        for index, (bytes_received, bytes_to_read) in self._next_packets(size):
+            if index in restored:
+                session.append(restored[index])
+                continue
 
-                time.sleep(0.01)
-            else:
+            packet = yield from self._read_packet(number, bytes_received, bytes_to_read)
+            if packet is None:
                 return None
 
-            session.append(list(data))
+            self._checkpoint_packet(number, size, index, packet)
+            session.append(packet)
 
+        self._discard_checkpoint(number, size)
         return session
 
-    def _assemble_packet_request_data(
-        self, session_number, bytes_received, bytes_to_read
-    ):
-        return (
-            0x01,
-            0x40,
-            0x09,
-            0x00,
-            0x54,
-            *self.hw_id,
-            0xB3,
-            0x00,
-            session_number,
-            least_significant_byte(bytes_received),
-            most_significant_byte(bytes_received),
-            0x00,
-            0x00,
-            least_significant_byte(bytes_to_read),
-            most_significant_byte(bytes_to_read),
+    def _read_packet(self, number, bytes_received, bytes_to_read):
+        send_data = self._assemble_packet_request_data(
+            number, bytes_received, bytes_to_read
         )
+        yield from self._write(send_data)
+
+        for _ in range(self._GET_SESSION_ATTEMPTS):
+            data = yield from self._read()
+            if self._is_ready(data):
+                return list(data)
+
+            yield _SLEEP, 0.01
+
+        return None
 
     def _write(self, data):
-        data = bytes(data) + bytes(self._WRITE_DATA_LENGTH - len(data))
-        return self.dev.write(self._ENDPOINT_OUT, data, self._WRITE_TIMEOUT)
+        yield _WRITE, self._pad_write_data(data)
 
     def _read(self, timeout_sleep=0.5):
-        try:
-            return self.dev.read(
-                self._ENDPOINT_IN, self._READ_DATA_LENGTH, self._READ_TIMEOUT
-            )
-        except usb.core.USBError as err:
-            if err.errno != self._ERROR_TIMEOUT_CODE:
-                raise err
+        data = yield _READ, None
+        if data is None:
+            yield _SLEEP, timeout_sleep
+            return array.array('B')
 
-        time.sleep(timeout_sleep)
-        return array.array('B')
+        return data
 
     def _read_retry(self, expected_data, resend_data):
         """Read and retry a request if expected data was not received."""
-        data = self._read()
+        data = yield from self._read()
         if self._is_ready(data):
             if starts_with(data, expected_data):
                 return data
 
-            time.sleep(self._READ_RETRY_TIMEOUT)
-            self._write(resend_data)
+            yield _SLEEP, self._READ_RETRY_TIMEOUT
+            yield from self._write(resend_data)
 
         return None
 
-    def _is_ready(self, data):
-        """Checks if data is ready to be processed."""
-        return len(data) == self._READ_DATA_LENGTH
+    # Device calls of drivers
+
+    def _device_write(self, data):
+        return self.dev.write(self._ENDPOINT_OUT, data, self._WRITE_TIMEOUT)
+
+    def _device_read(self):
+        """Returns data or None on timeout"""
+        try:
+            return self.dev.read(
+                self._ENDPOINT_IN, self._READ_DATA_LENGTH, self._READ_TIMEOUT
+            )
+        except usb.core.USBError as err:
+            if not self._is_timeout(err):
+                raise err
+
+        return None
+
+
+class DataLink(BaseDataLink):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.hw_id is not None:
+            self._run(self._disconnect())
+
+    def synchronize(self):
+        self._run(self._synchronize())
+
+    @property
+    def sessions(self):
+        return self.read_sessions()
+
+    def read_sessions(self, include=None):
+        """Returns raw sessions on the watch.
+
+        include(SessionHeader) picks sessions to download, the rest
+        cost only their first packet (e.g. sessions out of a date range).
+        """
+        return list(self._outputs(self._iter_sessions(include)))
+
+    def list_sessions(self):
+        """Returns SessionHeader of each session on the watch.
+
+        Only the first packet of each session is downloaded, which is
+        enough to tell its start time, duration and what it recorded.
+        """
+        return self._run(self._list_sessions())
+
+    def _run(self, steps):
+        """Runs protocol steps, returns their result"""
+        result = None
+        while True:
+            try:
+                request, arg = steps.send(result)
+            except StopIteration as stop:
+                return stop.value
+
+            result = self._do(request, arg)
+
+    def _outputs(self, steps):
+        """Runs protocol steps, yields their outputs"""
+        result = None
+        while True:
+            try:
+                request, arg = steps.send(result)
+            except StopIteration:
+                return
+
+            if request == _OUTPUT:
+                result = None
+                yield arg
+            else:
+                result = self._do(request, arg)
+
+    def _do(self, request, arg):
+        if request == _SETUP:
+            return self._setup_device()
+        if request == _WRITE:
+            return self._device_write(arg)
+        if request == _READ:
+            return self._device_read()
+        if request == _SLEEP:
+            return time.sleep(arg)
+
+        raise ValueError(f'Unknown request {request}')
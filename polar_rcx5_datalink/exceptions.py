@@ -1,6 +1,3 @@
-from requests.exceptions import HTTPError
-
-
 class PolarDataLinkError(Exception):
     """An ambiguous error occurred."""
 
@@ -17,13 +14,20 @@ class ConverterError(PolarDataLinkError):
     """An error occurred while converting training session."""
 
 
-class StravaHTTPError(PolarDataLinkError, HTTPError):
-    """An HTTP error occurred."""
+_STRAVA_ERRORS = (
+    'StravaHTTPError',
+    'StravaUnauthorized',
+    'StravaActivityUploadError',
+    'StravaRateLimitExceeded',
+)
 
 
-class StravaUnauthorized(StravaHTTPError):
-    """An authorization is needed to upload training sessions to Strava."""
+def __getattr__(name):
+    # Strava errors are derived from requests' HTTPError. They live in
+    # strava_sync so that importing this module doesn't import requests.
+    if name in _STRAVA_ERRORS:
+        from .strava_sync import exceptions
 
+        return getattr(exceptions, name)
 
-class StravaActivityUploadError(StravaHTTPError):
-    """An HTTP error occurred while uploading training session to Strava."""
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,180 @@
+"""Geodesic distances of segments between samples and their cache.
+
+A geodesic on the ellipsoid depends on the latitudes of its ends and
+the difference of longitudes, not on the longitudes themselves. Deltas
+between samples are whole coordinate units (see parser.COORD_DELTA_TABLE),
+so segments of the same shape at about the same latitude share a key:
+
+    (latitude band, latitude delta, longitude delta)
+
+Sessions that are parsed again (exports, stats and reports of the same
+sessions, the daemon) hit the cache for all of their segments, repeated
+routes share some. Distances of a segment from anywhere in its band
+differ by less than lat_band * tan(latitude) radians relative to each
+other, that's 3e-5 at 60 degrees with the default band and far less for
+the distance of a whole session as errors of segments cancel out.
+
+    cache = GeodesicCache.load(path)
+    TrainingSession.distance_cache = cache
+    ...
+    cache.save(path)
+
+Worker processes get a copy of the cache and send back what they learn
+(see analytics.batch_stats).
+"""
+
+import collections
+import functools
+import json
+import os
+import threading
+
+# Degrees
+DEFAULT_LAT_BAND = 0.001
+DEFAULT_MAXSIZE = 65536
+# Coordinate units per degree (see parser.TrainingSession.COORD_COEFF)
+_UNITS = 600000
+
+
+@functools.lru_cache(maxsize=None)
+def _geopy_distance():
+    """Returns geopy's distance, imported on first use since geopy
+    is slow to import and only needed once samples are parsed"""
+    import geopy.distance
+
+    return geopy.distance.distance
+
+
+def geodesic_distance(coord1, coord2):
+    """Meters between (lat, lon) pairs"""
+    return _geopy_distance()(coord1, coord2).meters
+
+
+class GeodesicCache(object):
+    """LRU cache of geodesic distances of segments, see the module docstring"""
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE, lat_band=DEFAULT_LAT_BAND):
+        self.maxsize = maxsize
+        self.lat_band = lat_band
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        # [band, lat delta, lon delta, meters] computed since the last
+        # pop_learned, recorded in copies of the cache only
+        self._learned = None
+        # (hits, misses) reported by the last pop_learned
+        self._reported = (0, 0)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def key(self, coord1, coord2):
+        (lat1, lon1), (lat2, lon2) = coord1, coord2
+        return (
+            int(lat1 // self.lat_band),
+            round((lat2 - lat1) * _UNITS),
+            round((lon2 - lon1) * _UNITS),
+        )
+
+    def distance(self, coord1, coord2):
+        """Meters between (lat, lon) pairs, computed once per key"""
+        key = self.key(coord1, coord2)
+        with self._lock:
+            meters = self._entries.get(key)
+            if meters is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return meters
+
+        meters = geodesic_distance(coord1, coord2)
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = meters
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            if self._learned is not None:
+                self._learned.append([*key, meters])
+
+        return meters
+
+    def start_learning(self):
+        """Makes a copy of the cache (e.g. in a worker process) record
+        what it learns, see pop_learned"""
+        with self._lock:
+            self._learned = []
+            self._reported = (self.hits, self.misses)
+
+    def pop_learned(self):
+        """Returns (entries, hits, misses) since the last call"""
+        with self._lock:
+            reported_hits, reported_misses = self._reported
+            learned = (
+                self._learned,
+                self.hits - reported_hits,
+                self.misses - reported_misses,
+            )
+            self._learned = []
+            self._reported = (self.hits, self.misses)
+
+        return learned
+
+    def merge(self, learned):
+        """Adds what a copy of the cache has learned (see pop_learned)"""
+        entries, hits, misses = learned
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+            for band, lat_delta, lon_delta, meters in entries:
+                key = band, lat_delta, lon_delta
+                self._entries[key] = meters
+                self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    @classmethod
+    def load(cls, path, maxsize=DEFAULT_MAXSIZE, lat_band=DEFAULT_LAT_BAND):
+        """Returns a cache saved to path, an empty one if there is none
+        or it was saved with another lat_band."""
+        cache = cls(maxsize, lat_band)
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return cache
+
+        if data['lat_band'] == lat_band:
+            # Least recently used first, the newest are kept
+            for band, lat_delta, lon_delta, meters in data['entries'][-maxsize:]:
+                cache._entries[band, lat_delta, lon_delta] = meters
+
+        return cache
+
+    def save(self, path):
+        with self._lock:
+            data = {
+                'lat_band': self.lat_band,
+                'entries': [[*key, meters] for key, meters in self._entries.items()],
+            }
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+
+        os.replace(tmp_path, path)
@@ -0,0 +1,81 @@
+"""Synchronization of several watches through several DataLinks at once.
+
+Each DataLink gets its own sync worker (see AsyncDataLink) and all of them
+run concurrently. Sessions are passed to a callback together with the
+hardware ID of the watch they came from. Callbacks run in a thread pool
+so that exporting a session doesn't hold up transfers of other devices.
+"""
+
+import asyncio
+import time
+
+import usb.core
+
+from .async_datalink import AsyncDataLink
+from .exceptions import SyncError
+
+
+class DeviceStats(object):
+    """Transfer statistics of a sync worker"""
+
+    def __init__(self):
+        self.hw_id = None
+        self.sessions = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.error = None
+
+    @property
+    def throughput(self):
+        """Bytes per second"""
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+
+async def sync_device(device, on_session, checkpoints=None, include=None):
+    """Downloads sessions of a single DataLink.
+
+    on_session(hw_id, raw_session) is called in a thread for each
+    session as soon as it's downloaded, include picks sessions to download
+    (see AsyncDataLink.iter_sessions). Returns DeviceStats, errors of the
+    device and of on_session are stored there so that they don't affect
+    other workers.
+    """
+    loop = asyncio.get_running_loop()
+    stats = DeviceStats()
+    start = time.monotonic()
+    try:
+        async with AsyncDataLink(device, checkpoints) as dl:
+            await dl.synchronize()
+            stats.hw_id = dl.hw_id
+
+            async for session in dl.iter_sessions(include):
+                stats.sessions += 1
+                stats.bytes += sum(len(packet) for packet in session)
+                try:
+                    await loop.run_in_executor(None, on_session, dl.hw_id, session)
+                except Exception as err:
+                    stats.error = f"Can't handle session #{stats.sessions}: {err}"
+                    break
+    except (SyncError, usb.core.USBError) as err:
+        stats.error = str(err)
+    finally:
+        stats.seconds = time.monotonic() - start
+
+    return stats
+
+
+async def sync_devices(devices, on_session, checkpoints=None, include=None):
+    workers = (sync_device(dev, on_session, checkpoints, include) for dev in devices)
+    return await asyncio.gather(*workers)
+
+
+def sync_all(devices, on_session, checkpoints=None, include=None):
+    """Runs a sync worker per device and returns (stats, seconds).
+
+    stats is a list of DeviceStats in order of devices, seconds is
+    the wall time of the whole sync.
+    """
+    start = time.monotonic()
+    stats = asyncio.run(sync_devices(devices, on_session, checkpoints, include))
+
+    return stats, time.monotonic() - start
@@ -0,0 +1,111 @@
+"""Packed binary format of raw training sessions.
+
+A packed file starts with MAGIC and contains one or more sessions.
+Each session is a header (packets count and packet length as
+little-endian unsigned 32-bit integers) followed by its packets:
+
+    RCX5 | count length | packet ... packet | count length | packet ...
+
+Packed files are read through mmap. Sessions are lists of memoryview
+slices over it, so even huge archives aren't loaded into memory.
+A session knows its path and offset in the file, so that other
+processes can map it themselves rather than get a copy of it.
+"""
+
+import mmap
+import struct
+
+MAGIC = b'RCX5'
+SUFFIX = '.rcx5'
+
+_SESSION_HEADER = struct.Struct('<II')
+
+
+def is_packed(path):
+    return path.endswith(SUFFIX)
+
+
+def pack_session(raw_session):
+    """Returns raw session as packed bytes (without MAGIC)"""
+    packet_length = len(raw_session[0])
+    data = [_SESSION_HEADER.pack(len(raw_session), packet_length)]
+    for packet in raw_session:
+        if len(packet) != packet_length:
+            raise ValueError('All packets of a session must have the same length')
+
+        data.append(bytes(packet))
+
+    return b''.join(data)
+
+
+def write_sessions(f, raw_sessions):
+    """Writes raw sessions into a binary file object"""
+    f.write(MAGIC)
+    for raw_session in raw_sessions:
+        f.write(pack_session(raw_session))
+
+
+class PackedSession(list):
+    """Packets of a session at offset (of its header) in a packed file"""
+
+    def __init__(self, packets, path, offset):
+        super().__init__(packets)
+        self.path = path
+        self.offset = offset
+
+
+def read_sessions(path):
+    """Yields raw sessions of a packed file.
+
+    Each session is a PackedSession of memoryview slices (one per packet)
+    over the memory-mapped file. The mapping stays alive while
+    there are references to the slices.
+    """
+    view = _map(path)
+    if view is None:
+        return
+
+    if view[: len(MAGIC)] != MAGIC:
+        raise ValueError(f'{path} is not a packed training sessions file')
+
+    offset = len(MAGIC)
+    while offset < len(view):
+        raw_session = _read_session(view, path, offset)
+        yield raw_session
+        offset += _SESSION_HEADER.size + len(raw_session) * len(raw_session[0])
+
+
+def read_session(path, offset):
+    """Returns PackedSession at offset of a packed file"""
+    view = _map(path)
+    if view is None or view[: len(MAGIC)] != MAGIC:
+        raise ValueError(f'{path} is not a packed training sessions file')
+
+    return _read_session(view, path, offset)
+
+
+def _map(path):
+    """Returns memoryview of the memory-mapped file or None if it's empty"""
+    with open(path, 'rb') as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file can't be mapped
+            return None
+
+    return memoryview(buf)
+
+
+def _read_session(view, path, offset):
+    count, length = _SESSION_HEADER.unpack_from(view, offset)
+    start = offset + _SESSION_HEADER.size
+    # Sessions without packets or empty packets are never written
+    if count == 0 or length == 0:
+        raise ValueError(f'{path} is corrupted')
+
+    end = start + count * length
+    if end > len(view):
+        raise ValueError(f'{path} is truncated')
+
+    packets = (view[pos : pos + length] for pos in range(start, end, length))
+    return PackedSession(packets, path, offset)
@@ -1,13 +1,20 @@
+import array
 import datetime
 import re
 from collections import namedtuple
 from enum import Enum
 
-import geopy.distance
-
+import polar_rcx5_datalink.bits as bits
 import polar_rcx5_datalink.utils as utils
+from .bits import bcd_to_int
 from .exceptions import ParserError
-from .utils import bcd_to_int
+from .geodesic import geodesic_distance
+
+try:
+    # Optional compiled samples loop, see _iter_compiled_samples
+    from . import _decoder
+except ImportError:
+    _decoder = None
 
 
 class SampleFields(Enum):
@@ -37,6 +44,7 @@ class HRType(Enum):
 
 node_fields = [f.value for f in SampleFields if f != SampleFields.SATELLITES]
 Sample = namedtuple('Sample', node_fields, defaults=(None,) * len(node_fields))
+Coords = namedtuple('Coords', ['lon', 'lat'])
 
 
 class TrainingSession(object):
@@ -44,6 +52,10 @@ class TrainingSession(object):
     COORD_COEFF = 10 ** 4 / 6
     _PACKET_HEADER_LENGTH = 7
     _LAP_DATA_BITS_LENGTH = 416
+    # Samples decoded by a single call of the compiled loop
+    _COMPILED_CHUNK_SIZE = 4096
+    # Optional geodesic.GeodesicCache shared by all sessions
+    distance_cache = None
 
     def __init__(self, raw_session):
         self.raw = raw_session
@@ -52,6 +64,8 @@ class TrainingSession(object):
         self.has_gps = self.info['has_gps']
 
         self.id = None
+        # Timezone name based on the first coordinates
+        self.timezone = None
         # Timezone unaware datetime of the training session's start
         self.start_time = self._format_start_time()
         # UTC datetime of the training session's start
@@ -64,23 +78,33 @@ class TrainingSession(object):
         # Meters per second
         self.max_speed = 0
         self.samples = []
+        # array('q') of heart rates, filled for sessions with HR only
+        self.hr_samples = None
+        # Positions of samples in the recording if some of them
+        # have been dropped (see simplify.simplified_session)
+        self.sample_indexes = None
 
         # Set UTC start time based on local timezone since we
         # don't have any information about user's timezone
         self._set_start_utctime()
 
-        self._cursor = 0
-        # We need these variables to manipulate with cursor
-        # while parsing values that freeze
-        self._zero_delta_counter = {field: 0 for field in list(SampleFields)}
-        self._prefixless_zero_sat = False
+        self._reset_decoder()
 
-        self._samples_bits = self._get_samples_bits()
+        # Bits are loaded on demand so that sessions can be scanned
+        # without converting all of their packets
+        self._samples_bits = None
+        self._samples_parsed = False
 
-    def tobin(self):
+    def tobin(self, packets_count=None):
+        """Returns session's bytes as a string of bits.
+
+        Packets might be lists of ints or any bytes-like objects
+        (e.g. memoryview slices of a packed file). Set packets_count
+        to convert only the first packets.
+        """
         result = []
 
-        for index, packet in enumerate(self.raw):
+        for index, packet in enumerate(self.raw[:packets_count]):
             # Keep header of the first packet just for convenience of debugging
             start = 0 if index == 0 else self._PACKET_HEADER_LENGTH
             # Cut off useless trailing zero bytes
@@ -90,65 +114,232 @@ class TrainingSession(object):
             else:
                 packet = packet[start:-59]
 
-            result.append(''.join([utils.get_bin(byte, 8) for byte in packet]))
+            if len(packet):
+                result.append(
+                    utils.get_bin(int.from_bytes(packet, 'big'), len(packet) * 8)
+                )
 
         return ''.join(result)
 
+    def parse_samples(self):
+        """Parses periodic data recorded with fixed interval.
+
+        Samples are parsed once, subsequent calls do nothing.
+        """
+        if self._samples_parsed:
+            return
+
+        try:
+            self._load_samples_bits()
+            if self.has_hr and not self.has_gps:
+                self._parse_hr_samples()
+            else:
+                self._parse_samples()
+        except Exception as e:
+            raise ParserError(e)
+
+        self._samples_parsed = True
+
+    def iter_samples(self):
+        """Yields samples as they are decoded without keeping them.
+
+        Only the previous sample is held, distance and max_speed are
+        accumulated along the way. Samples decoded before an error are
+        yielded as usual, then ParserError is raised, so the valid prefix
+        of a corrupted session can still be used. Parsed samples
+        (see parse_samples) are yielded as they are.
+        """
+        if self._samples_parsed:
+            yield from self.samples
+            return
+
+        try:
+            self._load_samples_bits()
+            yield from self._iter_samples()
+        except Exception as e:
+            raise ParserError(e)
+
+    def sample_offset(self, index):
+        """Seconds from the start of the session to the sample at index"""
+        if self.sample_indexes is not None:
+            index = self.sample_indexes[index]
+
+        return self.info['sample_rate'] * index
+
+    def _load_samples_bits(self):
+        if self._samples_bits is None:
+            self._samples_bits = self._get_samples_bits()
+
+    def _reset_decoder(self):
+        self._cursor = 0
+        # We need these variables to manipulate with cursor
+        # while parsing values that freeze
+        self._zero_delta_counter = {field: 0 for field in list(SampleFields)}
+        self._prefixless_zero_sat = False
+        # The previous sample and its coordinates in nanodegrees
+        # (see coord_nanos), nothing else is needed to decode the next one
+        self._prev = None
+        self._coord_nanos = {SampleFields.LON: 0, SampleFields.LAT: 0}
+
+    def _parse_hr_samples(self):
+        """Parses samples of a session without gps data using decode_hr."""
+        self.hr_samples = decode_hr(self._samples_bits)
+        self.samples = [Sample(hr) for hr in self.hr_samples]
+        self._cursor = len(self._samples_bits)
+
     # TODO: Make it less error-prone.
     # This code is prone to critical errors since changing
     # settings in the watch (e.g. enabling automatic lap) might affect it.
-    def parse_samples(self):
-        """Parses periodic data recorded with fixed interval."""
-        try:
-            self.samples = [self._parse_first_sample()]
+    def _parse_samples(self):
+        """Generic parser of samples. Handles any combination of HR and gps."""
+        self.samples = []
+        # Samples decoded before an error are kept
+        self.samples.extend(self._iter_samples())
 
-            while (
-                self._cursor < len(self._samples_bits) and len(self._next_bits(7)) > 5
-            ):
-                hr = self._parse_hr() if self.has_hr else None
+    def _iter_samples(self):
+        """Generic decoder of samples, yields them one by one."""
+        self._reset_decoder()
+        self.distance = 0
+        self.max_speed = 0
+        self._prev = self._parse_first_sample()
+        yield self._prev
+
+        if _decoder is not None:
+            yield from self._iter_compiled_samples()
+
+        while self._cursor < len(self._samples_bits) and len(self._next_bits(7)) > 5:
+            hr = self._parse_hr() if self.has_hr else None
+
+            if not self.has_gps:
+                self._prev = Sample(hr)
+                yield self._prev
+                continue
+
+            # We won't use these values but instead calculate
+            # them using lat and lon
+            self._parse_speed()
+            self._parse_distance()
+
+            # 24 bits for lon and lat delta
+            # Example: 000001101001 (lon) 111111011010 (lat)
+            lon, lat = self._parse_coords()
+
+            # TODO: This code has to be tested on more samples
+            # to confirm the pattern.
+            if self._has_lap_data():
+                sat_after_lap = self._next_bits(9) == '0' * 9
+                if not sat_after_lap:
+                    self._parse_satellites()
 
-                if not self.has_gps:
-                    self.samples.append(Sample(hr))
-                    continue
+                self._cursor += self._LAP_DATA_BITS_LENGTH
 
-                # We won't use these values but instead calculate
-                # them using lat and lon
-                self._parse_speed()
-                self._parse_distance()
+                if sat_after_lap:
+                    self._parse_satellites()
+            else:
+                self._parse_satellites()
 
-                # 24 bits for lon and lat delta
-                # Example: 000001101001 (lon) 111111011010 (lat)
-                lon, lat = self._parse_coords()
+            # Skip undefined 10 bits
+            self._cursor += 10
 
-                # TODO: This code has to be tested on more samples
-                # to confirm the pattern.
-                if self._has_lap_data():
-                    sat_after_lap = self._next_bits(9) == '0' * 9
-                    if not sat_after_lap:
-                        self._parse_satellites()
+            self._prev = self._gps_sample(hr, lon, lat)
+            yield self._prev
 
-                    self._cursor += self._LAP_DATA_BITS_LENGTH
+    def _iter_compiled_samples(self):
+        """Decodes samples with the compiled loop (see _decoder.c).
 
-                    if sat_after_lap:
-                        self._parse_satellites()
+        HR and coordinates are decoded in chunks into preallocated
+        columns, the rest of samples is calculated here. Samples close
+        to the end of session are left to the generic loop, which goes
+        on from the same state.
+        """
+        size = self._COMPILED_CHUNK_SIZE
+        hr_column = array.array('q', bytes(8 * size))
+        lon_column = array.array('d', bytes(8 * size))
+        lat_column = array.array('d', bytes(8 * size))
+        prev = self._prev
+        state = (
+            *(self._zero_delta_counter[field] for field in SampleFields),
+            self._prefixless_zero_sat,
+            self._coord_nanos[SampleFields.LON],
+            self._coord_nanos[SampleFields.LAT],
+            prev.hr or 0,
+            prev.lon or 0.0,
+            prev.lat or 0.0,
+        )
+
+        count = size
+        while count == size:
+            count, self._cursor, state = _decoder.decode_samples(
+                self._samples_bits,
+                self._cursor,
+                self.has_hr,
+                self.has_gps,
+                state,
+                hr_column,
+                lon_column,
+                lat_column,
+            )
+
+            for field, zero_deltas in zip(SampleFields, state):
+                self._zero_delta_counter[field] = zero_deltas
+            self._prefixless_zero_sat = state[6]
+            self._coord_nanos[SampleFields.LON] = state[7]
+            self._coord_nanos[SampleFields.LAT] = state[8]
+
+            for index in range(count):
+                hr = hr_column[index] if self.has_hr else None
+                if self.has_gps:
+                    self._prev = self._gps_sample(
+                        hr, lon_column[index], lat_column[index]
+                    )
                 else:
-                    self._parse_satellites()
+                    self._prev = Sample(hr)
+                yield self._prev
 
-                # Skip undefined 10 bits
-                self._cursor += 10
+    def _gps_sample(self, hr, lon, lat):
+        """Returns the sample that follows the previous one,
+        accumulates distance and max speed."""
+        prev = self._prev_sample()
+        distance = self._calculate_distance((prev.lat, prev.lon), (lat, lon))
+        self.distance += distance
 
-                prev = self._prev_sample()
-                distance = self._calculate_distance((prev.lat, prev.lon), (lat, lon))
-                self.distance += distance
+        # Meteres per second
+        speed = distance / self.info['sample_rate']
+        if speed > self.max_speed:
+            self.max_speed = speed
 
-                # Meteres per second
-                speed = distance / self.info['sample_rate']
-                if speed > self.max_speed:
-                    self.max_speed = speed
+        return Sample(hr, lon, lat, distance, speed)
 
-                self.samples.append(Sample(hr, lon, lat, distance, speed))
-        except Exception as e:
-            raise ParserError(e)
+    def first_coords(self):
+        """Returns coordinates of the first sample without parsing samples.
+
+        Returns None if training session has no gps data.
+        """
+        if not self.has_gps:
+            return None
+
+        if self.samples:
+            first = self.samples[0]
+            return Coords(first.lon, first.lat)
+
+        # First coordinates are always in the first packet
+        bits = self._samples_bits
+        if bits is None:
+            bits = self._get_samples_bits(packets_count=1)
+
+        # See _parse_first_sample for the layout of these bits
+        cursor = 22
+        if self.has_hr:
+            _, _, offset = self._process_hr_bits(bits[cursor : cursor + 11])
+            cursor += offset
+
+        cursor += 45
+        return self._parse_first_coords(bits[cursor : cursor + 56])
+
+    def set_timezone(self, timezone):
+        """Sets timezone of the training session and updates its UTC start time."""
+        self.timezone = timezone
+        self._set_start_utctime(timezone)
 
     def _next_bits(self, length):
         return self._samples_bits[self._cursor : self._cursor + length]
@@ -212,30 +403,28 @@ class TrainingSession(object):
         )
 
     def _process_hr_bits(self, input_val):
-        val_type = HRType(input_val[0:2])
+        try:
+            val, val_type, end = HR_TABLE[input_val]
+        except KeyError:
+            # There might be less bits at the end of session
+            val, val_type, end = decode_hr_bits(input_val)
 
-        if self._is_frozen(SampleFields.HR) and val_type != HRType.FULL_WITH_PREFIX:
+        if self._is_frozen(SampleFields.HR) and val_type is not HRType.FULL_WITH_PREFIX:
             return 0, None, 1
 
-        type_offset_map = {
-            HRType.FULL_WITH_PREFIX: 3,
-            HRType.FULL_PREFIXLESS: 0,
-            HRType.POS_DELTA: 2,
-            HRType.NEG_DELTA: 2,
-        }
-        type_offset = type_offset_map[val_type]
-        end = 11 if val_type in (HRType.FULL_WITH_PREFIX, HRType.FULL_PREFIXLESS) else 6
-        val = input_val[type_offset:end]
+        return val, val_type, end
 
-        if len(val) < 4:
-            val = '{:<04s}'.format(val)
+    def _process_hr_bits_reference(self, input_val):
+        """Same as _process_hr_bits but without the lookup table.
 
-        if val_type == HRType.NEG_DELTA:
-            val = utils.twos_complement_to_int(val)
-        else:
-            val = int(val, 2)
+        Kept for differential testing.
+        """
+        val_type = HRType(input_val[0:2])
 
-        return val, val_type, end
+        if self._is_frozen(SampleFields.HR) and val_type != HRType.FULL_WITH_PREFIX:
+            return 0, None, 1
+
+        return decode_hr_bits(input_val)
 
     def _is_frozen(self, field):
         """
@@ -265,13 +454,18 @@ class TrainingSession(object):
         return int(coord_int, 2) + self._format_coord_frac(coord_frac)
 
     def _format_coord_delta(self, val):
+        value = int(val, 2)
+        # There might be less than 12 bits at the end of session
         if val[:1] == '1':
-            val = utils.twos_complement_to_unsigned(val, 12)
+            value = bits.to_negative(value, 12)
 
-        return self._format_coord_frac(val)
+        return self._format_coord_frac(value)
 
     def _calculate_distance(self, coord1, coord2):
-        return geopy.distance.distance(coord1, coord2).meters
+        if self.distance_cache is not None:
+            return self.distance_cache.distance(coord1, coord2)
+
+        return geodesic_distance(coord1, coord2)
 
     def _parse_first_coords(self, data):
         """Returns initial coordinates.
@@ -293,13 +487,12 @@ class TrainingSession(object):
         lat_int = data[lon_end:lat_int_end]
         lat_frac = data[lat_int_end:lat_end]
 
-        Coords = namedtuple('Coords', ['lon', 'lat'])
         return Coords(
             self._format_coord(lon_int, lon_frac), self._format_coord(lat_int, lat_frac)
         )
 
     def _prev_sample(self, field=None):
-        sample = self.samples[-1]
+        sample = self._prev
         if field is None:
             return sample
 
@@ -311,7 +504,7 @@ class TrainingSession(object):
             self._cursor = 22
 
         if self.has_hr:
-            hr, _, offset = self._process_hr_bits(self._samples_bits[self._cursor :])
+            hr, _, offset = self._process_hr_bits(self._next_bits(11))
             self._cursor += offset
 
         if not self.has_gps:
@@ -333,11 +526,18 @@ class TrainingSession(object):
 
         # Next 56 bits contain first longitude and latitude
         coords_end = self._cursor + 56
-        coords = self._parse_first_coords(self._samples_bits[self._cursor : coords_end])
+        lon_nanos, lon = self._parse_full_coord(self._next_bits(28))
+        lat_nanos, lat = self._parse_full_coord(
+            self._samples_bits[self._cursor + 28 : coords_end]
+        )
+        self._coord_nanos[SampleFields.LON] = lon_nanos
+        self._coord_nanos[SampleFields.LAT] = lat_nanos
+        coords = Coords(lon, lat)
 
         # Set start time based on timezone of coordinates
-        timezone = utils.timezone_by_coords(coords.lat, coords.lon)
-        self._set_start_utctime(timezone)
+        # unless it has been resolved beforehand (see resolve_timezones)
+        if self.timezone is None:
+            self.set_timezone(utils.timezone_by_coords(coords.lat, coords.lon))
 
         self._cursor = coords_end
 
@@ -462,7 +662,57 @@ class TrainingSession(object):
 
         return (lon, lat)
 
+    def _parse_full_coord(self, bits):
+        """Returns (nanodegrees, degrees) of 8 bits of integer degrees
+        followed by 20 bits of fraction (see _parse_first_coords)."""
+        int_part = int(bits[:8], 2)
+        frac = coord_nanos(int(bits[8:], 2))
+
+        return int_part * 10 ** 9 + frac, int_part + frac / 10 ** 9
+
     def _parse_coord(self, coord_name):
+        """Parses 12 bits of delta or 28 bits of full value (when frozen).
+
+        Positions are accumulated in integer nanodegrees, which gives
+        the same values as rounding the sum of degrees to 9 digits
+        after every sample (see _parse_coord_reference).
+        """
+        raw_value = self._next_bits(12)
+        nanos = self._coord_nanos[coord_name]
+
+        if self._is_frozen(coord_name):
+            full_nanos, full_value = self._parse_full_coord(
+                self._samples_bits[self._cursor : self._cursor + 28]
+            )
+            if int(full_value) == int(nanos / 10 ** 9):
+                self._coord_nanos[coord_name] = full_nanos
+                self._reset_zero_delta_counter(coord_name)
+                self._cursor += 28
+                return full_value
+
+            self._handle_delta(coord_name, self._coord_delta(raw_value))
+            return nanos / 10 ** 9
+
+        delta = self._coord_delta(raw_value)
+        self._handle_delta(coord_name, delta)
+        nanos += delta
+        self._coord_nanos[coord_name] = nanos
+        self._cursor += 12
+
+        return nanos / 10 ** 9
+
+    def _coord_delta(self, bits):
+        try:
+            return COORD_DELTA_TABLE[bits]
+        except KeyError:
+            # There might be less bits at the end of session
+            return round(self._format_coord_delta(bits) * 10 ** 9)
+
+    def _parse_coord_reference(self, coord_name):
+        """Same as _parse_coord but with float arithmetic on bit strings.
+
+        Kept for differential testing.
+        """
         offset = 12
         raw_value = self._next_bits(offset)
 
@@ -494,7 +744,10 @@ class TrainingSession(object):
 
         self._cursor += offset
 
-        return value if is_full else round(prev + value, 9)
+        value = value if is_full else round(prev + value, 9)
+        self._coord_nanos[coord_name] = round(value * 10 ** 9)
+
+        return value
 
     # TODO: Seems like there is a lot of edge cases that may lead to errors.
     # Figure them out and handle. For now it covers most common cases.
@@ -599,11 +852,161 @@ class TrainingSession(object):
         pat = f'.{{250,290}}{lon}.{{24}}{lat}'
         return re.match(pat, self._next_bits(self._LAP_DATA_BITS_LENGTH)) is not None
 
-    def _get_samples_bits(self):
+    def _get_samples_bits(self, packets_count=None):
         """Returns bits with session's samples.
 
         Session's samples start at the 349th byte (if session has gps data)
         or at 351th (without gps data).
         """
         start = 349 if self.has_gps else 351
-        return self.tobin()[start * 8 :]
+        return self.tobin(packets_count)[start * 8 :]
+
+
+_HR_TYPE_OFFSETS = {
+    HRType.FULL_WITH_PREFIX: 3,
+    HRType.FULL_PREFIXLESS: 0,
+    HRType.POS_DELTA: 2,
+    HRType.NEG_DELTA: 2,
+}
+
+
+def decode_hr_bits(input_val):
+    """Decodes HR value at the start of input_val.
+
+    Returns value (delta for delta types), its type and length in bits.
+    """
+    val_type = HRType(input_val[0:2])
+    type_offset = _HR_TYPE_OFFSETS[val_type]
+    end = 11 if val_type in (HRType.FULL_WITH_PREFIX, HRType.FULL_PREFIXLESS) else 6
+    val = input_val[type_offset:end]
+
+    if len(val) < 4:
+        val = '{:<04s}'.format(val)
+
+    if val_type == HRType.NEG_DELTA:
+        val = bits.to_negative(int(val, 2), 4)
+    else:
+        val = int(val, 2)
+
+    return val, val_type, end
+
+
+def _hr_table_entry(index):
+    """Same as decode_hr_bits for 11 bits given as an integer"""
+    prefix = index >> 9
+    if prefix == 0b01:
+        return index & 0xFF, HRType.FULL_WITH_PREFIX, 11
+    if prefix == 0b00:
+        return index, HRType.FULL_PREFIXLESS, 11
+
+    delta = (index >> 5) & 0xF
+    if prefix == 0b10:
+        return delta, HRType.POS_DELTA, 6
+
+    # 4-bit two's complement
+    return delta - 16, HRType.NEG_DELTA, 6
+
+
+# Decoded HR values indexed by the next 11 bits (the longest HR value).
+# One lookup replaces decode_hr_bits. Less bits might be left at the end
+# of session, those are decoded with decode_hr_bits.
+HR_TABLE = {utils.get_bin(i, 11): _hr_table_entry(i) for i in range(2 ** 11)}
+
+
+def decode_hr(bits):
+    """Decodes bits of a session with HR only into array of heart rates.
+
+    This is a specialised version of the generic samples loop
+    (see _process_hr_bits and _parse_hr) that doesn't build
+    intermediate objects. Follows the same rules including
+    the freeze of HR after two zero deltas in a row.
+    """
+    full_with_prefix = HRType.FULL_WITH_PREFIX
+    full_prefixless = HRType.FULL_PREFIXLESS
+    table = HR_TABLE
+
+    result = array.array('q')
+    length = len(bits)
+    cursor = 0
+    zero_deltas = 0
+    hr = 0
+    is_first = True
+
+    while is_first or length - cursor > 5:
+        try:
+            val, val_type, end = table[bits[cursor : cursor + 11]]
+        except KeyError:
+            val, val_type, end = decode_hr_bits(bits[cursor:])
+
+        if zero_deltas >= 2 and val_type is not full_with_prefix:
+            # Frozen value takes a single bit
+            cursor += 1
+            zero_deltas += 1
+        elif val_type is full_with_prefix or val_type is full_prefixless:
+            cursor += end
+            hr = val
+            zero_deltas = 0
+        else:
+            cursor += end
+            if is_first:
+                # First value is taken as is
+                hr = val
+            else:
+                hr += val
+                zero_deltas = zero_deltas + 1 if val == 0 else 0
+
+        result.append(hr)
+        is_first = False
+
+    return result
+
+
+def coord_nanos(units):
+    """Converts coordinate units (COORD_COEFF / 10 ** 9 degrees) to nanodegrees.
+
+    Same as round(units * COORD_COEFF / 10 ** 9, 9) * 10 ** 9 in integers.
+    A unit is 5000 / 3 nanodegrees, so there are no ties to round.
+    """
+    return (units * 10000 + 3) // 6
+
+
+# Nanodegrees of 12-bit two's complement coordinate deltas indexed by bits
+COORD_DELTA_TABLE = {
+    utils.get_bin(i, 12): coord_nanos(i - 4096 if i >= 2048 else i)
+    for i in range(2 ** 12)
+}
+
+
+def resolve_timezones(training_sessions, cache=None):
+    """Sets timezones of training sessions by their first coordinates.
+
+    Timezones of all sessions are resolved in a single pass so that
+    parsing samples doesn't have to look them up one session at a time.
+    Returns a dict that maps coordinates to timezone names, it can be
+    passed as cache to share results (e.g. with workers). Sessions whose
+    first coordinates can't be decoded are left to look up their timezone
+    when samples are parsed.
+    """
+    if cache is None:
+        cache = {}
+
+    with_gps = []
+    coords = []
+    for training_session in training_sessions:
+        if not training_session.has_gps:
+            continue
+
+        try:
+            first = training_session.first_coords()
+        except Exception:
+            continue
+
+        with_gps.append(training_session)
+        coords.append((first.lat, first.lon))
+
+    timezones = utils.timezones_by_coords(coords, cache)
+
+    for training_session, timezone in zip(with_gps, timezones):
+        training_session.set_timezone(timezone)
+
+    return cache
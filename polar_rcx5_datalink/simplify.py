@@ -0,0 +1,202 @@
+"""Simplification of GPS tracks and training sessions.
+
+Douglas-Peucker ranks every point of a track by the error its removal
+would introduce (importance). A track is simplified either to a
+tolerance in meters or to a number of points by keeping the most
+important points, so both come from the same ranking.
+
+Distances to a segment are computed with numpy if it's installed,
+which makes simplification cheaper than converting dropped samples.
+"""
+
+import array
+import copy
+import math
+
+# Mean Earth radius, meters
+EARTH_RADIUS = 6371008.8
+# Spans shorter than this are searched without numpy, it doesn't pay off
+_VECTORIZE_MIN_SPAN = 32
+
+
+def project(coords):
+    """Projects (lat, lon) pairs onto a plane, coordinates are in meters.
+
+    Equirectangular projection around the first point, accurate enough
+    for the extent of a training session.
+    """
+    if not coords:
+        return []
+
+    lat0 = math.radians(coords[0][0])
+    scale = math.pi / 180 * EARTH_RADIUS
+    x_scale = scale * math.cos(lat0)
+
+    return [(lon * x_scale, lat * scale) for lat, lon in coords]
+
+
+def segment_distance(point, start, end):
+    """Distance from a point to a segment"""
+    px, py = point
+    sx, sy = start
+    dx = end[0] - sx
+    dy = end[1] - sy
+
+    length_sq = dx * dx + dy * dy
+    if length_sq == 0:
+        return math.hypot(px - sx, py - sy)
+
+    t = max(0.0, min(1.0, ((px - sx) * dx + (py - sy) * dy) / length_sq))
+    return math.hypot(px - sx - t * dx, py - sy - t * dy)
+
+
+def douglas_peucker_importance(points):
+    """Returns Douglas-Peucker importance of each point.
+
+    Importance is the distance from a point to the segment it was split
+    off when the point was selected. It's capped by importance of the
+    enclosing split so that the ranking is consistent with the tolerance
+    based algorithm. First and last points are always kept.
+    """
+    count = len(points)
+    importance = [0.0] * count
+    if count == 0:
+        return importance
+
+    importance[0] = importance[-1] = math.inf
+    farthest = _farthest_finder(points)
+
+    stack = [(0, count - 1, math.inf)]
+    while stack:
+        first, last, parent = stack.pop()
+        if last - first < 2:
+            continue
+
+        index, max_dist = farthest(first, last)
+        max_dist = min(max_dist, parent)
+        importance[index] = max_dist
+        stack.append((first, index, max_dist))
+        stack.append((index, last, max_dist))
+
+    return importance
+
+
+def _farthest_finder(points):
+    """Returns farthest(first, last) -> (index, distance) of the point
+    between first and last that is the farthest from the segment they form.
+    """
+
+    def farthest_python(first, last):
+        start = points[first]
+        end = points[last]
+        index = first + 1
+        max_dist = -1.0
+        for i in range(first + 1, last):
+            dist = segment_distance(points[i], start, end)
+            if dist > max_dist:
+                index = i
+                max_dist = dist
+
+        return index, max_dist
+
+    try:
+        import numpy
+    except ImportError:
+        return farthest_python
+
+    xs, ys = numpy.array(points, dtype=float).T
+
+    def farthest(first, last):
+        if last - first < _VECTORIZE_MIN_SPAN:
+            return farthest_python(first, last)
+
+        sx, sy = xs[first], ys[first]
+        dx = xs[last] - sx
+        dy = ys[last] - sy
+        px = xs[first + 1 : last] - sx
+        py = ys[first + 1 : last] - sy
+
+        length_sq = dx * dx + dy * dy
+        if length_sq == 0:
+            dists = numpy.hypot(px, py)
+        else:
+            t = numpy.clip((px * dx + py * dy) / length_sq, 0.0, 1.0)
+            dists = numpy.hypot(px - t * dx, py - t * dy)
+
+        offset = int(dists.argmax())
+        return first + 1 + offset, float(dists[offset])
+
+    return farthest
+
+
+def simplify_coords(coords, tolerance=None, max_points=None):
+    """Returns indexes of (lat, lon) pairs kept by Douglas-Peucker.
+
+    tolerance is the maximal error in meters, max_points limits
+    the number of kept points. Either or both can be given.
+    """
+    importance = douglas_peucker_importance(project(coords))
+    indexes = range(len(coords))
+
+    if tolerance is not None:
+        indexes = [i for i in indexes if importance[i] > tolerance]
+
+    if max_points is not None and len(indexes) > max_points:
+        indexes = sorted(indexes, key=importance.__getitem__, reverse=True)
+        indexes = sorted(indexes[:max_points])
+
+    return list(indexes)
+
+
+def downsample_indexes(count, step):
+    """Returns indexes of every step-th of count items, the last one included"""
+    indexes = list(range(0, count, step))
+    if count and indexes[-1] != count - 1:
+        indexes.append(count - 1)
+
+    return indexes
+
+
+def simplified_session(training_session, tolerance=None, sample_rate=None):
+    """Returns a copy of a training session with fewer samples.
+
+    Samples are first downsampled to sample_rate (seconds), then the
+    track is simplified with Douglas-Peucker to tolerance (meters).
+    Kept samples keep their HR, take over distance of the dropped
+    samples before them and get the average speed over that distance.
+    """
+    training_session.parse_samples()
+    samples = training_session.samples
+    recorded_rate = training_session.info['sample_rate']
+
+    indexes = list(range(len(samples)))
+    if sample_rate is not None:
+        indexes = downsample_indexes(len(samples), max(sample_rate // recorded_rate, 1))
+
+    if tolerance is not None and training_session.has_gps:
+        coords = [(samples[i].lat, samples[i].lon) for i in indexes]
+        indexes = [indexes[i] for i in simplify_coords(coords, tolerance=tolerance)]
+
+    offset = training_session.sample_offset
+    result = copy.copy(training_session)
+    result.samples = []
+    prev = 0
+    for index in indexes:
+        sample = samples[index]
+        if training_session.has_gps and index > 0:
+            distance = sum(s.distance for s in samples[prev + 1 : index + 1])
+            speed = distance / (offset(index) - offset(prev))
+            sample = sample._replace(distance=distance, speed=speed)
+
+        result.samples.append(sample)
+        prev = index
+
+    if training_session.hr_samples is not None:
+        hr_samples = training_session.hr_samples
+        result.hr_samples = array.array(
+            hr_samples.typecode, (hr_samples[i] for i in indexes)
+        )
+
+    result.sample_indexes = [offset(i) // recorded_rate for i in indexes]
+
+    return result
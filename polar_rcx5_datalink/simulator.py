@@ -0,0 +1,117 @@
+"""Simulated Polar DataLink with a watch on the other side.
+
+SimulatedDevice mimics the pyusb device API used by DataLink
+(read, write, set_configuration, etc.) and answers requests of
+the DataLink protocol with given raw sessions. It is meant for tests
+and for running sync code without hardware.
+"""
+
+import array
+import collections
+
+import usb.core
+
+
+class SimulatedDevice(object):
+    PACKET_LENGTH = 512
+    _PACKET_PAYLOAD_LENGTH = 446
+    _TIMEOUT_ERRNO = 110
+
+    def __init__(
+        self,
+        raw_sessions,
+        hw_id=(0x12, 0x34, 0x56),
+        fail_after_packets=None,
+        tail_sizes=None,
+    ):
+        self.raw_sessions = list(raw_sessions)
+        # Hardware ID of the watch
+        self.hw_id = tuple(hw_id)
+        # {session number: bytes of its last packet} for sessions
+        # whose size isn't a multiple of the packet payload length
+        self.tail_sizes = tail_sizes or {}
+        # Simulates connection loss: session packets aren't
+        # sent anymore once this many have been sent
+        self.fail_after_packets = fail_after_packets
+        self.packets_sent = 0
+        self.paired = False
+        self.requests = []
+        self._responses = collections.deque()
+
+    # pyusb device API
+
+    def is_kernel_driver_active(self, interface):
+        return False
+
+    def detach_kernel_driver(self, interface):
+        pass
+
+    def set_configuration(self):
+        pass
+
+    def write(self, endpoint, data, timeout=None):
+        data = bytes(data)
+        self.requests.append(data)
+
+        response = self._respond(data)
+        if response is not None:
+            self._responses.append(self._packet(response))
+
+        return len(data)
+
+    def read(self, endpoint, size, timeout=None):
+        if self._responses:
+            return self._responses.popleft()
+
+        if not self.paired:
+            # Watch keeps announcing itself until paired
+            return self._packet((0x04, 0x42, 0x20, 0x00, 0x00, *reversed(self.hw_id)))
+
+        raise usb.core.USBError('Operation timed out', errno=self._TIMEOUT_ERRNO)
+
+    # Protocol
+
+    def session_size(self, number):
+        full_packets = len(self.raw_sessions[number])
+        tail_size = self.tail_sizes.get(number)
+        if tail_size is None:
+            return full_packets * self._PACKET_PAYLOAD_LENGTH
+
+        return (full_packets - 1) * self._PACKET_PAYLOAD_LENGTH + tail_size
+
+    def _respond(self, data):
+        if data[:2] != b'\x01\x40' or data[4] != 0x54:
+            return None
+
+        command = data[2]
+        if command == 0x06:
+            self.paired = True
+            return (0x04, 0x42, 0x03, 0x00, 0x40, 0xB6, 0x00, 0x01)
+
+        if command == 0x02:
+            count = [0] * 14
+            count[:3] = (0x04, 0x42, 0x3C)
+            count[13] = len(self.raw_sessions)
+            return count
+
+        if command == 0x03:
+            size = self.session_size(data[10])
+            return (0x04, 0x42, 0x06, 0x00, 0x00, 0x00, 0x00, size & 0xFF, size >> 8)
+
+        if command == 0x09:
+            if self.fail_after_packets is not None:
+                if self.packets_sent >= self.fail_after_packets:
+                    return None
+
+            self.packets_sent += 1
+            number = data[10]
+            bytes_received = data[11] + (data[12] << 8)
+            return self.raw_sessions[number][
+                bytes_received // self._PACKET_PAYLOAD_LENGTH
+            ]
+
+        return None
+
+    def _packet(self, data):
+        data = list(data)
+        return array.array('B', data + [0] * (self.PACKET_LENGTH - len(data)))
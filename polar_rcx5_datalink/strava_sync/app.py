@@ -5,13 +5,20 @@ import functools
 
 import click
 import requests
-import loguru
-from flask import Flask, flash, render_template, session, request, redirect, url_for
-
-from .uploader import upload_activity
-from polar_rcx5_datalink.converter import TCXConverter
-from polar_rcx5_datalink.exceptions import StravaActivityUploadError, ParserError
-from polar_rcx5_datalink.utils import report_error, report_warning
+from flask import (
+    Flask,
+    flash,
+    jsonify,
+    redirect,
+    render_template,
+    request,
+    session,
+    url_for,
+)
+
+from .jobs import JobQueue
+from .previews import Previews
+from polar_rcx5_datalink.utils import report_error
 
 STRAVA_OAUTH_URL = 'https://www.strava.com/oauth'
 SPORT_PROFILES = ('Other', 'Running', 'Biking')
@@ -41,60 +48,75 @@ def auth_url(client_id):
     return f'{STRAVA_OAUTH_URL}/authorize?{urllib.parse.urlencode(params)}'
 
 
-def run_app(host, port, client_id, client_secret, training_sessions):
+def create_app(client_id, client_secret, training_sessions, scheduler, previews=None):
+    """Creates the web UI.
+
+    Uploads go through scheduler.UploadScheduler,
+    previews is an optional previews.Previews.
+    """
     app = Flask(__name__)
     app.secret_key = b'cT![\x88\xd8JN1x{S\xb2\xc7]\x18'
+    jobs = JobQueue(scheduler)
+    # Stopped by run_app on shutdown
+    app.extensions['upload_jobs'] = jobs
 
     def authorized():
         return 'access_token' in session
 
-    def upload_training_sessions(ids):
-        selected = (ts for ts in training_sessions if ts.id in ids)
-        for training_session in selected:
-            ts_id = training_session.id
-            sport = request.form.get(f'sport-{ts_id}')
-
-            try:
-                converter = TCXConverter(training_session, sport)
-            except ParserError:
-                err_msg = f"Can't parse samples of session #{ts_id}"
-                loguru.logger.exception(err_msg)
-                report_warning(err_msg)
-                continue
-
-            try:
-                upload_activity(
-                    session['access_token'], converter.tostring(), external_id=ts_id
-                )
-            except StravaActivityUploadError as err:
-                # Hack to check if activity is a duplicate.
-                # In case if we don't want to interupt the flow because of it.
-                duplicate = 'duplicate' in str(err)
-                if not duplicate:
-                    report_warning(f"Can't upload training session {ts_id}. {err}")
-
-    @app.route('/', methods=['GET', 'POST'])
+    @app.route('/')
     def index():
         if not authorized():
             return redirect(url_for('authorization'))
 
-        if request.method == 'POST':
-            selected_ids = request.form.getlist('training_sessions')
-            if selected_ids:
-                upload_training_sessions(selected_ids)
-                flash('Activities have been successfully uploaded')
-            else:
-                flash('Please select training sessions you want to upload', 'error')
-
-            return redirect(url_for('index'))
+        ledger = scheduler.ledger
+        uploads = {}
+        if ledger is not None:
+            uploads = {ts.id: ledger.get(ts) for ts in training_sessions}
 
         return render_template(
             'index.html',
             sport_profiles=SPORT_PROFILES,
             default_sport=DEFAULT_SPORT,
             training_sessions=training_sessions,
+            uploads=uploads,
         )
 
+    @app.route('/jobs', methods=['POST'])
+    def create_job():
+        if not authorized():
+            return jsonify(error='Not authorized'), 401
+
+        selected_ids = request.form.getlist('training_sessions')
+        if not selected_ids:
+            return (
+                jsonify(error='Please select training sessions you want to upload'),
+                400,
+            )
+
+        uploads = [
+            (ts, request.form.get(f'sport-{ts.id}', DEFAULT_SPORT))
+            for ts in training_sessions
+            if ts.id in selected_ids
+        ]
+        job = jobs.submit(uploads, session['access_token'])
+
+        return jsonify(job.todict()), 202
+
+    @app.route('/jobs/<job_id>')
+    def job_status(job_id):
+        job = jobs.get(job_id)
+        if job is None:
+            return jsonify(error='Job not found'), 404
+
+        return jsonify(job.todict())
+
+    @app.route('/previews')
+    def session_previews():
+        if previews is None:
+            return jsonify(ready=True, previews={})
+
+        return jsonify(ready=previews.ready, previews=previews.todict())
+
     @app.route('/authorization', methods=['GET', 'POST'])
     def authorization():
         if authorized():
@@ -126,5 +148,35 @@ def run_app(host, port, client_id, client_secret, training_sessions):
 
         return redirect(url_for('authorization'))
 
+    return app
+
+
+def run_app(
+    host,
+    port,
+    client_id,
+    client_secret,
+    training_sessions,
+    scheduler,
+    previews_path=None,
+):
+    """Serves the web UI and opens it in a browser.
+
+    Previews of sessions are computed in the background and cached in
+    previews_path. Uses waitress if it's installed, otherwise
+    the threaded development server of Flask.
+    """
+    previews = Previews(training_sessions, previews_path)
+    previews.start()
+
+    app = create_app(client_id, client_secret, training_sessions, scheduler, previews)
     threading.Thread(target=functools.partial(open_browser, host, port)).start()
-    app.run(host=host, port=port)
+
+    try:
+        import waitress
+    except ImportError:
+        app.run(host=host, port=port, threaded=True)
+    else:
+        waitress.serve(app, host=host, port=port)
+    finally:
+        app.extensions['upload_jobs'].close()
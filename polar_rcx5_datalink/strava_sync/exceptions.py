@@ -0,0 +1,19 @@
+from requests.exceptions import HTTPError
+
+from polar_rcx5_datalink.exceptions import PolarDataLinkError
+
+
+class StravaHTTPError(PolarDataLinkError, HTTPError):
+    """An HTTP error occurred."""
+
+
+class StravaUnauthorized(StravaHTTPError):
+    """An authorization is needed to upload training sessions to Strava."""
+
+
+class StravaActivityUploadError(StravaHTTPError):
+    """An HTTP error occurred while uploading training session to Strava."""
+
+
+class StravaRateLimitExceeded(StravaActivityUploadError):
+    """Strava's rate limit has been exceeded, the request may be retried later."""
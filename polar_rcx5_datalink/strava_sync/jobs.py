@@ -0,0 +1,172 @@
+"""Background upload jobs of the web UI.
+
+Jobs run one at a time in a worker thread, so request handlers return
+right away and the page polls a job for progress. Between jobs the worker
+keeps uploading sessions that wait for rate limits.
+"""
+
+import queue
+import threading
+import time
+import uuid
+
+import requests
+
+from .exceptions import StravaUnauthorized
+from .scheduler import POLL_INTERVAL
+from polar_rcx5_datalink.exceptions import ParserError
+from polar_rcx5_datalink.utils import get_logger, report_error, report_warning
+
+# Statuses of a session in a job
+QUEUED = 'queued'
+UPLOADED = 'uploaded'
+# Waiting for Strava's rate limit
+WAITING = 'waiting'
+FAILED = 'failed'
+# Seconds between retries after network errors
+_RETRY_INTERVAL = 60
+# Seconds finished jobs are kept for the page to poll
+JOB_TTL = 60 * 60
+
+
+class UploadJob(object):
+    def __init__(self, uploads, token):
+        self.id = uuid.uuid4().hex
+        # [(training_session, sport)]
+        self.uploads = uploads
+        self.token = token
+        self.finished = False
+        # Clock time the job has finished at
+        self.finished_at = None
+        self.statuses = {ts.id: QUEUED for ts, _ in uploads}
+
+    @property
+    def done(self):
+        return sum(status != QUEUED for status in self.statuses.values())
+
+    def todict(self):
+        return {
+            'id': self.id,
+            'finished': self.finished,
+            'total': len(self.statuses),
+            'done': self.done,
+            'sessions': dict(self.statuses),
+        }
+
+
+class JobQueue(object):
+    """Runs upload jobs through scheduler.UploadScheduler in the background"""
+
+    def __init__(self, scheduler, clock=time.monotonic):
+        self.scheduler = scheduler
+        self.clock = clock
+        self.jobs = {}
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+        # Token of the latest job, waiting uploads are made with it
+        self._token = None
+        # Interrupts uploads of waiting sessions
+        self._wakeup = threading.Event()
+        self._closed = False
+
+    def submit(self, uploads, token):
+        """Queues [(training_session, sport)] for upload, returns UploadJob"""
+        job = UploadJob(uploads, token)
+        self._evict()
+        self.jobs[job.id] = job
+
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._work, daemon=True)
+                self._worker.start()
+
+        self._queue.put(job)
+        self._wakeup.set()
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def _evict(self):
+        """Forgets jobs that have finished more than JOB_TTL seconds ago"""
+        expired_at = self.clock() - JOB_TTL
+        self.jobs = {
+            job_id: job
+            for job_id, job in list(self.jobs.items())
+            if job.finished_at is None or job.finished_at > expired_at
+        }
+
+    def close(self):
+        """Stops the worker"""
+        self._closed = True
+        self._wakeup.set()
+
+    def _work(self):
+        while not self._closed:
+            try:
+                job = self._queue.get_nowait()
+            except queue.Empty:
+                self._upload_waiting()
+                continue
+
+            self._token = job.token
+            try:
+                self._run(job)
+            except Exception:
+                get_logger().exception(f'Upload job {job.id} failed')
+            finally:
+                job.finished_at = self.clock()
+                job.finished = True
+
+    def _upload_waiting(self):
+        """Uploads queued sessions as rate limits allow until there are
+        none left or the worker is woken up by a job or close. Uploads
+        Strava is processing are polled meanwhile."""
+        self._wakeup.clear()
+        if self._closed or not self._queue.empty():
+            return
+
+        try:
+            self.scheduler.drain(self._token, stop=self._wakeup)
+            self.scheduler.poll(self._token)
+        except StravaUnauthorized as err:
+            report_error(f'Uploads to Strava have been stopped. {err}')
+        except requests.RequestException:
+            get_logger().exception("Can't upload to Strava")
+            self._wakeup.wait(_RETRY_INTERVAL)
+            return
+
+        if self.scheduler.is_processing():
+            self._wakeup.wait(POLL_INTERVAL)
+        else:
+            self._wakeup.wait()
+
+    def _run(self, job):
+        scheduler = self.scheduler
+        for training_session, sport in job.uploads:
+            ts_id = training_session.id
+            try:
+                scheduler.submit(training_session, sport)
+                scheduler.drain(job.token, block=False)
+            except ParserError:
+                err_msg = f"Can't parse samples of session #{ts_id}"
+                get_logger().exception(err_msg)
+                report_warning(err_msg)
+                job.statuses[ts_id] = FAILED
+                continue
+            except requests.RequestException as err:
+                report_warning(f"Can't upload training session {ts_id}. {err}")
+
+            job.statuses[ts_id] = self._status(training_session)
+
+    def _status(self, training_session):
+        if self.scheduler.is_queued(training_session.id):
+            return WAITING
+
+        ledger = self.scheduler.ledger
+        if ledger is None or ledger.is_uploaded(training_session):
+            return UPLOADED
+
+        # Dropped by the scheduler
+        return FAILED
@@ -0,0 +1,108 @@
+import datetime
+import json
+import os
+import re
+import threading
+
+from polar_rcx5_datalink.utils import content_hash
+
+# Strava mentions the original activity in duplicate errors
+_DUPLICATE_ACTIVITY_RE = re.compile(r'activities/(\d+)')
+
+
+def duplicate_activity_id(err_msg):
+    """Returns ID of the activity a duplicate upload error refers to"""
+    match = _DUPLICATE_ACTIVITY_RE.search(err_msg)
+    return None if match is None else int(match.group(1))
+
+
+class UploadLedger(object):
+    """Local record of training sessions uploaded to Strava.
+
+    Entries are keyed by session ID and hold the content hash of the
+    session, so a session is considered uploaded only if it hasn't
+    changed since. It lets uploaders skip sessions before converting
+    them and the UI show upload status without asking Strava.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = self._load()
+
+    def get(self, training_session):
+        """Returns the entry of an uploaded session or None"""
+        entry = self._entries.get(training_session.id)
+        if entry is None or entry['hash'] != content_hash(training_session):
+            return None
+
+        return entry
+
+    def is_uploaded(self, training_session):
+        return self.get(training_session) is not None
+
+    def record(self, training_session, upload):
+        """Records a session uploaded as described by Strava's upload response"""
+        return self.record_upload(
+            training_session.id, content_hash(training_session), upload
+        )
+
+    def record_upload(self, session_id, session_hash, upload):
+        entry = {
+            'hash': session_hash,
+            'upload_id': upload.get('id'),
+            'activity_id': upload.get('activity_id'),
+            'uploaded_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        }
+        with self._lock:
+            self._entries[session_id] = entry
+            self._save()
+
+        return entry
+
+    def processing(self):
+        """Returns [(session_id, upload_id)] of uploads Strava hasn't
+        turned into activities yet"""
+        with self._lock:
+            return [
+                (session_id, entry['upload_id'])
+                for session_id, entry in self._entries.items()
+                if entry['activity_id'] is None and entry['upload_id'] is not None
+            ]
+
+    def update_upload(self, session_id, upload):
+        """Updates an entry with the upload status polled from Strava.
+
+        A processing error removes the entry, the session isn't uploaded
+        then. Returns False while the upload is being processed.
+        """
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return True
+
+            if upload.get('error'):
+                del self._entries[session_id]
+            elif upload.get('activity_id') is not None:
+                entry['activity_id'] = upload['activity_id']
+            else:
+                return False
+
+            self._save()
+
+        return True
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._entries, f, indent=2, sort_keys=True)
+
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,131 @@
+"""Lightweight summaries of training sessions for the web UI.
+
+A preview holds distance, duration, average and maximal HR and the
+track simplified to TRACK_POINTS points. Previews need fully parsed
+samples, so they are computed once in a background thread and cached
+on disk by content hash of a session.
+"""
+
+import json
+import os
+import threading
+
+from .ledger import content_hash
+from polar_rcx5_datalink.exceptions import ParserError
+from polar_rcx5_datalink.parser import TrainingSession
+from polar_rcx5_datalink.simplify import simplify_coords
+from polar_rcx5_datalink.utils import get_logger
+
+TRACK_POINTS = 200
+# Decimal places of coordinates, ~1 m
+_COORD_PRECISION = 5
+
+
+def session_preview(training_session, track_points=TRACK_POINTS):
+    """Returns preview of a training session as a JSON serializable dict"""
+    training_session.parse_samples()
+
+    coords = [
+        (sample.lat, sample.lon)
+        for sample in training_session.samples
+        if sample.lat is not None
+    ]
+    track = [
+        [round(coord, _COORD_PRECISION) for coord in coords[index]]
+        for index in simplify_coords(coords, max_points=track_points)
+    ]
+
+    info = training_session.info
+    has_hr = training_session.has_hr
+    return {
+        'distance': round(training_session.distance),
+        'duration': training_session.duration,
+        'hr_avg': info['hr_avg'] if has_hr else None,
+        'hr_max': info['hr_max'] if has_hr else None,
+        'track': track,
+    }
+
+
+class Previews(object):
+    """Previews of training sessions computed in the background.
+
+    previews = Previews(training_sessions, path)
+    previews.start()
+    previews.get(training_session.id)  # None until computed
+    """
+
+    _SUFFIX = '.json'
+
+    def __init__(self, training_sessions, path=None):
+        self.training_sessions = training_sessions
+        # Directory of cached previews, nothing is cached if None
+        self.path = path
+        self._previews = {}
+        self._thread = None
+
+    @property
+    def ready(self):
+        return len(self._previews) == len(self.training_sessions)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._compute_all, daemon=True)
+        self._thread.start()
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def get(self, session_id):
+        return self._previews.get(session_id)
+
+    def todict(self):
+        """Returns {session ID: preview or None if it's not computed yet}"""
+        return {ts.id: self._previews.get(ts.id) for ts in self.training_sessions}
+
+    def _compute_all(self):
+        for training_session in self.training_sessions:
+            self._previews[training_session.id] = self._preview(training_session)
+
+    def _preview(self, training_session):
+        session_hash = content_hash(training_session)
+        preview = self._load(session_hash)
+        if preview is not None:
+            return preview
+
+        # Sessions are shared with upload jobs, parse a copy of it
+        sess = TrainingSession(training_session.raw)
+        if training_session.timezone is not None:
+            sess.set_timezone(training_session.timezone)
+
+        try:
+            preview = session_preview(sess)
+        except ParserError:
+            err_msg = f"Can't parse samples of session #{training_session.id}"
+            get_logger().exception(err_msg)
+            return {'error': err_msg}
+
+        self._save(session_hash, preview)
+        return preview
+
+    def _filepath(self, session_hash):
+        return os.path.join(self.path, session_hash + self._SUFFIX)
+
+    def _load(self, session_hash):
+        if self.path is None:
+            return None
+
+        try:
+            with open(self._filepath(session_hash)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _save(self, session_hash, preview):
+        if self.path is None:
+            return
+
+        os.makedirs(self.path, exist_ok=True)
+        filepath = self._filepath(session_hash)
+        with open(filepath + '.tmp', 'w') as f:
+            json.dump(preview, f)
+
+        os.replace(filepath + '.tmp', filepath)
@@ -0,0 +1,403 @@
+"""Uploads to Strava at the rate Strava allows.
+
+Strava limits requests per 15 minutes and per day. Both windows are
+fixed: 15 minute windows start at 0, 15, 30 and 45 minutes of an hour
+and daily windows start at midnight UTC. Usage and limits are reported
+in every response:
+
+    X-RateLimit-Limit: 100,1000
+    X-RateLimit-Usage: 42,420
+
+UploadScheduler keeps a token bucket per window, synchronized with these
+headers, and an on-disk queue of uploads, so that a backlog of sessions
+drains as fast as allowed and survives restarts.
+
+Strava processes uploaded files asynchronously: an upload has no
+activity ID until it's processed. The scheduler polls uploads recorded
+in the ledger until Strava reports the activity or a processing error.
+"""
+
+import json
+import os
+import threading
+import time
+
+import requests
+
+from .exceptions import (
+    StravaActivityUploadError,
+    StravaRateLimitExceeded,
+    StravaUnauthorized,
+)
+from .ledger import content_hash, duplicate_activity_id
+from .uploader import STRAVA_API_URL, get_upload, upload_activity
+from polar_rcx5_datalink.converter import TCXConverter
+from polar_rcx5_datalink.utils import get_logger, report_error, report_warning
+
+# Seconds
+FIFTEEN_MINUTES = 15 * 60
+DAY = 24 * 60 * 60
+# Default limits of a Strava application per window
+DEFAULT_LIMITS = (100, 1000)
+# Seconds between retries after network errors
+_RETRY_INTERVAL = 60
+# Seconds between polls of uploads Strava is processing
+POLL_INTERVAL = 5
+
+
+def is_permanent_error(err):
+    """True if retrying a request that failed with err won't help"""
+    status = err.response.status_code
+    return 400 <= status < 500 and status not in (408, 429)
+
+
+class TokenBucket(object):
+    """Requests left in a fixed window of a rate limit"""
+
+    def __init__(self, capacity, window, clock=time.time):
+        self.capacity = capacity
+        self.window = window
+        self.clock = clock
+        self.tokens = capacity
+        self.reset_at = self._next_window()
+
+    def update(self, limit, usage):
+        """Synchronizes the bucket with usage reported by Strava"""
+        self._refill()
+        self.capacity = limit
+        self.tokens = max(limit - usage, 0)
+
+    def exhaust(self):
+        self._refill()
+        self.tokens = 0
+
+    def wait_time(self):
+        """Seconds till a token is available"""
+        self._refill()
+        return 0 if self.tokens > 0 else self.reset_at - self.clock()
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    def _refill(self):
+        if self.clock() >= self.reset_at:
+            self.tokens = self.capacity
+            self.reset_at = self._next_window()
+
+    def _next_window(self):
+        now = self.clock()
+        return now - now % self.window + self.window
+
+
+class RateLimits(object):
+    """Token buckets of the 15 minute and daily windows"""
+
+    def __init__(self, limits=DEFAULT_LIMITS, clock=time.time):
+        short_limit, daily_limit = limits
+        self.buckets = (
+            TokenBucket(short_limit, FIFTEEN_MINUTES, clock),
+            TokenBucket(daily_limit, DAY, clock),
+        )
+
+    def update(self, headers):
+        """Synchronizes buckets with X-RateLimit-* response headers"""
+        limits = headers.get('X-RateLimit-Limit')
+        usage = headers.get('X-RateLimit-Usage')
+        if limits is None or usage is None:
+            return
+
+        limits = [int(val) for val in limits.split(',')]
+        usage = [int(val) for val in usage.split(',')]
+        for bucket, limit, used in zip(self.buckets, limits, usage):
+            bucket.update(limit, used)
+
+    def exhaust(self):
+        """Makes the next request wait for the next 15 minute window"""
+        self.buckets[0].exhaust()
+
+    def acquire(self):
+        """Takes a token from every bucket.
+
+        Returns 0 on success, otherwise seconds to wait before trying again.
+        """
+        wait_time = max(bucket.wait_time() for bucket in self.buckets)
+        if wait_time > 0:
+            return wait_time
+
+        for bucket in self.buckets:
+            bucket.take()
+
+        return 0
+
+
+class UploadQueue(object):
+    """On-disk FIFO of uploads, a JSON file per upload"""
+
+    _SUFFIX = '.json'
+    # Subdirectory of uploads Strava has rejected, kept for inspection
+    FAILED_DIR = 'failed'
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._counter = 0
+        # Session IDs of uploads by name, files are read once to build it
+        self._session_ids = None
+
+    def __len__(self):
+        return len(self._names())
+
+    def __contains__(self, session_id):
+        """True if an upload of session_id is queued"""
+        with self._lock:
+            return session_id in self._index().values()
+
+    def put(self, item):
+        os.makedirs(self.path, exist_ok=True)
+        with self._lock:
+            self._counter += 1
+            # Names sort in order of submission
+            name = f'{time.time_ns():020d}-{self._counter:06d}{self._SUFFIX}'
+
+        filepath = os.path.join(self.path, name)
+        with open(filepath + '.tmp', 'w') as f:
+            json.dump(item, f)
+
+        os.replace(filepath + '.tmp', filepath)
+        with self._lock:
+            self._index()[name] = item.get('session_id')
+
+    def peek(self):
+        """Returns (name, item) of the oldest upload or None"""
+        names = self._names()
+        if not names:
+            return None
+
+        with open(os.path.join(self.path, names[0])) as f:
+            return names[0], json.load(f)
+
+    def remove(self, name):
+        os.remove(os.path.join(self.path, name))
+        with self._lock:
+            self._index().pop(name, None)
+
+    def fail(self, name, error):
+        """Moves an upload that can't be made to FAILED_DIR along with the error"""
+        filepath = os.path.join(self.path, name)
+        with open(filepath) as f:
+            item = json.load(f)
+
+        failed_path = os.path.join(self.path, self.FAILED_DIR)
+        os.makedirs(failed_path, exist_ok=True)
+        failed_filepath = os.path.join(failed_path, name)
+        with open(failed_filepath + '.tmp', 'w') as f:
+            json.dump({**item, 'error': error}, f)
+
+        os.replace(failed_filepath + '.tmp', failed_filepath)
+        self.remove(name)
+
+    def items(self):
+        for name in self._names():
+            with open(os.path.join(self.path, name)) as f:
+                yield json.load(f)
+
+    def _index(self):
+        if self._session_ids is None:
+            self._session_ids = {}
+            for name in self._names():
+                with open(os.path.join(self.path, name)) as f:
+                    self._session_ids[name] = json.load(f).get('session_id')
+
+        return self._session_ids
+
+    def _names(self):
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return []
+
+        return sorted(name for name in names if name.endswith(self._SUFFIX))
+
+
+class UploadScheduler(object):
+    """Queues training sessions and uploads them within rate limits.
+
+    scheduler = UploadScheduler(UploadQueue(path), ledger)
+    scheduler.submit(training_session)
+    scheduler.drain(token)
+    """
+
+    def __init__(
+        self,
+        queue,
+        ledger=None,
+        rate_limits=None,
+        api_url=STRAVA_API_URL,
+        simplifier=None,
+    ):
+        self.queue = queue
+        # ledger.UploadLedger of uploaded sessions
+        self.ledger = ledger
+        self.rate_limits = rate_limits or RateLimits()
+        self.api_url = api_url
+        # Applied to sessions before conversion, see simplify.simplified_session
+        self.simplifier = simplifier
+        self._submitted = threading.Event()
+
+    def submit(self, training_session, sport='Other'):
+        """Queues a session, returns False if it's uploaded or queued already."""
+        if self.ledger is not None and self.ledger.is_uploaded(training_session):
+            return False
+
+        if self.is_queued(training_session.id):
+            return False
+
+        simplified = training_session
+        if self.simplifier is not None:
+            simplified = self.simplifier(training_session)
+
+        tcx = TCXConverter(simplified, sport).tostring()
+        self.queue.put(
+            {
+                'session_id': training_session.id,
+                'hash': content_hash(training_session),
+                'tcx': tcx.decode(),
+            }
+        )
+        self._submitted.set()
+
+        return True
+
+    def is_queued(self, session_id):
+        return session_id in self.queue
+
+    def drain(self, token, block=True, stop=None):
+        """Uploads queued sessions, returns the number taken off the queue.
+
+        Waits for rate limits to allow the next upload if block is True,
+        otherwise returns as soon as the limit is reached. Waiting is
+        cut short by setting the stop event. Uploads rejected by Strava
+        are moved to the queue's FAILED_DIR. Network and server errors
+        are raised and the upload stays queued.
+        """
+        done = 0
+        while True:
+            entry = self.queue.peek()
+            if entry is None:
+                return done
+
+            wait_time = self.rate_limits.acquire()
+            if wait_time > 0:
+                if not block or self._wait(wait_time, stop):
+                    return done
+
+                continue
+
+            name, item = entry
+            try:
+                uploaded = self._upload(token, item)
+            except StravaActivityUploadError as err:
+                if not is_permanent_error(err):
+                    raise
+
+                session_id = item['session_id']
+                report_warning(f"Can't upload training session {session_id}. {err}")
+                self.queue.fail(name, str(err))
+                done += 1
+                continue
+
+            if uploaded:
+                done += 1
+                self.queue.remove(name)
+
+    def poll(self, token):
+        """Checks uploads Strava is processing as rate limits allow,
+        returns the number of them that are done.
+
+        Activity IDs are recorded in the ledger, uploads Strava has
+        failed to process are removed from it.
+        """
+        if self.ledger is None:
+            return 0
+
+        done = 0
+        for session_id, upload_id in self.ledger.processing():
+            if self.rate_limits.acquire() > 0:
+                break
+
+            try:
+                upload = get_upload(
+                    token, upload_id, api_url=self.api_url, rate_limits=self.rate_limits
+                )
+            except StravaRateLimitExceeded:
+                self.rate_limits.exhaust()
+                break
+
+            error = upload.get('error')
+            if error and 'duplicate' in error:
+                upload = {'activity_id': duplicate_activity_id(error)}
+            elif error:
+                report_warning(
+                    f"Strava can't process training session {session_id}. {error}"
+                )
+
+            if self.ledger.update_upload(session_id, upload):
+                done += 1
+
+        return done
+
+    def is_processing(self):
+        """True if Strava hasn't processed some of the uploads yet"""
+        return self.ledger is not None and bool(self.ledger.processing())
+
+    def serve(self, token, stop):
+        """Keeps draining the queue and polling uploads until the stop
+        event is set."""
+        while not stop.is_set():
+            try:
+                self.drain(token, stop=stop)
+                self.poll(token)
+            except StravaUnauthorized as err:
+                report_error(f'Uploads to Strava have been stopped. {err}')
+                return
+            except requests.RequestException:
+                get_logger().exception("Can't upload to Strava")
+
+            interval = POLL_INTERVAL if self.is_processing() else _RETRY_INTERVAL
+            self._submitted.wait(interval)
+            self._submitted.clear()
+
+    def _upload(self, token, item):
+        """Returns False if the upload should be retried later"""
+        session_id = item['session_id']
+        try:
+            upload = upload_activity(
+                token,
+                item['tcx'].encode(),
+                api_url=self.api_url,
+                rate_limits=self.rate_limits,
+                external_id=session_id,
+            )
+        except StravaRateLimitExceeded:
+            # In case Strava hasn't reported usage along with the error
+            self.rate_limits.exhaust()
+            return False
+        except StravaActivityUploadError as err:
+            if 'duplicate' not in str(err):
+                raise
+
+            upload = {'activity_id': duplicate_activity_id(str(err))}
+
+        if self.ledger is not None:
+            self.ledger.record_upload(session_id, item['hash'], upload)
+
+        return True
+
+    def _wait(self, seconds, stop):
+        """Returns True if stopped while waiting"""
+        if stop is None:
+            time.sleep(seconds)
+            return False
+
+        return stop.wait(seconds)
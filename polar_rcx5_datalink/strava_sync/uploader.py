@@ -3,21 +3,49 @@ from io import BytesIO
 import requests
 from requests.exceptions import HTTPError
 
-from polar_rcx5_datalink.exceptions import StravaUnauthorized, StravaActivityUploadError
+from .exceptions import (
+    StravaUnauthorized,
+    StravaActivityUploadError,
+    StravaRateLimitExceeded,
+)
 
+STRAVA_API_URL = 'https://www.strava.com/api/v3'
 
-def upload_activity(token, tcx_as_bytestring, **kwargs):
-    """Uploads a new data file to create an activity from"""
-    url = 'https://www.strava.com/api/v3/uploads'
+
+def upload_activity(
+    token, tcx_as_bytestring, api_url=STRAVA_API_URL, rate_limits=None, **kwargs
+):
+    """Uploads a new data file to create an activity from.
+
+    rate_limits (see scheduler.RateLimits) is updated with
+    the usage reported by Strava, even for failed requests.
+    """
     activity_file = BytesIO(tcx_as_bytestring)
 
     resp = requests.post(
-        url,
+        f'{api_url}/uploads',
         files={'file': activity_file},
         headers={'Authorization': f'Bearer {token}'},
         data={'data_type': 'tcx', **kwargs},
     )
 
+    if rate_limits is not None:
+        rate_limits.update(resp.headers)
+
+    return handle_response(resp)
+
+
+def get_upload(token, upload_id, api_url=STRAVA_API_URL, rate_limits=None):
+    """Returns status of an upload, activity_id is set once Strava
+    has processed it and error if processing has failed."""
+    resp = requests.get(
+        f'{api_url}/uploads/{upload_id}',
+        headers={'Authorization': f'Bearer {token}'},
+    )
+
+    if rate_limits is not None:
+        rate_limits.update(resp.headers)
+
     return handle_response(resp)
 
 
@@ -32,6 +60,8 @@ def handle_response(resp):
 
         if err.response.status_code == 401:
             exc_class = StravaUnauthorized
+        elif err.response.status_code == 429:
+            exc_class = StravaRateLimitExceeded
         else:
             exc_class = StravaActivityUploadError
 
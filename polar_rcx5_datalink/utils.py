@@ -1,7 +1,24 @@
+import functools
+import hashlib
+import os
+import pathlib
+
 import click
-import pytz
-import tzlocal
-from timezonefinder import TimezoneFinder
+
+LOGS_PATH = os.path.join(
+    str(pathlib.Path.home()), 'Documents/rcx5' if os.name == 'nt' else '.rcx5'
+)
+
+log_config = {
+    'handlers': [
+        # {'sink': sys.stdout},
+        {
+            'sink': os.path.join(LOGS_PATH, 'error.log'),
+            'rotation': '100 MB',
+            'retention': '10 days',
+        }
+    ]
+}
 
 
 def to_stdout(message):
@@ -20,11 +37,41 @@ def report_warning(message):
     click.secho(f"{click.style('WARNING:', fg='yellow')} {message}")
 
 
+@functools.lru_cache(maxsize=None)
+def get_logger():
+    """Returns the error logger.
+
+    loguru is imported and configured on first use so that
+    short invocations don't pay for it.
+    """
+    import loguru
+
+    loguru.logger.configure(**log_config)
+    return loguru.logger
+
+
+def content_hash(training_session):
+    """SHA-1 of the raw session, tells apart sessions with the same id"""
+    return raw_content_hash(training_session.raw)
+
+
+def raw_content_hash(raw_session):
+    sha = hashlib.sha1()
+    for packet in raw_session:
+        sha.update(bytes(packet))
+
+    return sha.hexdigest()
+
+
 def get_bin(val, length=16):
     """16-bit binary reptesentation of val"""
     return format(val, 'b').zfill(length)
 
 
+# Bit helpers on strings. The bits module has their integer versions,
+# these are kept for compatibility.
+
+
 def bcd_to_int(input_val):
     """Converts Binary Coded Decimal to integer"""
     if isinstance(input_val, int):
@@ -45,6 +92,11 @@ def get_bin_slice(val, start=0, end=None):
     return int(byte_string[start:end], 2)
 
 
+def format_hw_id(hw_id):
+    """Hardware ID of the watch as a hex string"""
+    return ''.join(f'{byte:02x}' for byte in hw_id)
+
+
 def pop_zeroes(items):
     """Removes trailing zeros from a list"""
     index = next(i for i, v in enumerate(reversed(items)) if v != 0)
@@ -91,20 +143,67 @@ def twos_complement_to_unsigned(*args, **kwargs):
     return bin(twos_complement_to_int(*args, **kwargs))
 
 
+@functools.lru_cache(maxsize=None)
+def get_timezone_finder():
+    """Returns shared TimezoneFinder since it's expensive to create"""
+    from timezonefinder import TimezoneFinder
+
+    return TimezoneFinder()
+
+
+@functools.lru_cache(maxsize=None)
+def get_timezone(name):
+    import pytz
+
+    return pytz.timezone(name)
+
+
 def timezone_by_coords(lat, lng):
-    tf = TimezoneFinder()
-    timezone = tf.timezone_at(lat=lat, lng=lng)
-    if timezone is None:
-        timezone = str(tzlocal.get_localzone())
+    return timezones_by_coords([(lat, lng)])[0]
+
 
-    return timezone
+def timezones_by_coords(coords, cache=None):
+    """Returns timezone names for a sequence of (lat, lng) pairs.
+
+    Each distinct pair is looked up once with a shared finder.
+    Pass a dict as cache to reuse results between calls
+    (e.g. across workers); it is filled with new lookups.
+    """
+    import tzlocal
+
+    coords = list(coords)
+    if cache is None:
+        cache = {}
+
+    tf = None
+    local_timezone = None
+    for lat, lng in coords:
+        if (lat, lng) in cache:
+            continue
+
+        if tf is None:
+            tf = get_timezone_finder()
+
+        timezone = tf.timezone_at(lat=lat, lng=lng)
+        if timezone is None:
+            if local_timezone is None:
+                local_timezone = str(tzlocal.get_localzone())
+
+            timezone = local_timezone
+
+        cache[(lat, lng)] = timezone
+
+    return [cache[pair] for pair in coords]
 
 
 def datetime_to_utc(dt, timezone=None):
+    import pytz
+    import tzlocal
+
     if timezone is None:
         timezone = tzlocal.get_localzone()
     else:
-        timezone = pytz.timezone(timezone)
+        timezone = get_timezone(timezone)
 
     local_dt = timezone.localize(dt, is_dst=None)
 
@@ -4,7 +4,7 @@
 import io
 import os
 
-from setuptools import find_packages, setup
+from setuptools import Extension, find_packages, setup
 
 NAME = 'polar_rcx5_datalink'
 DESCRIPTION = 'Polar RCX5 training session exporter'
@@ -26,7 +26,16 @@ REQUIRED = [
     'tzlocal>=1.5.1',
 ]
 
-EXTRAS = {'dev': ['pytest']}
+EXTRAS = {'dev': ['pytest'], 'server': ['waitress'], 'analytics': ['numpy']}
+
+# Compiled samples loop, the pure Python one is used if it fails to build
+EXT_MODULES = [
+    Extension(
+        'polar_rcx5_datalink._decoder',
+        ['polar_rcx5_datalink/_decoder.c'],
+        optional=True,
+    )
+]
 
 here = os.path.abspath(os.path.dirname(__file__))
 
@@ -55,6 +64,7 @@ setup(
     url=URL,
     install_requires=REQUIRED,
     extras_require=EXTRAS,
+    ext_modules=EXT_MODULES,
     include_package_data=True,
     license='Unlicense',
     packages=find_packages(),
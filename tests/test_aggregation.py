@@ -0,0 +1,93 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+sys.path.insert(0, ROOT)
+
+from polar_rcx5_datalink.aggregation import (
+    MetricsStore,
+    aggregate,
+    metrics_key,
+    period_of,
+)
+
+
+def metrics(start_time, duration, hr_avg=None, load=0.0):
+    return {
+        'id': 1,
+        'start_time': start_time,
+        'duration': duration,
+        'distance': duration * 3.0,
+        'hr_avg': hr_avg,
+        'trimp': load,
+        'load': load,
+    }
+
+
+def test_period_of():
+    assert period_of('2019-01-01T10:00:00+03:00', 'month') == '2019-01'
+    assert period_of('2019-12-30T10:00:00+03:00', 'week') == '2020-W01'
+    assert period_of('2019-02-03T23:00:00', 'week') == '2019-W05'
+
+
+def test_aggregate():
+    sessions = [
+        metrics('2019-02-04T08:00:00', 3600, hr_avg=150, load=80),
+        metrics('2019-01-28T08:00:00', 1800, hr_avg=120, load=20),
+        metrics('2019-02-01T08:00:00', 600),
+        metrics('2019-02-03T08:00:00', 1800, hr_avg=180, load=50),
+    ]
+
+    weeks = aggregate(sessions, 'week')
+    assert [week['period'] for week in weeks] == ['2019-W05', '2019-W06']
+    assert weeks[0]['sessions'] == 3
+    assert weeks[0]['duration'] == 4200
+    assert weeks[0]['distance'] == 12600
+    assert weeks[0]['load'] == 70
+    assert weeks[0]['hr_avg'] == pytest.approx(150)
+
+    months = aggregate(sessions, 'month')
+    assert [month['sessions'] for month in months] == [1, 3]
+    assert aggregate([], 'month') == []
+    with pytest.raises(ValueError):
+        aggregate(sessions, 'year')
+
+
+def test_metrics_store(tmp_path, monkeypatch):
+    pytest.importorskip('numpy')
+    from polar_rcx5_datalink import analytics
+    from polar_rcx5_datalink.parser import TrainingSession
+    from test_parser import raw_sessions_with_expected_samples
+
+    sessions = [TrainingSession(rs) for rs, _ in raw_sessions_with_expected_samples()]
+    for sess in sessions:
+        sess.set_timezone('UTC')
+    broken = TrainingSession(sessions[0].raw[:1])
+    path = str(tmp_path / 'metrics.json')
+
+    store = MetricsStore(path)
+    assert store.update(sessions[:2] + [broken], workers=1) == 3
+    assert len(store.metrics()) == 2
+    assert store.key(broken) in store
+
+    parsed = []
+    batch_stats = analytics.batch_stats
+    monkeypatch.setattr(
+        analytics,
+        'batch_stats',
+        lambda tss, workers: parsed.extend(tss) or batch_stats(tss, workers),
+    )
+    store = MetricsStore(path)
+    assert store.update(sessions + [broken], workers=1) == 1
+    assert parsed == sessions[2:]
+
+    keys = [store.key(sess) for sess in sessions]
+    assert keys[0] == metrics_key(sessions[0].raw[0], len(sessions[0].raw))
+    assert len(store.metrics(keys, from_date=sessions[2].start_time)) == 1
+    totals = aggregate(store.metrics(keys), 'month')
+    assert sum(total['sessions'] for total in totals) == 3
+    assert sum(total['distance'] for total in totals) == pytest.approx(
+        sum(sess.distance for sess in sessions)
+    )
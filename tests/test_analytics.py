@@ -0,0 +1,132 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'devscripts'))
+
+numpy = pytest.importorskip('numpy')
+
+from polar_rcx5_datalink.analytics import (
+    batch_stats,
+    hr_stats,
+    session_columns,
+    session_stats,
+)
+from polar_rcx5_datalink.geodesic import GeodesicCache
+from polar_rcx5_datalink.parser import TrainingSession
+from polar_rcx5_datalink.simplify import simplified_session
+from synthetic_sessions import encode_hr, random_hr, raw_session
+from test_parser import raw_sessions_with_expected_samples
+
+
+@pytest.fixture
+def sessions():
+    result = [TrainingSession(rs) for rs, _ in raw_sessions_with_expected_samples()]
+    for sess in result:
+        sess.set_timezone('UTC')
+
+    return result
+
+
+def test_hr_stats():
+    time = numpy.arange(1.0, 7.0)
+    hr = numpy.array([100.0, 120.0, numpy.nan, 150.0, 170.0, 190.0])
+
+    stats = hr_stats(time, hr, hr_max=200, hr_rest=50, zones=(50, 60, 70, 80, 90))
+
+    assert stats['hr_avg'] == 146
+    assert stats['hr_max'] == 190
+    assert [zone['seconds'] for zone in stats['zones']] == [0, 1, 1, 1, 1, 1]
+    assert [zone['from_hr'] for zone in stats['zones']] == [0, 100, 120, 140, 160, 180]
+    # An hour at threshold HR
+    hour = numpy.arange(1.0, 3601.0)
+    threshold = hr_stats(hour, numpy.full(3600, 170.0), 200, 50, threshold_hr=170)
+    assert threshold['load'] == pytest.approx(100)
+    assert stats['trimp'] < threshold['trimp']
+
+
+def test_hr_only_session():
+    values = random_hr(3600)
+    sess = TrainingSession(raw_session(encode_hr(values), has_gps=False))
+
+    stats = session_stats(sess)
+
+    assert stats['duration'] == len(sess.samples)
+    assert stats['distance'] is None and stats['splits'] == []
+    assert sum(zone['seconds'] for zone in stats['hr']['zones']) == len(sess.samples)
+    assert stats['hr']['hr_max'] == max(sess.hr_samples)
+    assert [avg['speed_avg'] for avg in stats['rolling']] == [None] * 3
+
+
+def test_splits(sessions):
+    for sess in sessions:
+        stats = session_stats(sess, split='mile')
+        splits = stats['splits']
+
+        assert sum(s['distance'] for s in splits) == pytest.approx(stats['distance'])
+        assert sum(s['seconds'] for s in splits) == pytest.approx(stats['duration'])
+        assert all(s['distance'] == pytest.approx(1609.344) for s in splits[:-1])
+        assert stats['distance'] == pytest.approx(sess.distance)
+
+
+def test_simplified_session(sessions):
+    sess = sessions[0]
+    full = session_stats(sess)
+    simplified_sess = simplified_session(sess, tolerance=5)
+    simplified = session_stats(simplified_sess)
+
+    time, _, _ = session_columns(simplified_sess)
+    assert len(time) < len(sess.samples)
+    assert simplified['duration'] == full['duration']
+    assert simplified['distance'] == pytest.approx(full['distance'])
+    assert len(simplified['splits']) == len(full['splits'])
+
+
+def test_batch_stats(sessions):
+    assert batch_stats(sessions, workers=2) == batch_stats(sessions, workers=1)
+
+    broken = TrainingSession(sessions[0].raw[:1])
+    assert 'error' in batch_stats([broken], workers=1)[0]
+
+
+def test_batch_stats_of_packed_sessions(sessions, tmp_path, monkeypatch):
+    from polar_rcx5_datalink import analytics, packed
+
+    path = str(tmp_path / f'sessions{packed.SUFFIX}')
+    with open(path, 'wb') as f:
+        packed.write_sessions(f, [sess.raw for sess in sessions])
+    packed_sessions = [TrainingSession(rs) for rs in packed.read_sessions(path)]
+    for sess in packed_sessions:
+        sess.set_timezone('UTC')
+
+    # Workers get where sessions are in the file, not their packets
+    sent = []
+    portable = analytics._portable
+    monkeypatch.setattr(
+        analytics, '_portable', lambda rs: sent.append(portable(rs)) or sent[-1]
+    )
+    stats = batch_stats(packed_sessions, workers=2)
+    assert all(raw_session[0] == path for raw_session in sent)
+    assert stats == batch_stats(sessions, workers=1)
+
+
+def test_batch_stats_with_distance_cache(sessions, monkeypatch):
+    expected = batch_stats(sessions, workers=2)
+    cache = GeodesicCache()
+    monkeypatch.setattr(TrainingSession, 'distance_cache', cache)
+
+    # Distances computed by workers end up in the cache
+    stats = batch_stats(sessions, workers=2)
+    assert len(cache) > 0
+    assert cache.misses >= len(cache)
+    assert [s['distance'] for s in stats] == pytest.approx(
+        [s['distance'] for s in expected], rel=1e-5
+    )
+
+    misses = cache.misses
+    batch_stats(sessions, workers=2)
+    assert cache.misses == misses
+    assert cache.hits > 0
@@ -0,0 +1,68 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(os.path.dirname(__file__))))
+
+from polar_rcx5_datalink import packed
+from polar_rcx5_datalink.archive import SessionArchive, header_fingerprint
+from polar_rcx5_datalink.utils import raw_content_hash
+from test_parser import raw_sessions_with_expected_samples
+
+
+@pytest.fixture
+def export_dirs(tmp_path):
+    """Two exports sharing sessions, one of them packed"""
+    raw_sessions = [rs for rs, _ in raw_sessions_with_expected_samples()]
+
+    laptop1 = tmp_path / 'laptop1'
+    (laptop1 / 'old').mkdir(parents=True)
+    for num, rs in enumerate(raw_sessions[:2]):
+        (laptop1 / 'old' / f'{num}.json').write_text(json.dumps(rs))
+    # Interrupted download of the first session
+    (laptop1 / 'partial.json').write_text(json.dumps(raw_sessions[0][:-1]))
+    (laptop1 / 'notes.txt').write_text('not a session')
+
+    laptop2 = tmp_path / 'laptop2'
+    laptop2.mkdir()
+    with open(laptop2 / f'all{packed.SUFFIX}', 'wb') as f:
+        packed.write_sessions(f, raw_sessions)
+    (laptop2 / 'broken.json').write_text('{"not": "a session"}')
+
+    return raw_sessions, [str(laptop1), str(laptop2)]
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_import_dirs(tmp_path, export_dirs, workers):
+    raw_sessions, dirs = export_dirs
+    archive = SessionArchive(str(tmp_path / 'archive'))
+    errors = []
+
+    stats = archive.import_dirs(dirs, workers, on_error=errors.append)
+
+    assert stats.files == 5
+    assert (stats.sessions, stats.imported, stats.duplicates) == (6, 4, 2)
+    assert stats.errors == 1 and 'broken.json' in errors[0]
+    assert len(archive) == 4
+
+    for rs in raw_sessions:
+        session_hash = raw_content_hash(rs)
+        assert session_hash in archive
+        assert archive.raw_session(session_hash) == rs
+
+    fingerprint = header_fingerprint(raw_sessions[0])
+    assert archive.variants() == {
+        fingerprint: sorted(
+            [raw_content_hash(raw_sessions[0]), raw_content_hash(raw_sessions[0][:-1])]
+        )
+    }
+
+    # Index survives and everything is a duplicate the next time
+    archive = SessionArchive(str(tmp_path / 'archive'))
+    stats = archive.import_dirs(dirs, workers)
+    assert (stats.imported, stats.duplicates) == (0, 6)
+    assert sorted(os.listdir(archive.sessions_path)) == sorted(
+        f'{h}.json' for h in archive.entries()
+    )
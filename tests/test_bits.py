@@ -0,0 +1,51 @@
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(os.path.dirname(__file__))))
+
+from polar_rcx5_datalink import bits, utils
+
+# Exhaustive up to 16 bits and random wider numbers
+NUMBERS = list(range(2 ** 16))
+NUMBERS += random.Random(0).sample(range(2 ** 16, 2 ** 40), 500)
+
+
+def test_bytes():
+    for value in NUMBERS:
+        assert bits.most_significant_byte(value) == utils.most_significant_byte(value)
+        assert bits.least_significant_byte(value) == utils.least_significant_byte(value)
+
+
+@pytest.mark.parametrize(
+    'start,end', [(0, None), (0, 8), (-8, None), (3, 11), (5, -2), (-12, -4)]
+)
+def test_bin_slice(start, end):
+    for value in NUMBERS[::7]:
+        assert bits.bin_slice(value, start, end) == utils.get_bin_slice(
+            value, start, end
+        )
+
+
+def test_bcd_to_int():
+    for value in range(256):
+        assert bits.bcd_to_int(value) == utils.bcd_to_int(value)
+        assert bits.bcd_to_int(value) == utils.bcd_to_int(utils.get_bin(value, 8))
+
+
+@pytest.mark.parametrize('length', [4, 7, 8, 12])
+def test_twos_complement(length):
+    for value in range(-(2 ** (length - 1)), 2 ** (length - 1)):
+        unsigned = bits.to_unsigned(value, length)
+        assert utils.get_bin(unsigned, length) == utils.int_to_twos_complement(
+            value, length
+        )
+        assert bits.to_signed(unsigned, length) == value
+
+        if value < 0:
+            string = utils.get_bin(unsigned, length)
+            assert bits.to_negative(unsigned, length) == utils.twos_complement_to_int(
+                string, length
+            )
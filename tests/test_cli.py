@@ -0,0 +1,352 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+
+# Cumulative import time of the cli module, microseconds
+IMPORT_TIME_BUDGET = 150000
+HEAVY_MODULES = (
+    'flask',
+    'requests',
+    'geopy',
+    'timezonefinder',
+    'pytz',
+    'tzlocal',
+    'loguru',
+    'usb',
+)
+
+
+def importtime(module):
+    """Returns {module: cumulative import time} reported by `python -X importtime`"""
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=ROOT,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+
+    result = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        _, cumulative, name = line.split('|')
+        result[name.strip()] = int(cumulative)
+
+    return result
+
+
+def test_cli_doesnt_import_heavy_dependencies():
+    imported = importtime('polar_rcx5_datalink.cli')
+    top_level = {name.split('.')[0] for name in imported}
+
+    assert not top_level.intersection(HEAVY_MODULES)
+
+
+def test_cli_import_time_budget():
+    imported = importtime('polar_rcx5_datalink.cli')
+
+    assert imported['polar_rcx5_datalink.cli'] < IMPORT_TIME_BUDGET
+
+
+@pytest.mark.parametrize('file_format,files', (('raw', (2, 1)), ('packed', (1, 1))))
+def test_multisync(tmp_path, monkeypatch, file_format, files):
+    from click.testing import CliRunner
+
+    from polar_rcx5_datalink import cli
+    from polar_rcx5_datalink.datalink import DataLink
+    from polar_rcx5_datalink.simulator import SimulatedDevice
+    from test_parser import raw_sessions_with_expected_samples
+
+    first, second, third = [rs for rs, _ in raw_sessions_with_expected_samples()]
+    devices = [
+        SimulatedDevice([first, second], hw_id=(0x12, 0x34, 0x56)),
+        SimulatedDevice([third], hw_id=(0xAB, 0xCD, 0xEF)),
+    ]
+    monkeypatch.setattr(DataLink, 'find_devices', classmethod(lambda cls: devices))
+    monkeypatch.setattr(cli, 'PARTIAL_DOWNLOADS_PATH', str(tmp_path / 'partial'))
+
+    out = tmp_path / 'out'
+    out.mkdir()
+    result = CliRunner().invoke(
+        cli.cli, ['multisync', '-o', str(out), '-f', file_format]
+    )
+
+    assert result.exit_code == 0, result.output
+    assert 'Total:' in result.output
+    assert len(list((out / '123456').iterdir())) == files[0]
+    assert len(list((out / 'abcdef').iterdir())) == files[1]
+    exported = cli.raw_sessions_from_dir(str(out / '123456'))
+    assert [[list(p) for p in rs] for rs in exported] == [first, second]
+
+
+def test_export_simplified(tmp_path):
+    from click.testing import CliRunner
+
+    from polar_rcx5_datalink import cli
+    from test_parser import raw_sessions_with_expected_samples
+
+    sessions_dir = tmp_path / 'sessions'
+    sessions_dir.mkdir()
+    for num, (rs, _) in enumerate(raw_sessions_with_expected_samples()):
+        (sessions_dir / f'{num}.json').write_text(json.dumps(rs))
+
+    sizes = {}
+    for options in ([], ['--simplify', '5', '--downsample', '10']):
+        out = tmp_path / str(len(options))
+        out.mkdir()
+        result = CliRunner().invoke(
+            cli.cli, ['export', '-s', str(sessions_dir), '-o', str(out), *options]
+        )
+        assert result.exit_code == 0, result.output
+        sizes[len(options)] = {f.name: f.stat().st_size for f in out.iterdir()}
+
+    full, simplified = sizes.values()
+    assert full.keys() == simplified.keys()
+    assert all(simplified[name] < full[name] / 2 for name in full)
+
+
+def test_export_packed(tmp_path):
+    from click.testing import CliRunner
+
+    from polar_rcx5_datalink import cli
+    from test_parser import raw_sessions_with_expected_samples
+
+    raw_sessions = [rs for rs, _ in raw_sessions_with_expected_samples()]
+    sessions_dir = tmp_path / 'sessions'
+    sessions_dir.mkdir()
+    for num, rs in enumerate(raw_sessions):
+        (sessions_dir / f'{num}.json').write_text(json.dumps(rs))
+
+    out = tmp_path / 'out'
+    out.mkdir()
+    result = CliRunner().invoke(
+        cli.cli, ['export', '-s', str(sessions_dir), '-o', str(out), '-f', 'packed']
+    )
+
+    assert result.exit_code == 0, result.output
+    (packed_file,) = out.iterdir()
+    assert packed_file.name.count('T') == 2
+    exported = cli.raw_sessions_from_dir(str(out))
+    assert [[list(p) for p in rs] for rs in exported] == raw_sessions
+
+
+def test_stats(tmp_path):
+    from click.testing import CliRunner
+
+    from polar_rcx5_datalink import cli
+    from test_parser import raw_sessions_with_expected_samples
+
+    sessions_dir = tmp_path / 'sessions'
+    sessions_dir.mkdir()
+    raw_sessions = [rs for rs, _ in raw_sessions_with_expected_samples()]
+    for num, rs in enumerate(raw_sessions):
+        (sessions_dir / f'{num}.json').write_text(json.dumps(rs))
+
+    result = CliRunner().invoke(
+        cli.cli, ['stats', '-s', str(sessions_dir), '--split', 'mile', '-j', '1']
+    )
+
+    assert result.exit_code == 0, result.output
+    stats = json.loads(result.output)
+    assert len(stats) == len(raw_sessions)
+    assert all(sess['splits'] and sess['hr']['trimp'] > 0 for sess in stats)
+
+
+def test_report(tmp_path, monkeypatch):
+    from click.testing import CliRunner
+
+    from polar_rcx5_datalink import cli, parser
+    from test_parser import raw_sessions_with_expected_samples
+
+    sessions_dir = tmp_path / 'sessions'
+    sessions_dir.mkdir()
+    for num, (rs, _) in enumerate(raw_sessions_with_expected_samples()):
+        (sessions_dir / f'{num}.json').write_text(json.dumps(rs))
+    monkeypatch.setattr(cli, 'METRICS_PATH', str(tmp_path / 'metrics.json'))
+
+    args = ['report', '-s', str(sessions_dir), '--by', 'month', '-j', '1']
+    result = CliRunner().invoke(cli.cli, args)
+    assert result.exit_code == 0, result.output
+    assert '3 sessions, 3 parsed' in result.output
+
+    # Known sessions are neither parsed nor looked up
+    monkeypatch.setattr(parser, 'TrainingSession', None)
+    monkeypatch.setattr(parser, 'resolve_timezones', lambda batch, timezones: None)
+    result = CliRunner().invoke(cli.cli, args + ['--json'])
+    assert result.exit_code == 0, result.output
+    totals = json.loads(result.output)
+    assert sum(total['sessions'] for total in totals) == 3
+    assert (tmp_path / 'metrics.json').exists()
+
+
+def test_report_from_watch(tmp_path, monkeypatch):
+    from click.testing import CliRunner
+
+    from polar_rcx5_datalink import cli
+    from polar_rcx5_datalink.simulator import SimulatedDevice
+    from test_parser import raw_sessions_with_expected_samples
+
+    raw_sessions = [rs for rs, _ in raw_sessions_with_expected_samples()]
+    monkeypatch.setattr(cli, 'METRICS_PATH', str(tmp_path / 'metrics.json'))
+    monkeypatch.setattr(cli, 'PARTIAL_DOWNLOADS_PATH', str(tmp_path / 'partial'))
+    args = ['report', '--by', 'month', '-j', '1']
+
+    device = SimulatedDevice(raw_sessions[:2])
+    monkeypatch.setattr('usb.core.find', lambda **kwargs: device)
+    result = CliRunner().invoke(cli.cli, args)
+    assert result.exit_code == 0, result.output
+    assert '2 sessions, 2 parsed' in result.output
+
+    # Sessions in the store aren't downloaded
+    device = SimulatedDevice(raw_sessions)
+    result = CliRunner().invoke(cli.cli, args)
+    assert result.exit_code == 0, result.output
+    assert '3 sessions, 1 parsed' in result.output
+    assert device.packets_sent == 2 + len(raw_sessions[2])
+
+
+def test_distance_cache(tmp_path, monkeypatch):
+    from click.testing import CliRunner
+
+    from polar_rcx5_datalink import cli
+    from polar_rcx5_datalink.parser import TrainingSession
+    from test_parser import raw_sessions_with_expected_samples
+
+    sessions_dir = tmp_path / 'sessions'
+    sessions_dir.mkdir()
+    for num, (rs, _) in enumerate(raw_sessions_with_expected_samples()):
+        (sessions_dir / f'{num}.json').write_text(json.dumps(rs))
+    cache_path = tmp_path / 'distance-cache.json'
+    monkeypatch.setattr(cli, 'DISTANCE_CACHE_PATH', str(cache_path))
+    monkeypatch.setattr(cli, 'METRICS_PATH', str(tmp_path / 'metrics.json'))
+    monkeypatch.setattr(TrainingSession, 'distance_cache', None)
+
+    args = ['--distance-cache', 'export', '-s', str(sessions_dir), '-o', str(tmp_path)]
+    result = CliRunner().invoke(cli.cli, args)
+    assert result.exit_code == 0, result.output
+    assert cache_path.exists()
+
+    result = CliRunner().invoke(cli.cli, args)
+    assert result.exit_code == 0, result.output
+    assert 'Distance cache: 100% hits' in result.stderr
+
+    # JSON on stdout stays valid
+    for command in (['stats', '-j', '1'], ['report', '--json', '-j', '1']):
+        result = CliRunner().invoke(
+            cli.cli, ['--distance-cache', *command, '-s', str(sessions_dir)]
+        )
+        assert result.exit_code == 0, result.output
+        assert json.loads(result.stdout)
+        assert 'Distance cache' in result.stderr
+
+
+def test_import(tmp_path):
+    from click.testing import CliRunner
+
+    from polar_rcx5_datalink import cli
+    from test_parser import raw_sessions_with_expected_samples
+
+    sessions_dir = tmp_path / 'sessions'
+    sessions_dir.mkdir()
+    for num, (rs, _) in enumerate(raw_sessions_with_expected_samples()):
+        for copy in range(2):
+            (sessions_dir / f'{num}-{copy}.json').write_text(json.dumps(rs))
+
+    archive = tmp_path / 'archive'
+    args = ['import', str(sessions_dir), '-a', str(archive), '-j', '1']
+    result = CliRunner().invoke(cli.cli, args)
+
+    assert result.exit_code == 0, result.output
+    assert '6 files, 6 sessions' in result.output
+    assert '3 imported, 3 duplicates, 0 errors' in result.output
+    assert len(os.listdir(archive / 'sessions')) == 3
+
+
+def test_ls(tmp_path, monkeypatch):
+    from click.testing import CliRunner
+
+    from polar_rcx5_datalink import cli
+    from polar_rcx5_datalink.simulator import SimulatedDevice
+    from test_parser import raw_sessions_with_expected_samples
+
+    raw_sessions = [rs for rs, _ in raw_sessions_with_expected_samples()]
+    sessions_dir = tmp_path / 'sessions'
+    sessions_dir.mkdir()
+    for num, rs in enumerate(raw_sessions):
+        (sessions_dir / f'{num}.json').write_text(json.dumps(rs))
+
+    result = CliRunner().invoke(cli.cli, ['ls', '-s', str(sessions_dir)])
+    assert result.exit_code == 0, result.output
+    from_dir = result.output.splitlines()[1:]
+    assert len(from_dir) == len(raw_sessions)
+
+    device = SimulatedDevice(raw_sessions)
+    monkeypatch.setattr('usb.core.find', lambda **kwargs: device)
+    monkeypatch.setattr(cli, 'PARTIAL_DOWNLOADS_PATH', str(tmp_path / 'partial'))
+    result = CliRunner().invoke(cli.cli, ['ls', '--device'])
+
+    assert result.exit_code == 0, result.output
+    listed = [line for line in result.output.splitlines() if line[:3].strip().isdigit()]
+    # Sizes differ, sessions on the watch have no packet headers
+    assert [line[:40] for line in listed] == [line[:40] for line in from_dir]
+    assert all(r[2] != 0x09 or r[11:13] == b'\x00\x00' for r in device.requests)
+
+
+def test_export_from_date(tmp_path, monkeypatch):
+    from click.testing import CliRunner
+
+    from polar_rcx5_datalink import cli
+    from polar_rcx5_datalink.parser import TrainingSession
+    from polar_rcx5_datalink.simulator import SimulatedDevice
+    from test_parser import raw_sessions_with_expected_samples
+
+    raw_sessions = [rs for rs, _ in raw_sessions_with_expected_samples()]
+    device = SimulatedDevice(raw_sessions)
+    monkeypatch.setattr('usb.core.find', lambda **kwargs: device)
+    monkeypatch.setattr(cli, 'PARTIAL_DOWNLOADS_PATH', str(tmp_path / 'partial'))
+    from_date = TrainingSession(raw_sessions[2]).start_time
+
+    args = ['export', '-o', str(tmp_path), '-f', 'raw', '--from-date', str(from_date)]
+    result = CliRunner().invoke(cli.cli, args)
+
+    assert result.exit_code == 0, result.output
+    assert len(list(tmp_path.glob('*.json'))) == 1
+    assert device.packets_sent == 2 + len(raw_sessions[2])
+
+
+def test_parse_raw_sessions_in_batches(monkeypatch):
+    from polar_rcx5_datalink import cli, parser
+    from test_parser import raw_sessions_with_expected_samples
+
+    raw_sessions = [rs for rs, _ in raw_sessions_with_expected_samples()]
+    batches = []
+    resolve_timezones = parser.resolve_timezones
+
+    def record_batch(sessions, cache=None):
+        batches.append(len(sessions))
+        return resolve_timezones(sessions, cache)
+
+    monkeypatch.setattr(parser, 'resolve_timezones', record_batch)
+    monkeypatch.setattr(cli, 'TIMEZONE_BATCH_SIZE', 2)
+    read = []
+
+    def read_raw_sessions():
+        for rs in raw_sessions:
+            read.append(rs)
+            yield rs
+
+    sessions = cli.parse_raw_sessions(read_raw_sessions())
+    first = next(sessions)
+    # The rest of raw sessions isn't read yet
+    assert len(read) == 2
+    assert first.timezone is not None
+
+    assert len([first] + list(sessions)) == 3
+    assert batches == [2, 1]
@@ -0,0 +1,137 @@
+import json
+import os
+import socket
+import sys
+import time
+from functools import partial
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(os.path.dirname(__file__))))
+
+from polar_rcx5_datalink.cli import export_session
+from polar_rcx5_datalink.daemon import Daemon, SyncedSessions
+from polar_rcx5_datalink.simulator import SimulatedDevice
+from test_parser import raw_sessions_with_expected_samples
+
+
+def recorded_raw_sessions():
+    return [rs for rs, _ in raw_sessions_with_expected_samples()]
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def read_status(address):
+    with socket.create_connection(address) as sock:
+        return json.loads(sock.makefile().readline())
+
+
+def run_daemon(devices, synced, pipeline=()):
+    processed = []
+    sync_daemon = Daemon(
+        [*pipeline, processed.append],
+        synced,
+        find_devices=lambda: devices,
+        status_address=('127.0.0.1', 0),
+    )
+    sync_daemon.start()
+    try:
+        wait_for(lambda: sync_daemon.status()['devices'][0]['last_sync'])
+        status = read_status(sync_daemon.server_address)
+    finally:
+        sync_daemon.stop()
+
+    return processed, status
+
+
+def test_daemon(tmp_path):
+    raw_sessions = recorded_raw_sessions()
+    synced = SyncedSessions(str(tmp_path / 'synced.json'))
+
+    processed, status = run_daemon([SimulatedDevice(raw_sessions)], synced)
+
+    assert [sess.raw for sess in processed] == raw_sessions
+    assert status['synced_sessions'] == 3
+    (device,) = status['devices']
+    assert device['hw_id'] == '123456'
+    assert device['new_sessions'] == 3
+    assert device['error'] is None
+
+
+def test_daemon_is_incremental(tmp_path):
+    raw_sessions = recorded_raw_sessions()
+    path = str(tmp_path / 'synced.json')
+
+    run_daemon([SimulatedDevice(raw_sessions[:2])], SyncedSessions(path))
+    device = SimulatedDevice(raw_sessions)
+    processed, status = run_daemon([device], SyncedSessions(path))
+
+    assert [sess.raw for sess in processed] == raw_sessions[2:]
+    # Only first packets of synced sessions are downloaded
+    assert device.packets_sent == 2 + len(raw_sessions[2])
+    assert status['synced_sessions'] == 3
+
+
+def test_daemon_retries_sessions_that_failed_export(tmp_path):
+    raw_sessions = recorded_raw_sessions()
+    # Samples can't be parsed
+    broken = [raw_sessions[1][0]] + [[0xFF] * len(p) for p in raw_sessions[1][1:]]
+    path = str(tmp_path / 'synced.json')
+    out = tmp_path / 'out'
+    out.mkdir()
+    export = partial(export_session, out=str(out), file_format='tcx')
+
+    processed, status = run_daemon(
+        [SimulatedDevice([raw_sessions[0], broken, raw_sessions[2]])],
+        SyncedSessions(path),
+        [export],
+    )
+    assert [sess.raw for sess in processed] == raw_sessions[::2]
+    assert status['synced_sessions'] == 2
+    assert len(list(out.iterdir())) == 2
+
+    # The session is downloaded again on the next sync
+    processed, status = run_daemon(
+        [SimulatedDevice(raw_sessions)], SyncedSessions(path), [export]
+    )
+    assert [sess.raw for sess in processed] == raw_sessions[1:2]
+    assert status['synced_sessions'] == 3
+    assert len(list(out.iterdir())) == 3
+
+
+class ReconnectingDevice(SimulatedDevice):
+    """Counts connections, the watch announces itself again on each"""
+
+    connections = 0
+
+    def set_configuration(self):
+        self.connections += 1
+        self.paired = False
+
+
+def test_daemon_cools_down_after_sync(tmp_path):
+    device = ReconnectingDevice(recorded_raw_sessions()[:1])
+    devices = [device]
+    sync_daemon = Daemon(
+        [lambda sess: None],
+        SyncedSessions(str(tmp_path / 'synced.json')),
+        find_devices=lambda: list(devices),
+        poll_interval=0.01,
+    )
+    sync_daemon.start()
+    try:
+        wait_for(lambda: sync_daemon.status()['devices'][0]['last_sync'])
+        time.sleep(0.3)
+        assert device.connections == 1
+        assert sync_daemon.status()['devices'][0]['state'] == 'idle'
+
+        # Plugged in again
+        devices.clear()
+        wait_for(lambda: not sync_daemon.status()['devices'])
+        devices.append(device)
+        wait_for(lambda: device.connections == 2)
+    finally:
+        sync_daemon.stop()
@@ -0,0 +1,278 @@
+import asyncio
+import os
+import sys
+import threading
+
+import usb.core
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(os.path.dirname(__file__))))
+
+from polar_rcx5_datalink.async_datalink import AsyncDataLink
+from polar_rcx5_datalink.checkpoint import PartialDownloads
+from polar_rcx5_datalink.datalink import DataLink
+from polar_rcx5_datalink.multisync import sync_all
+from polar_rcx5_datalink.parser import TrainingSession
+from polar_rcx5_datalink.simulator import SimulatedDevice
+from test_parser import raw_sessions_with_expected_samples
+
+
+def recorded_raw_sessions():
+    return [rs for rs, _ in raw_sessions_with_expected_samples()]
+
+
+def test_datalink():
+    raw_sessions = recorded_raw_sessions()
+    device = SimulatedDevice(raw_sessions)
+
+    with DataLink(device) as dl:
+        dl.synchronize()
+        assert dl.hw_id == device.hw_id
+        assert dl.sessions == raw_sessions
+
+
+def test_async_datalink():
+    raw_sessions = recorded_raw_sessions()
+    device = SimulatedDevice(raw_sessions)
+    ticks = []
+
+    async def ticker(done):
+        # Event loop must stay responsive while sessions are downloaded
+        while not done.is_set():
+            ticks.append(None)
+            await asyncio.sleep(0)
+
+    async def sync():
+        done = asyncio.Event()
+        ticker_task = asyncio.ensure_future(ticker(done))
+        sessions = []
+        async with AsyncDataLink(device) as dl:
+            await dl.synchronize()
+            async for session in dl.iter_sessions():
+                sessions.append(session)
+
+        done.set()
+        await ticker_task
+        return sessions
+
+    assert asyncio.run(sync()) == raw_sessions
+    assert len(ticks) > len(device.requests)
+
+
+def test_list_sessions():
+    raw_sessions = recorded_raw_sessions()
+    device = SimulatedDevice(raw_sessions)
+
+    with DataLink(device) as dl:
+        dl.synchronize()
+        headers = dl.list_sessions()
+
+    assert [h.number for h in headers] == list(range(len(raw_sessions)))
+    for header, raw_session in zip(headers, raw_sessions):
+        sess = TrainingSession(raw_session)
+        assert header.start_time == sess.start_time
+        assert header.duration == sess.duration
+        assert header.has_gps == sess.has_gps
+        assert header.size == device.session_size(header.number)
+        assert header.first_packet == raw_session[0]
+
+    # Nothing but the first packets
+    assert len(packet_requests(device)) == len(raw_sessions)
+
+    async def list_async():
+        async with AsyncDataLink(SimulatedDevice(raw_sessions)) as dl:
+            await dl.synchronize()
+            return await dl.list_sessions()
+
+    assert asyncio.run(list_async()) == headers
+
+
+def test_read_selected_sessions(tmp_path):
+    raw_sessions = recorded_raw_sessions()
+    device = SimulatedDevice(raw_sessions)
+    checkpoints = PartialDownloads(str(tmp_path))
+    start_time = TrainingSession(raw_sessions[1]).start_time
+
+    with DataLink(device, checkpoints) as dl:
+        dl.synchronize()
+        sessions = dl.read_sessions(lambda header: header.start_time >= start_time)
+
+    assert sessions == raw_sessions[1:]
+    # First packets aren't requested twice
+    assert device.packets_sent == 1 + len(raw_sessions[1]) + len(raw_sessions[2])
+
+    async def read_async():
+        async with AsyncDataLink(SimulatedDevice(raw_sessions)) as dl:
+            await dl.synchronize()
+            return await dl.sessions(lambda header: header.number == 0)
+
+    assert asyncio.run(read_async()) == raw_sessions[:1]
+
+
+def packet_requests(device):
+    return [r for r in device.requests if r[2] == 0x09]
+
+
+def test_resume_session_download(tmp_path, monkeypatch):
+    monkeypatch.setattr(DataLink, '_GET_SESSION_ATTEMPTS', 1)
+    raw_sessions = recorded_raw_sessions()[:1]
+    checkpoints = PartialDownloads(str(tmp_path))
+
+    # Connection is lost in the middle of the session
+    device = SimulatedDevice(raw_sessions, fail_after_packets=5)
+    with DataLink(device, checkpoints) as dl:
+        dl.synchronize()
+        assert dl.sessions == []
+
+    device = SimulatedDevice(raw_sessions)
+    with DataLink(device, checkpoints) as dl:
+        dl.synchronize()
+        assert dl.sessions == raw_sessions
+
+    # The first packet is requested again to make sure it's the same session
+    requests = packet_requests(device)
+    assert len(requests) == len(raw_sessions[0]) - 5 + 1
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_resume_session_tail(tmp_path, monkeypatch):
+    monkeypatch.setattr(DataLink, '_GET_SESSION_ATTEMPTS', 1)
+    raw_sessions = recorded_raw_sessions()[:1]
+    packets_count = len(raw_sessions[0])
+    checkpoints = PartialDownloads(str(tmp_path))
+
+    # Connection is lost right before the last, shorter packet
+    device = SimulatedDevice(
+        raw_sessions, fail_after_packets=packets_count - 1, tail_sizes={0: 100}
+    )
+    with DataLink(device, checkpoints) as dl:
+        dl.synchronize()
+        assert dl.sessions == []
+
+    device = SimulatedDevice(raw_sessions, tail_sizes={0: 100})
+    with DataLink(device, checkpoints) as dl:
+        dl.synchronize()
+        assert dl.sessions == raw_sessions
+
+    # The first packet and the tail
+    requests = packet_requests(device)
+    assert len(requests) == 2
+    assert requests[1][15:17] == bytes((100, 0))
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_checkpoint_is_created_with_a_packet(tmp_path):
+    first, second = recorded_raw_sessions()[0][:2]
+    checkpoints = PartialDownloads(str(tmp_path / 'partial'))
+
+    assert checkpoints.restore((1, 2, 3), 0, 892, first) == {0: first}
+    assert not (tmp_path / 'partial').exists()
+
+    checkpoints.append((1, 2, 3), 0, 892, 1, second)
+    assert checkpoints.restore((1, 2, 3), 0, 892, first) == {0: first, 1: second}
+
+
+def test_resume_another_session(tmp_path, monkeypatch):
+    monkeypatch.setattr(DataLink, '_GET_SESSION_ATTEMPTS', 1)
+    _, second, _ = recorded_raw_sessions()
+    checkpoints = PartialDownloads(str(tmp_path))
+
+    device = SimulatedDevice([second], fail_after_packets=3)
+    with DataLink(device, checkpoints) as dl:
+        dl.synchronize()
+        assert dl.sessions == []
+
+    # Session with the same number and size but different data
+    other = [list(packet) for packet in second]
+    other[0][40] = (other[0][40] + 1) % 0x60
+    device = SimulatedDevice([other])
+    with DataLink(device, checkpoints) as dl:
+        dl.synchronize()
+        assert dl.sessions == [other]
+
+    assert len(packet_requests(device)) == len(other)
+
+
+def test_sync_all():
+    first, second, third = recorded_raw_sessions()
+    devices = [
+        SimulatedDevice([first, second], hw_id=(0x12, 0x34, 0x56)),
+        SimulatedDevice([third], hw_id=(0xAB, 0xCD, 0xEF)),
+    ]
+    received = {}
+
+    def on_session(hw_id, raw_session):
+        received.setdefault(hw_id, []).append(raw_session)
+
+    stats, seconds = sync_all(devices, on_session)
+
+    assert received == {
+        (0x12, 0x34, 0x56): [first, second],
+        (0xAB, 0xCD, 0xEF): [third],
+    }
+    assert [s.sessions for s in stats] == [2, 1]
+    assert [s.hw_id for s in stats] == [d.hw_id for d in devices]
+    assert all(s.error is None and s.throughput > 0 for s in stats)
+    # Workers run concurrently
+    assert seconds < sum(s.seconds for s in stats)
+
+
+def test_sync_all_isolates_errors():
+    devices = [SimulatedDevice([]), SimulatedDevice(recorded_raw_sessions())]
+    stats, _ = sync_all(devices, lambda hw_id, raw_session: None)
+
+    assert stats[0].error == 'No training sessions found'
+    assert stats[1].error is None and stats[1].sessions == 3
+
+
+class UnpluggedDevice(SimulatedDevice):
+    """DataLink that is unplugged after a few session packets"""
+
+    def read(self, endpoint, size, timeout=None):
+        if self.packets_sent >= 3:
+            raise usb.core.USBError('No such device', errno=19)
+
+        return super().read(endpoint, size, timeout)
+
+
+def test_sync_all_isolates_usb_and_callback_errors():
+    first, second, third = recorded_raw_sessions()
+    devices = [
+        UnpluggedDevice([first, second], hw_id=(0x12, 0x34, 0x56)),
+        SimulatedDevice([second, third], hw_id=(0xAB, 0xCD, 0xEF)),
+        SimulatedDevice([first, third], hw_id=(0x01, 0x02, 0x03)),
+    ]
+    received = []
+
+    def on_session(hw_id, raw_session):
+        if hw_id == (0x01, 0x02, 0x03):
+            raise OSError('Disk is full')
+        received.append(raw_session)
+
+    stats, _ = sync_all(devices, on_session)
+
+    assert 'No such device' in stats[0].error
+    assert stats[1].error is None and stats[1].sessions == 2
+    assert stats[2].error == "Can't handle session #1: Disk is full"
+    assert received == [second, third]
+
+
+def test_sync_all_exports_off_the_event_loop():
+    first, second, third = recorded_raw_sessions()
+    devices = [
+        SimulatedDevice([first], hw_id=(0x12, 0x34, 0x56)),
+        SimulatedDevice([second, third], hw_id=(0xAB, 0xCD, 0xEF)),
+    ]
+    other_done = threading.Event()
+    waited = []
+
+    def on_session(hw_id, raw_session):
+        # A slow export of one watch must not stop downloads of another
+        if hw_id == devices[0].hw_id:
+            waited.append(other_done.wait(timeout=10))
+        elif raw_session == third:
+            other_done.set()
+
+    stats, _ = sync_all(devices, on_session)
+
+    assert waited == [True]
+    assert all(s.error is None for s in stats)
@@ -0,0 +1,107 @@
+import os
+import pickle
+import sys
+
+import pytest
+
+ROOT = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'devscripts'))
+
+from polar_rcx5_datalink.geodesic import GeodesicCache, geodesic_distance
+from polar_rcx5_datalink.parser import TrainingSession
+from test_parser import raw_sessions_with_expected_samples
+
+
+def parse_distances(raw_session):
+    ts = TrainingSession(raw_session)
+    ts.set_timezone('UTC')
+    ts.parse_samples()
+
+    return [sample.distance for sample in ts.samples]
+
+
+def test_cached_distances(monkeypatch):
+    cache = GeodesicCache()
+    raw_sessions = [rs for rs, _ in raw_sessions_with_expected_samples()]
+    expected = [parse_distances(rs) for rs in raw_sessions]
+
+    monkeypatch.setattr(TrainingSession, 'distance_cache', cache)
+    for raw_session, distances in zip(raw_sessions, expected):
+        assert parse_distances(raw_session) == pytest.approx(distances, rel=1e-5)
+    assert cache.misses == len(cache)
+
+    misses = cache.misses
+    for raw_session in raw_sessions:
+        parse_distances(raw_session)
+    assert cache.misses == misses
+    assert cache.hit_rate > 0.5
+
+
+def test_segments_in_band():
+    cache = GeodesicCache(lat_band=0.01)
+    segments = [
+        ((55.751, 37.61), (55.7511, 37.6101)),
+        ((55.752, 100.0), (55.7521, 100.0001)),
+        ((55.758, -20.0), (55.7581, -19.9999)),
+    ]
+
+    for coord1, coord2 in segments:
+        meters = cache.distance(coord1, coord2)
+        assert meters == pytest.approx(geodesic_distance(coord1, coord2), rel=1e-3)
+    assert (cache.hits, cache.misses, len(cache)) == (2, 1, 1)
+
+    cache.distance((55.748, 37.61), (55.7481, 37.6101))
+    cache.distance((55.751, 37.61), (55.7512, 37.6101))
+    assert (cache.misses, len(cache)) == (3, 3)
+
+
+def test_lru_eviction():
+    cache = GeodesicCache(maxsize=2)
+    coords = [(10.0, 20.0), (10.0001, 20.0), (10.0, 20.0001)]
+
+    cache.distance(coords[0], coords[1])
+    cache.distance(coords[0], coords[2])
+    cache.distance(coords[0], coords[1])
+    cache.distance(coords[1], coords[2])
+    assert len(cache) == 2
+    assert cache.key(coords[0], coords[2]) not in cache._entries
+    assert cache.key(coords[0], coords[1]) in cache._entries
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / 'cache' / 'distances.json')
+    assert len(GeodesicCache.load(path)) == 0
+
+    cache = GeodesicCache()
+    for step in range(1, 6):
+        cache.distance((60.0, 30.0), (60.0 + step / 10000, 30.0))
+    cache.save(path)
+
+    loaded = GeodesicCache.load(path)
+    assert loaded._entries == cache._entries
+    assert (
+        loaded.distance((60.0, 31.0), (60.0005, 31.0))
+        == cache._entries[cache.key((60.0, 30.0), (60.0005, 30.0))]
+    )
+    assert loaded.hits == 1
+
+    assert (
+        list(GeodesicCache.load(path, maxsize=2)._entries) == list(cache._entries)[-2:]
+    )
+    assert len(GeodesicCache.load(path, lat_band=0.01)) == 0
+
+
+def test_merge_copy():
+    cache = GeodesicCache()
+    cache.distance((60.0, 30.0), (60.0001, 30.0))
+
+    # As a worker process gets it
+    copy = pickle.loads(pickle.dumps(cache))
+    copy.start_learning()
+    copy.distance((60.0, 30.0), (60.0001, 30.0))
+    copy.distance((60.0, 30.0), (60.0002, 30.0))
+    cache.merge(copy.pop_learned())
+
+    assert (cache.hits, cache.misses, len(cache)) == (1, 2, 2)
+    assert copy.pop_learned() == ([], 0, 0)
@@ -0,0 +1,45 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(os.path.dirname(__file__))))
+
+from polar_rcx5_datalink import packed
+from polar_rcx5_datalink.parser import TrainingSession
+from test_parser import raw_sessions_with_expected_samples
+
+
+def test_packed_sessions(tmp_path):
+    raw_sessions = [rs for rs, _ in raw_sessions_with_expected_samples()]
+    path = str(tmp_path / f'sessions{packed.SUFFIX}')
+    with open(path, 'wb') as f:
+        packed.write_sessions(f, raw_sessions)
+
+    packed_sessions = list(packed.read_sessions(path))
+    assert len(packed_sessions) == len(raw_sessions)
+
+    for raw_session, packed_session in zip(raw_sessions, packed_sessions):
+        assert all(isinstance(p, memoryview) for p in packed_session)
+        assert [list(p) for p in packed_session] == raw_session
+
+        expected = TrainingSession(raw_session)
+        ts = TrainingSession(packed_session)
+        assert ts.info == expected.info
+        assert ts.tobin() == expected.tobin()
+
+        expected.parse_samples()
+        ts.parse_samples()
+        assert ts.samples == expected.samples
+
+
+@pytest.mark.parametrize('count, length', [(0, 512), (3, 0), (0, 0)])
+def test_corrupted_header(tmp_path, count, length):
+    raw_session = [rs for rs, _ in raw_sessions_with_expected_samples()][0]
+    path = str(tmp_path / f'sessions{packed.SUFFIX}')
+    with open(path, 'wb') as f:
+        packed.write_sessions(f, [raw_session])
+        f.write(packed._SESSION_HEADER.pack(count, length))
+
+    with pytest.raises(ValueError, match='is corrupted'):
+        list(packed.read_sessions(path))
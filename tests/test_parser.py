@@ -4,9 +4,29 @@ import pickle
 
 import pytest
 
-sys.path.insert(0, os.path.abspath(os.path.dirname(os.path.dirname(__file__))))
+ROOT = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'devscripts'))
 
-from polar_rcx5_datalink.parser import TrainingSession
+from polar_rcx5_datalink.exceptions import ParserError
+from polar_rcx5_datalink.parser import (
+    COORD_DELTA_TABLE,
+    HR_TABLE,
+    Sample,
+    SampleFields,
+    TrainingSession,
+    _decoder,
+    coord_nanos,
+    decode_hr_bits,
+    resolve_timezones,
+)
+from synthetic_sessions import (
+    encode_hr,
+    gps_session,
+    random_hr,
+    random_track,
+    raw_session,
+)
 
 
 def raw_sessions_with_expected_samples():
@@ -30,3 +50,239 @@ def test_parse_samples(raw_session, expected_samples):
     ts = TrainingSession(raw_session)
     ts.parse_samples()
     assert ts.samples == expected_samples
+
+
+def test_resolve_timezones():
+    raw_sessions = [rs for rs, _ in raw_sessions_with_expected_samples()]
+    sessions = [TrainingSession(rs) for rs in raw_sessions]
+    cache = resolve_timezones(sessions)
+
+    for rs, ts in zip(raw_sessions, sessions):
+        parsed = TrainingSession(rs)
+        parsed.parse_samples()
+
+        assert ts.first_coords() == parsed.first_coords()
+        assert (ts.first_coords().lat, ts.first_coords().lon) in cache
+        assert ts.timezone == parsed.timezone
+        assert ts.start_utctime == parsed.start_utctime
+        assert ts.id == parsed.id
+
+
+def test_resolve_timezones_skips_corrupted_sessions():
+    raw_sessions = [rs for rs, _ in raw_sessions_with_expected_samples()]
+    # First packet is cut right after the start of samples
+    corrupted = TrainingSession([raw_sessions[0][0][:352]] + raw_sessions[0][1:])
+    sessions = [corrupted] + [TrainingSession(rs) for rs in raw_sessions[1:]]
+    resolve_timezones(sessions)
+
+    assert corrupted.timezone is None
+    for rs, ts in zip(raw_sessions[1:], sessions[1:]):
+        parsed = TrainingSession(rs)
+        parsed.parse_samples()
+        assert ts.timezone == parsed.timezone
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_hr_only_samples(seed):
+    values = random_hr(2000, seed)
+    ts = TrainingSession(raw_session(encode_hr(values), has_gps=False))
+    ts.parse_samples()
+
+    generic = TrainingSession(ts.raw)
+    generic._samples_bits = generic._get_samples_bits()
+    generic._parse_samples()
+
+    assert ts.samples == generic.samples
+    assert list(ts.hr_samples) == [s.hr for s in generic.samples]
+    assert ts.samples[: len(values)] == [Sample(hr) for hr in values]
+
+
+def test_hr_only_samples_below_zero():
+    # Deltas of a corrupted or badly fitted strap can run HR below zero
+    values = [6, 2, -3, -9, -5, 0, 4]
+    ts = TrainingSession(raw_session(encode_hr(values), has_gps=False))
+    ts.parse_samples()
+
+    generic = TrainingSession(ts.raw)
+    generic._samples_bits = generic._get_samples_bits()
+    generic._parse_samples()
+
+    assert ts.samples == generic.samples
+    assert ts.samples[: len(values)] == [Sample(hr) for hr in values]
+
+
+@pytest.mark.parametrize('has_gps', (True, False))
+def test_iter_samples(has_gps):
+    if has_gps:
+        raw, _ = gps_session(random_track(300, 0, has_hr=True), True, 0)
+    else:
+        raw = raw_session(encode_hr(random_hr(300, 0)), has_gps=False)
+    parsed = TrainingSession(raw)
+    parsed.set_timezone('UTC')
+    parsed.parse_samples()
+
+    ts = TrainingSession(raw)
+    ts.set_timezone('UTC')
+    assert list(ts.iter_samples()) == parsed.samples
+    assert (ts.distance, ts.max_speed) == (parsed.distance, parsed.max_speed)
+    assert ts.samples == []
+    # Decoding starts over
+    assert list(ts.iter_samples()) == parsed.samples
+    assert ts.distance == parsed.distance
+    assert list(parsed.iter_samples()) == parsed.samples
+
+
+def test_iter_samples_of_corrupted_session():
+    raw, _ = gps_session(random_track(300, 1, has_hr=True), True, 1)
+    parsed = TrainingSession(raw)
+    parsed.set_timezone('UTC')
+    parsed.parse_samples()
+
+    ts = TrainingSession(raw)
+    ts.set_timezone('UTC')
+    ts._load_samples_bits()
+    middle = len(ts._samples_bits) // 2
+    ts._samples_bits = ts._samples_bits[:middle] + '2' * 64
+
+    samples = []
+    with pytest.raises(ParserError):
+        for sample in ts.iter_samples():
+            samples.append(sample)
+    assert 100 < len(samples) < len(parsed.samples)
+    assert samples == parsed.samples[: len(samples)]
+
+
+@pytest.mark.parametrize('has_hr', (True, False))
+@pytest.mark.parametrize('seed', range(3))
+def test_gps_samples(seed, has_hr):
+    track = random_track(1000, seed, has_hr)
+    raw, expected = gps_session(track, has_hr, seed)
+    ts = TrainingSession(raw)
+    ts.set_timezone('UTC')
+    ts.parse_samples()
+
+    assert any(sample.lap for sample in track)
+    assert [sample[:3] for sample in ts.samples] == expected
+
+
+def test_coord_nanos():
+    raw, _ = next(raw_sessions_with_expected_samples())
+    ts = TrainingSession(raw)
+    for bits, nanos in COORD_DELTA_TABLE.items():
+        assert nanos / 10 ** 9 == ts._format_coord_delta(bits)
+
+    for frac in range(0, 2 ** 20, 7):
+        assert coord_nanos(frac) / 10 ** 9 == ts._format_coord_frac(frac)
+
+
+def test_coords_against_reference(monkeypatch):
+    sessions = [rs for rs, _ in raw_sessions_with_expected_samples()]
+    for seed in range(2):
+        track = random_track(1000, seed, has_hr=seed == 0)
+        sessions.append(gps_session(track, seed == 0, seed)[0])
+    parsed = []
+    for raw in sessions:
+        ts = TrainingSession(raw)
+        ts.set_timezone('UTC')
+        ts.parse_samples()
+        parsed.append(ts.samples)
+
+    monkeypatch.setattr(
+        TrainingSession, '_parse_coord', TrainingSession._parse_coord_reference
+    )
+    for raw, samples in zip(sessions, parsed):
+        reference = TrainingSession(raw)
+        reference.set_timezone('UTC')
+        reference.parse_samples()
+        assert samples == reference.samples
+
+
+@pytest.mark.parametrize(
+    'bits,frozen',
+    [
+        ('011010000001' + '0' * 16, True),  # full value, same degree
+        ('011010010001' + '0' * 16, True),  # other degree, not parsed
+        ('111111111111', False),
+        ('000000000000', False),
+        ('10110', False),  # end of session
+    ],
+)
+def test_coord_edge_cases(bits, frozen):
+    def parse(method):
+        ts = TrainingSession(raw_session(encode_hr([100]), has_gps=False))
+        ts._prev = Sample(lon=104.000001667, lat=65.5)
+        ts._coord_nanos[SampleFields.LON] = 104000001667
+        ts._zero_delta_counter[SampleFields.LON] = 2 if frozen else 1
+        ts._samples_bits = bits
+        value = method(ts, SampleFields.LON)
+
+        return value, ts._cursor, ts._zero_delta_counter[SampleFields.LON]
+
+    expected = parse(TrainingSession._parse_coord_reference)
+    assert parse(TrainingSession._parse_coord) == expected
+
+
+def test_hr_table():
+    assert len(HR_TABLE) == 2 ** 11
+    for bits, entry in HR_TABLE.items():
+        assert entry == decode_hr_bits(bits)
+
+
+@pytest.mark.parametrize(
+    'raw_session,expected_samples', raw_sessions_with_expected_samples()
+)
+def test_hr_table_against_reference(monkeypatch, raw_session, expected_samples):
+    ts = TrainingSession(raw_session)
+    ts.parse_samples()
+
+    monkeypatch.setattr(
+        TrainingSession, '_process_hr_bits', TrainingSession._process_hr_bits_reference
+    )
+    reference = TrainingSession(raw_session)
+    reference.parse_samples()
+
+    assert ts.samples == reference.samples
+
+
+def synthetic_sessions():
+    for seed in range(3):
+        for has_hr in (True, False):
+            yield gps_session(random_track(1000, seed, has_hr), has_hr, seed)[0]
+        yield raw_session(encode_hr(random_hr(1000, seed)), has_gps=False)
+
+
+def decoded(raw_session, corrupt=False):
+    ts = TrainingSession(raw_session)
+    ts.set_timezone('UTC')
+    ts._load_samples_bits()
+    if corrupt:
+        middle = len(ts._samples_bits) // 2
+        ts._samples_bits = ts._samples_bits[:middle] + '2' + ts._samples_bits[middle:]
+    try:
+        ts._parse_samples()
+    except ValueError:
+        pass
+
+    state = (
+        ts._cursor,
+        ts._zero_delta_counter,
+        ts._coord_nanos,
+        ts._prefixless_zero_sat,
+    )
+    return ts.samples, ts.distance, ts.max_speed, state
+
+
+@pytest.mark.skipif(_decoder is None, reason='compiled decoder is not built')
+@pytest.mark.parametrize('chunk_size', (4096, 7))
+@pytest.mark.parametrize(
+    'raw_session',
+    [rs for rs, _ in raw_sessions_with_expected_samples()] + list(synthetic_sessions()),
+)
+def test_compiled_decoder(monkeypatch, raw_session, chunk_size):
+    monkeypatch.setattr(TrainingSession, '_COMPILED_CHUNK_SIZE', chunk_size)
+    compiled = decoded(raw_session)
+    corrupted = decoded(raw_session, corrupt=True)
+
+    monkeypatch.setattr('polar_rcx5_datalink.parser._decoder', None)
+    assert compiled == decoded(raw_session)
+    assert corrupted == decoded(raw_session, corrupt=True)
@@ -0,0 +1,126 @@
+import math
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(os.path.dirname(__file__))))
+
+from polar_rcx5_datalink import simplify
+from polar_rcx5_datalink.converter import TCXConverter
+from polar_rcx5_datalink.parser import TrainingSession
+from polar_rcx5_datalink.simplify import (
+    douglas_peucker_importance,
+    project,
+    segment_distance,
+    simplified_session,
+    simplify_coords,
+)
+from test_parser import raw_sessions_with_expected_samples
+
+
+def douglas_peucker(points, tolerance):
+    """Textbook recursive Douglas-Peucker, returns kept indexes"""
+    if len(points) < 3:
+        return list(range(len(points)))
+
+    dists = [segment_distance(p, points[0], points[-1]) for p in points[1:-1]]
+    index = max(range(len(dists)), key=dists.__getitem__) + 1
+    if dists[index - 1] <= tolerance:
+        return [0, len(points) - 1]
+
+    left = douglas_peucker(points[: index + 1], tolerance)
+    right = douglas_peucker(points[index:], tolerance)
+    return left[:-1] + [i + index for i in right]
+
+
+def random_track(seed, count=500):
+    rnd = random.Random(seed)
+    lat, lon = 60.0, 30.0
+    track = []
+    for _ in range(count):
+        lat += rnd.uniform(-1, 1) * 1e-4
+        lon += rnd.uniform(-1, 1) * 1e-4
+        track.append((lat, lon))
+
+    return track
+
+
+def test_straight_line():
+    track = [(60.0 + i * 1e-4, 30.0) for i in range(100)]
+
+    assert simplify_coords(track, tolerance=0.1) == [0, 99]
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('tolerance', [1, 5, 20])
+def test_tolerance_matches_recursive_implementation(seed, tolerance):
+    track = random_track(seed)
+
+    assert simplify_coords(track, tolerance=tolerance) == douglas_peucker(
+        project(track), tolerance
+    )
+
+
+def test_max_points():
+    track = random_track(0)
+    indexes = simplify_coords(track, max_points=50)
+
+    assert len(indexes) == 50
+    assert indexes[0] == 0 and indexes[-1] == len(track) - 1
+    assert indexes == sorted(indexes)
+
+
+def test_project_distances():
+    (x1, y1), (x2, y2) = project([(60.0, 30.0), (60.001, 30.0)])
+
+    assert math.isclose(math.hypot(x2 - x1, y2 - y1), 111.2, rel_tol=1e-3)
+
+
+def test_vectorized_search_matches_python(monkeypatch):
+    points = project(random_track(1, count=2000))
+    vectorized = douglas_peucker_importance(points)
+    monkeypatch.setattr(simplify, '_VECTORIZE_MIN_SPAN', math.inf)
+
+    assert douglas_peucker_importance(points) == pytest.approx(vectorized)
+
+
+@pytest.fixture
+def training_session():
+    raw_session, _ = next(raw_sessions_with_expected_samples())
+    sess = TrainingSession(raw_session)
+    sess.parse_samples()
+    return sess
+
+
+def test_simplified_session(training_session):
+    simplified = simplified_session(training_session, tolerance=5)
+    samples = training_session.samples
+    kept = simplified.sample_indexes
+
+    assert 2 < len(simplified.samples) < len(samples)
+    assert simplified.samples[0] == samples[0]
+    assert [s.hr for s in simplified.samples] == [samples[i].hr for i in kept]
+    assert sum(s.distance for s in simplified.samples) == pytest.approx(
+        sum(s.distance for s in samples)
+    )
+    # Original session is intact
+    assert training_session.sample_indexes is None
+
+
+def test_downsampled_session(training_session):
+    rate = training_session.info['sample_rate']
+    simplified = simplified_session(training_session, sample_rate=rate * 10)
+    offsets = [simplified.sample_offset(i) for i in range(len(simplified.samples))]
+
+    assert len(simplified.samples) == math.ceil(len(training_session.samples) / 10) + 1
+    assert offsets[:3] == [0, rate * 10, rate * 20]
+    assert offsets[-1] == rate * (len(training_session.samples) - 1)
+
+
+def test_tcx_of_simplified_session(training_session):
+    simplified = simplified_session(training_session, tolerance=5)
+    trackpoints = TCXConverter(simplified).element_tree.iter('Trackpoint')
+
+    assert len(list(trackpoints)) == len(simplified.samples)
@@ -0,0 +1,422 @@
+import http.server
+import json
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(os.path.dirname(__file__))))
+
+from polar_rcx5_datalink.parser import TrainingSession
+from polar_rcx5_datalink.strava_sync.app import create_app
+from polar_rcx5_datalink.strava_sync.jobs import JobQueue
+from polar_rcx5_datalink.strava_sync.ledger import UploadLedger
+from polar_rcx5_datalink.strava_sync import jobs as jobs_module
+from polar_rcx5_datalink.strava_sync import previews as previews_module
+from polar_rcx5_datalink.strava_sync import scheduler as scheduler_module
+from polar_rcx5_datalink.strava_sync.previews import TRACK_POINTS, Previews
+from polar_rcx5_datalink.strava_sync.scheduler import (
+    RateLimits,
+    UploadQueue,
+    UploadScheduler,
+)
+from test_parser import raw_sessions_with_expected_samples
+
+
+class MockStrava(object):
+    """Strava's upload endpoint with rate limit headers"""
+
+    def __init__(self, limits=(100, 1000)):
+        self.limits = list(limits)
+        self.usage = [0, 0]
+        self.uploads = []
+        # Activity ID all uploads are duplicates of
+        self.duplicate_of = None
+        # Statuses of errors returned instead of handling next uploads
+        self.errors = []
+        # Seconds, the 15 minute window is reset on its own if set
+        self.window = None
+        # Errors of uploads that can't be processed by upload ID
+        self.processing_errors = {}
+        self._window_end = 0
+        self._server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), self._handler_class()
+        )
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f'http://{host}:{port}'
+
+    def reset_window(self):
+        self.usage[0] = 0
+
+    def shutdown(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def respond(self, body):
+        if self._count_request():
+            return 429, {'message': 'Rate Limit Exceeded'}
+
+        if self.errors:
+            return self.errors.pop(0), {'message': 'Error'}
+
+        if self.duplicate_of is not None:
+            return 400, {
+                'error': f"duplicate of <a href='/activities/{self.duplicate_of}'>"
+            }
+
+        self.uploads.append(body)
+        return 201, {'id': len(self.uploads), 'activity_id': None, 'error': None}
+
+    def upload_status(self, upload_id):
+        """Uploads are processed by the time they are polled"""
+        if self._count_request():
+            return 429, {'message': 'Rate Limit Exceeded'}
+
+        if upload_id > len(self.uploads):
+            return 404, {'message': 'Record Not Found'}
+
+        error = self.processing_errors.get(upload_id)
+        activity_id = None if error else 1000 + upload_id
+        return 200, {'id': upload_id, 'activity_id': activity_id, 'error': error}
+
+    def _count_request(self):
+        """Returns True if the request exceeds rate limits"""
+        now = time.time()
+        if self.window is not None and now >= self._window_end:
+            self.reset_window()
+            self._window_end = now - now % self.window + self.window
+
+        self.usage = [used + 1 for used in self.usage]
+        return any(used > limit for used, limit in zip(self.usage, self.limits))
+
+    def _handler_class(self):
+        mock = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                self._send(*mock.respond(body))
+
+            def do_GET(self):
+                upload_id = int(self.path.rsplit('/', 1)[-1])
+                self._send(*mock.upload_status(upload_id))
+
+            def _send(self, status, data):
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header(
+                    'X-RateLimit-Limit', ','.join(str(val) for val in mock.limits)
+                )
+                self.send_header(
+                    'X-RateLimit-Usage', ','.join(str(val) for val in mock.usage)
+                )
+                self.end_headers()
+                self.wfile.write(json.dumps(data).encode())
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def strava():
+    mock = MockStrava()
+    yield mock
+    mock.shutdown()
+
+
+@pytest.fixture
+def training_session():
+    sessions = (TrainingSession(rs) for rs, _ in raw_sessions_with_expected_samples())
+    return next(sess for sess in sessions if sess.has_gps)
+
+
+def scheduler_at(path, strava, clock=None):
+    return UploadScheduler(
+        UploadQueue(str(path / 'queue')),
+        UploadLedger(str(path / 'uploads.json')),
+        RateLimits(clock=clock or Clock()),
+        api_url=strava.url,
+    )
+
+
+def queue_uploads(queue, count):
+    for num in range(count):
+        queue.put({'session_id': f'session-{num}', 'hash': '', 'tcx': '<tcx/>'})
+
+
+def test_ledger_skips_uploaded_sessions(tmp_path, strava, training_session):
+    scheduler = scheduler_at(tmp_path, strava)
+
+    assert scheduler.submit(training_session)
+    # Already queued
+    assert not scheduler.submit(training_session)
+    assert scheduler.drain('token') == 1
+    # Already uploaded
+    assert not scheduler.submit(training_session)
+    assert len(strava.uploads) == 1
+
+    # Ledger is persistent
+    entry = UploadLedger(scheduler.ledger.path).get(training_session)
+    assert entry['upload_id'] == 1
+
+
+def test_scheduler_polls_uploads(tmp_path, strava, training_session):
+    scheduler = scheduler_at(tmp_path, strava)
+    scheduler.submit(training_session)
+    scheduler.drain('token')
+
+    # Strava hasn't processed the upload yet
+    assert scheduler.ledger.get(training_session)['activity_id'] is None
+    assert scheduler.is_processing()
+
+    assert scheduler.poll('token') == 1
+    assert not scheduler.is_processing()
+    entry = UploadLedger(scheduler.ledger.path).get(training_session)
+    assert entry['activity_id'] == 1001
+
+
+def test_scheduler_clears_failed_processing(tmp_path, strava, training_session):
+    strava.processing_errors[1] = 'Improperly formatted data.'
+    scheduler = scheduler_at(tmp_path, strava)
+    scheduler.submit(training_session)
+    scheduler.drain('token')
+
+    assert scheduler.poll('token') == 1
+    assert not scheduler.ledger.is_uploaded(training_session)
+    # The session can be uploaded again
+    assert scheduler.submit(training_session)
+
+
+def test_ledger_checks_content(tmp_path, strava, training_session):
+    scheduler = scheduler_at(tmp_path, strava)
+    scheduler.submit(training_session)
+    scheduler.drain('token')
+
+    changed = TrainingSession(training_session.raw[:-1])
+    changed.id = training_session.id
+
+    assert not scheduler.ledger.is_uploaded(changed)
+
+
+def test_ledger_records_duplicates(tmp_path, strava, training_session):
+    strava.duplicate_of = 42
+    scheduler = scheduler_at(tmp_path, strava)
+    scheduler.submit(training_session)
+
+    assert scheduler.drain('token') == 1
+    assert scheduler.ledger.get(training_session)['activity_id'] == 42
+
+
+def test_scheduler_respects_rate_limits(tmp_path, strava):
+    strava.limits = [2, 10]
+    clock = Clock()
+    scheduler = scheduler_at(tmp_path, strava, clock)
+    queue_uploads(scheduler.queue, 3)
+
+    assert scheduler.drain('token', block=False) == 2
+    assert len(scheduler.queue) == 1
+    # Limits are known from the headers, no request is made
+    assert scheduler.drain('token', block=False) == 0
+    assert strava.usage == [2, 2]
+
+
+def test_scheduler_resumes_after_restart(tmp_path, strava):
+    strava.limits = [2, 10]
+    queue_uploads(scheduler_at(tmp_path, strava).queue, 3)
+    scheduler_at(tmp_path, strava).drain('token', block=False)
+
+    # A restarted scheduler learns limits from a 429 and keeps the upload
+    clock = Clock()
+    scheduler = scheduler_at(tmp_path, strava, clock)
+    assert scheduler.drain('token', block=False) == 0
+    assert len(scheduler.queue) == 1
+
+    clock.now += 15 * 60
+    strava.reset_window()
+    assert scheduler.drain('token', block=False) == 1
+    assert len(scheduler.queue) == 0
+    assert len(strava.uploads) == 3
+
+
+def test_scheduler_retries_server_errors(tmp_path, strava, monkeypatch):
+    monkeypatch.setattr(scheduler_module, '_RETRY_INTERVAL', 0.01)
+    strava.errors = [503]
+    scheduler = scheduler_at(tmp_path, strava)
+    queue_uploads(scheduler.queue, 1)
+
+    stop = threading.Event()
+    thread = threading.Thread(target=scheduler.serve, args=('token', stop))
+    thread.start()
+    try:
+        deadline = time.monotonic() + 10
+        while not strava.uploads:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+    finally:
+        stop.set()
+        thread.join()
+
+    assert len(scheduler.queue) == 0
+    assert 'session-0' in json.loads((tmp_path / 'uploads.json').read_text())
+
+
+def test_scheduler_sets_rejected_uploads_aside(tmp_path, strava):
+    strava.errors = [400]
+    scheduler = scheduler_at(tmp_path, strava)
+    queue_uploads(scheduler.queue, 2)
+
+    assert scheduler.drain('token') == 2
+    assert len(strava.uploads) == 1
+    assert len(scheduler.queue) == 0
+    (failed,) = (tmp_path / 'queue' / UploadQueue.FAILED_DIR).iterdir()
+    item = json.loads(failed.read_text())
+    assert item['session_id'] == 'session-0'
+    assert '400' in item['error']
+
+
+def test_app_uploads_in_background(tmp_path, strava):
+    strava.limits = [1, 10]
+    sessions = [TrainingSession(rs) for rs, _ in raw_sessions_with_expected_samples()]
+    sessions = [sess for sess in sessions if sess.has_gps]
+    app = create_app(1, 'secret', sessions, scheduler_at(tmp_path, strava))
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['access_token'] = 'token'
+
+    resp = client.post('/jobs', data={'training_sessions': [s.id for s in sessions]})
+    assert resp.status_code == 202
+
+    job = resp.get_json()
+    deadline = time.monotonic() + 10
+    while not job['finished']:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+        job = client.get(f'/jobs/{job["id"]}').get_json()
+
+    assert job['done'] == job['total'] == len(sessions)
+    # The rest waits for the next 15 minute window
+    assert list(job['sessions'].values()) == ['uploaded'] + ['waiting'] * (
+        len(sessions) - 1
+    )
+    assert b'Uploaded' in client.get('/').data
+
+
+def test_app_drains_waiting_uploads(tmp_path, strava, monkeypatch):
+    monkeypatch.setattr(jobs_module, 'POLL_INTERVAL', 0.05)
+    strava.limits = [1, 10]
+    strava.window = 0.5
+    scheduler = scheduler_at(tmp_path, strava, clock=time.time)
+    # Short windows of the real clock instead of 15 minutes
+    bucket = scheduler.rate_limits.buckets[0]
+    bucket.window = strava.window
+    bucket.reset_at = bucket._next_window()
+
+    sessions = [TrainingSession(rs) for rs, _ in raw_sessions_with_expected_samples()]
+    sessions = [sess for sess in sessions if sess.has_gps]
+    app = create_app(1, 'secret', sessions, scheduler)
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['access_token'] = 'token'
+
+    resp = client.post('/jobs', data={'training_sessions': [s.id for s in sessions]})
+    job_id = resp.get_json()['id']
+
+    # No more jobs are submitted, uploads go on as windows are reset
+    deadline = time.monotonic() + 10
+    while len(strava.uploads) < len(sessions):
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+    job = client.get(f'/jobs/{job_id}').get_json()
+    assert 'waiting' in job['sessions'].values()
+    assert len(scheduler.queue) == 0
+    assert all(scheduler.ledger.is_uploaded(sess) for sess in sessions)
+
+    # Activity IDs are polled for in the background as well
+    while scheduler.is_processing():
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+    assert all(scheduler.ledger.get(sess)['activity_id'] for sess in sessions)
+    app.extensions['upload_jobs'].close()
+
+
+def test_job_queue_evicts_finished_jobs(tmp_path, strava):
+    clock = Clock()
+    jobs = JobQueue(scheduler_at(tmp_path, strava), clock=clock)
+    finished = jobs.submit([], 'token')
+    deadline = time.monotonic() + 10
+    while not finished.finished:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+    jobs.submit([], 'token')
+    assert jobs.get(finished.id) is finished
+
+    clock.now += jobs_module.JOB_TTL + 1
+    latest = jobs.submit([], 'token')
+    assert jobs.get(finished.id) is None
+    assert jobs.get(latest.id) is latest
+    jobs.close()
+
+
+def test_upload_queue_index(tmp_path):
+    queue_uploads(UploadQueue(str(tmp_path)), 3)
+
+    queue = UploadQueue(str(tmp_path))
+    assert 'session-1' in queue
+    name, item = queue.peek()
+    assert item['session_id'] == 'session-0'
+    queue.remove(name)
+    queue.put({'session_id': 'session-3', 'hash': '', 'tcx': '<tcx/>'})
+
+    assert 'session-0' not in queue and 'session-3' in queue
+    assert 'session-3' in UploadQueue(str(tmp_path))
+
+
+def test_app_job_requires_selection(tmp_path, strava):
+    app = create_app(1, 'secret', [], scheduler_at(tmp_path, strava))
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['access_token'] = 'token'
+
+    assert client.post('/jobs').status_code == 400
+    assert client.get('/jobs/unknown').status_code == 404
+
+
+def test_previews(tmp_path, strava, monkeypatch):
+    sessions = [TrainingSession(rs) for rs, _ in raw_sessions_with_expected_samples()]
+    previews = Previews(sessions, str(tmp_path / 'previews'))
+    previews.start()
+    previews.join()
+
+    app = create_app(1, 'secret', sessions, scheduler_at(tmp_path, strava), previews)
+    data = app.test_client().get('/previews').get_json()
+
+    assert data['ready']
+    for sess in sessions:
+        preview = data['previews'][sess.id]
+        assert preview['duration'] == sess.duration
+        assert 2 <= len(preview['track']) <= TRACK_POINTS
+
+    # Cached previews are not computed again
+    monkeypatch.setattr(previews_module, 'session_preview', None)
+    cached = Previews(sessions, previews.path)
+    cached._compute_all()
+    assert cached.todict() == data['previews']